@@ -12,25 +12,76 @@
 # inst.ks -- tells anaconda to do http, but direct through this cgi script
 # rocks.ks -- tells this script where to fetch the real kickstart file
 #
+# Optional parameters
+# rocks.ks=<url1>,<url2>,... -- more than one kickstart server (frontend,
+#	replicas). The first is the primary.
+# rocks.ks.peers=1 -- also ask every host in tracker.trackers, using the
+#	path of the primary rocks.ks url
+# rocks.ks.hedge=<secs> -- how long to wait on one server before sending
+#	the same request to the next one (default HEDGEDELAY)
+# rocks.ks.timeout=<secs> -- timeout of a single request
+# rocks.ks.deadline=<secs> -- give up (rescue kickstart) after this long
+#	(default DEADLINE)
+# rocks.ks.window=<secs> -- spread the first request of all nodes over
+#	this many seconds (default 0, ask right away)
+# rocks.ks.rack=<n> rocks.ks.rank=<n> -- place this node in the window
+#	deterministically instead of at random
+#
+# Requests are hedged: servers are asked one after another, HEDGEDELAY
+# apart, without waiting for the earlier ones to finish. The first complete
+# kickstart file wins and the remaining requests are abandoned.
+#
+# Admission control: when every server failed, the node sleeps with
+# decorrelated jitter backoff (BACKOFFBASE .. BACKOFFCAP) before asking
+# again, never past the deadline. A busy frontend may answer with
+#	Retry-After: <secs> -- minimum time before asking again
+#	X-Rocks-Slot: <secs> -- come back in exactly this many seconds
+#	X-Rocks-Token: <token> -- handed back in the next request so the
+#		frontend can admit the node in its reserved slot
+# A slot is honored as is (0 or less means right away, after SLOTFLOOR), so
+# a frontend that hands out slots at the rate it can generate kickstart
+# files drains the queue without retry waves.
+#
+# Kickstart cache: on a reinstall, the last good kickstart file and its
+# ETag (or, if the frontend sent none, a sha1 of its contents) are kept in
+# CACHEDIR on the state partition of the rocks disk, i.e. a partition that
+# do_partition.py reconnects with --noformat. It is found with blkid and
+# the fstab of the previous install, and mounted read-only except while
+# the cache is written. Requests carry
+# If-None-Match so the frontend can answer 304 Not Modified instead of
+# generating the kickstart again. rocks.ks.cache=0 turns this off.
+#
 # In case of failure:
 # 	slow frontend, no frontend. - create a "rescue kickstart file"
 #       can ssh to the node with passwd "rescueME" 
 #       attempts to leave a failure note on the frontend
 #
 DEFAULTURL = "https://10.1.117.1/install/sbin/kickstart.cgi"
-RETRIES = 4
 MINTIMEOUT = 2
 MAXTIMEOUT = 20
+HEDGEDELAY = 2.0
+DEADLINE = 600
+BACKOFFBASE = MINTIMEOUT
+BACKOFFCAP = 120
+SLOTFLOOR = 0.1
+GOLDENRATIO = 0.6180339887
+CACHEDIR = ".rocks-ks"
+CACHEFSTYPES = [ "ext2", "ext3", "ext4", "xfs" ]
 import os
 import sys
+import tempfile
+import hashlib
 import urllib,urllib2
+import urlparse
 import random
 import time
 import ssl
 import socket
+import threading
+import Queue
 
 print "# Opening /proc/cmdline looking for rocks.ks and rocks.ks.timeout"
-arg = []
+cmdline = []
 url = None
 RESCUE_KICKSTART="""
 # There was an error retrieving the kickstart file
@@ -49,40 +100,251 @@ if [ -f /tracker/peer-done ]; then /tracker/peer-done; fi
 /sbin/shutdown -r +2 
 %%end
 """
+
+def cmdlineArg(args, name):
+	""" Return the value of the last name=value boot parameter,
+	or None if it was not given """
+	values = filter(lambda x: x[0] == name and len(x) > 1, args)
+	if len(values) > 0:
+		return "=".join(values[-1][1:])
+	return None
+
+def backoff(previous, floor=0):
+	""" Decorrelated jitter: the next sleep is drawn between BACKOFFBASE
+	and three times the previous sleep, capped at BACKOFFCAP. floor
+	(a server supplied Retry-After) is the shortest allowed sleep """
+	low = max(BACKOFFBASE, floor)
+	high = max(low + BACKOFFBASE, previous * 3)
+	return min(max(BACKOFFCAP, floor), random.uniform(low, high))
+
+def initialDelay(window, rack, rank):
+	""" Where in the startup window this node sends its first request.
+	With rack/rank hints the node is placed on a golden ratio sequence,
+	which keeps neighbouring nodes far apart whatever the cluster size.
+	Without hints, place it at random """
+	if window <= 0:
+		return 0
+	if rack is None and rank is None:
+		return random.uniform(0, window)
+	position = (rack or 0) * 1000 + (rank or 0)
+	return ((position * GOLDENRATIO) % 1.0) * window
+
+def blkidDevices():
+	""" { device: { tag: value } } for every filesystem blkid finds. The
+	cache file is bypassed so we see what is on the disks now """
+	devices = {}
+	device = None
+	for line in os.popen("blkid -c /dev/null -o export 2> /dev/null").readlines():
+		line = line.strip()
+		if "=" not in line:
+			device = None
+			continue
+		(key, value) = line.split("=", 1)
+		if key == "DEVNAME":
+			device = value
+			devices[device] = {}
+		elif device is not None:
+			devices[device][key] = value
+	return devices
+
+def mountDevice(device, options="ro"):
+	""" Mount device on a new temporary directory. Returns the
+	mountpoint, or None if it could not be mounted """
+	mountpoint = tempfile.mkdtemp()
+	if os.system("mount -o %s %s %s > /dev/null 2>&1" %
+			(options, device, mountpoint)) != 0:
+		os.rmdir(mountpoint)
+		return None
+	return mountpoint
+
+def findStatePartition(devices):
+	""" The state partition of the previous rocks install: a filesystem
+	listed in the fstab of the root partition that has /.rocks-release,
+	other than /, /var and swap. These are the partitions the
+	installer reconnects with --noformat (see addPartitions() in
+	rocks_partition.py). Only blkid and mount are needed, so this works
+	in the initramfs """
+	for device in sorted(devices.keys()):
+		if devices[device].get("TYPE") not in CACHEFSTYPES:
+			continue
+		mountpoint = mountDevice(device)
+		if mountpoint is None:
+			continue
+		fstab = []
+		try:
+			if os.path.exists(os.path.join(mountpoint, ".rocks-release")):
+				f = open(os.path.join(mountpoint, "etc", "fstab"))
+				fstab = f.readlines()
+				f.close()
+		except:
+			pass
+		closeCache(mountpoint)
+
+		for line in fstab:
+			fields = line.split()
+			if len(fields) < 3 or fields[0][0] == "#":
+				continue
+			(spec, mnt, fstype) = fields[:3]
+			if mnt in [ "/", "/var" ] or mnt[0:1] != "/" or \
+					fstype not in CACHEFSTYPES:
+				continue
+			for (candidate, tags) in devices.items():
+				if spec in [ candidate,
+						"UUID=%s" % tags.get("UUID"),
+						"LABEL=%s" % tags.get("LABEL") ] or \
+						os.path.realpath(spec) == candidate:
+					return candidate
+	return None
+
+def openCache():
+	""" Mount the state partition left by a previous install of this
+	node, read-only. Returns the mountpoint, or None if there is none """
+	try:
+		partition = findStatePartition(blkidDevices())
+	except Exception as e:
+		print "# No kickstart cache: %s" % str(e)
+		return None
+
+	if partition is None:
+		return None
+	mountpoint = mountDevice(partition)
+	if mountpoint is None:
+		return None
+	print "# Kickstart cache on %s" % partition
+	return mountpoint
+
+def closeCache(mountpoint):
+	os.system("umount %s > /dev/null 2>&1" % mountpoint)
+	try:
+		os.rmdir(mountpoint)
+	except:
+		pass
+
+def readCache(mountpoint):
+	""" Returns the cached (contents, etag), or (None, None) """
+	try:
+		f = open(os.path.join(mountpoint, CACHEDIR, "rocks.ks"))
+		contents = f.read()
+		f.close()
+		f = open(os.path.join(mountpoint, CACHEDIR, "rocks.ks.etag"))
+		etag = f.read().strip()
+		f.close()
+	except:
+		return (None, None)
+	if len(contents) == 0 or len(etag) == 0:
+		return (None, None)
+	return (contents, etag)
+
+def writeCache(mountpoint, contents, etag):
+	""" Save the kickstart file and its etag. The partition is only
+	writable while this runs, and files are renamed into place so a
+	half written cache is never used """
+	if os.system("mount -o remount,rw %s > /dev/null 2>&1" % mountpoint) != 0:
+		print "# Could not write kickstart cache: remount failed"
+		return
+	try:
+		cachedir = os.path.join(mountpoint, CACHEDIR)
+		if not os.path.isdir(cachedir):
+			os.makedirs(cachedir, 0700)
+		for (name, data) in [ ("rocks.ks", contents),
+				("rocks.ks.etag", etag) ]:
+			filename = os.path.join(cachedir, name)
+			f = open(filename + ".new", "w")
+			f.write(data)
+			f.close()
+			os.rename(filename + ".new", filename)
+	except Exception as e:
+		print "# Could not write kickstart cache: %s" % str(e)
+	os.system("mount -o remount,ro %s > /dev/null 2>&1" % mountpoint)
+
+def contentTag(contents):
+	return '"sha1-%s"' % hashlib.sha1(contents).hexdigest()
+
+def peerURL(url, host):
+	""" The same kickstart url, served by host """
+	parts = list(urlparse.urlsplit(url))
+	parts[1] = host
+	return urlparse.urlunsplit(parts)
+
 ## read /proc/cmdline and look for rocks.ks=
 try:
 	f = open("/proc/cmdline")
 	lines = f.readlines()
 	f.close()
-	arg = filter(lambda x: x[0]=="rocks.ks",map(lambda y: y.split('=')," ".join(lines).split()))
-	ksTimeout = filter(lambda x: x[0]=="rocks.ks.timeout",map(lambda y: y.split('=')," ".join(lines).split()))
+	cmdline = map(lambda y: y.split('=')," ".join(lines).split())
 except Exception as e:
 	print "# had exception %s" % e.__str__()
 
-## Set the url, if misformatted use the default 
-url = DEFAULTURL
+## Set the urls, if misformatted use the default 
+urls = []
 try:
-	if len(arg) > 0:
-		url = arg[0][1]
+	arg = cmdlineArg(cmdline, "rocks.ks")
+	if arg is not None:
+		urls = filter(lambda x: len(x) > 0, arg.split(','))
 except:
 	pass	
+if len(urls) == 0:
+	urls = [DEFAULTURL]
+url = urls[0]
+
+## Peers that already hold a cached kickstart 
+try:
+	if cmdlineArg(cmdline, "rocks.ks.peers") in ("1", "yes", "true"):
+		trackers = cmdlineArg(cmdline, "tracker.trackers")
+		for host in filter(lambda x: len(x) > 0, trackers.split(',')):
+			peer = peerURL(url, host)
+			if peer not in urls:
+				urls.append(peer)
+except:
+	pass
 
 # Set the maximum timeout, override if rocks.ks.timeout specified 
 maxTimeout = MAXTIMEOUT
 try:
-	if len(ksTimeout) > 0:
-		maxTimeout = int(ksTimeout[0][1])
+	maxTimeout = int(cmdlineArg(cmdline, "rocks.ks.timeout"))
 except:
 	pass
 
+hedgeDelay = HEDGEDELAY
+try:
+	hedgeDelay = float(cmdlineArg(cmdline, "rocks.ks.hedge"))
+except:
+	pass
+
+deadline = DEADLINE
+try:
+	deadline = int(cmdlineArg(cmdline, "rocks.ks.deadline"))
+except:
+	pass
+
+window = 0
+try:
+	window = int(cmdlineArg(cmdline, "rocks.ks.window"))
+except:
+	pass
+
+rack = None
+rank = None
+try:
+	rack = int(cmdlineArg(cmdline, "rocks.ks.rack"))
+except:
+	pass
+try:
+	rank = int(cmdlineArg(cmdline, "rocks.ks.rank"))
+except:
+	pass
+
+## Frontends (build) have no previous install to revalidate against
+useCache = "build" not in map(lambda x: x[0], cmdline) and \
+	cmdlineArg(cmdline, "rocks.ks.cache") not in ("0", "no", "false")
+
 lines = sys.stdin.readlines()
 query=""
 macargs=""
+headers = []
 sslContext = ssl._create_unverified_context()
 
 try:
-	request = urllib2.Request(url,query)
-
 	print "# Looking for provisioning mac"
 
 	for key in os.environ.keys():
@@ -90,7 +352,7 @@ try:
 
 			iface = int(key.split("_")[-1])
 			macHeader = "X-RHN-Provisioning-MAC-%d" % iface
-			request.add_header(macHeader,os.environ[key])
+			headers.append((macHeader,os.environ[key]))
 			pstr = "%s: %s\r\n"%(macHeader,os.environ[key])
 			macargs += pstr
 	cpus = open("/proc/cpuinfo")
@@ -98,54 +360,177 @@ try:
 	cpus.close()
 	np=filter(lambda x: x.startswith('processor'),lines)	
 	if len(np) > 0:
-		request.add_header('np',len(np))
+		headers.append(('np',len(np)))
 	# print "XXX" + str(np) + str(len(np))
 
 except Exception as e:
 	print "# urllib2 call had exception %s" % str(e) 
 
-retries = RETRIES
+cacheMount = None
+cachedKS = None
+cachedTag = None
+if useCache:
+	cacheMount = openCache()
+	if cacheMount is not None:
+		(cachedKS, cachedTag) = readCache(cacheMount)
+	if cachedTag is not None:
+		headers.append(("If-None-Match", cachedTag))
+
+def fetch(url, results, done):
+	""" Thread body. Fetch one kickstart file and put
+	(url, contents, etag, exception) on the results queue. A 304 from
+	the server answers with the cached kickstart """
+	response = None
+	try:
+		request = urllib2.Request(url,query)
+		for header in headers:
+			request.add_header(*header)
+		response = urllib2.urlopen(request,macargs,maxTimeout,context=sslContext)
+		# Someone else already won, don't bother reading
+		if done.isSet():
+			results.put((url, None, None, None))
+			return
+		contents = response.read()
+		etag = response.info().getheader("ETag")
+		if etag is None:
+			etag = contentTag(contents)
+		results.put((url, contents, etag, None))
+	except urllib2.HTTPError as e:
+		if e.code == 304 and cachedKS is not None:
+			results.put((url, cachedKS, cachedTag, None))
+		else:
+			results.put((url, None, None, e))
+	except Exception as e:
+		results.put((url, None, None, e))
+	finally:
+		if response is not None:
+			try:
+				response.close()
+			except:
+				pass
+
+def hedgedFetch(urls):
+	""" Ask the servers in urls for the kickstart file, starting a new
+	request every hedgeDelay seconds (or as soon as one fails) until
+	one of them answers. Returns (url, contents, etag, errors).
+	contents is None if nobody answered, errors is the list of
+	exceptions seen """
+	results = Queue.Queue()
+	done = threading.Event()
+	errors = []
+	launched = 0
+	answered = 0
+	deadline = time.time()
+	while answered < len(urls):
+		# Either the hedge delay expired or a request failed,
+		# start the next one
+		if launched < len(urls):
+			t = threading.Thread(target=fetch,
+				args=(urls[launched], results, done))
+			t.setDaemon(True)
+			t.start()
+			launched += 1
+			# each request gets its own full timeout
+			deadline = time.time() + maxTimeout + 1
+		if launched < len(urls):
+			wait = hedgeDelay
+		else:
+			wait = deadline - time.time()
+		if wait <= 0:
+			break
+		try:
+			(u, contents, etag, e) = results.get(True, wait)
+		except Queue.Empty:
+			continue
+		answered += 1
+		if e is None and contents is not None and len(contents) > 0:
+			# Abandon everyone else
+			done.set()
+			return (u, contents, etag, errors)
+		print "# %s failed: %s" % (u, str(e))
+		errors.append(e)
+	done.set()
+	return (None, None, None, errors)
+
 ## Print some debug statements
-print "# URL is %s" % url
+print "# URLs are %s" % " ".join(urls)
 print "# Query is %s" % query
 print "# Environment is %s" % str(os.environ)
 print "# Macargs is %s" % macargs.replace("\r","").replace("\n"," ")
 print "# Timeout is %d" % maxTimeout 
+print "# Hedge delay is %.1f" % hedgeDelay
+print "# Deadline is %d" % deadline
+
+startTime = time.time()
+giveUp = startTime + deadline
+delay = initialDelay(window, rack, rank)
+if delay > 0:
+	print "# Waiting %.1f secs of the %d sec window" % (delay, window)
+	time.sleep(delay)
 
 goodResponse = False
-while retries > 0:
-	try:
-		retries = retries - 1
-		response = urllib2.urlopen(request,macargs,maxTimeout,context=sslContext)
-		goodResponse=True
+ksContents = ""
+sleeptime = BACKOFFBASE
+while time.time() < giveUp:
+	(ksURL, contents, etag, errors) = hedgedFetch(urls)
+	if contents is not None:
+		if contents is cachedKS:
+			print "# Kickstart from cache, not modified on %s" % ksURL
+		else:
+			print "# Kickstart from %s" % ksURL
+		ksContents = contents
+		goodResponse = True
 		break
 
-	except urllib2.HTTPError as e:
-		timeout = None
-		if e.headers.has_key("Retry-After"):
-			timeout = int(e.headers["Retry-After"]) 
-		if timeout is None:
-			timeout = maxTimeout
-		sleeptime = random.randint(MINTIMEOUT,timeout)
-		# syslog.syslog(syslog.LOG_INFO,"ROCKS: Kickstart Service Busy. Retries left (%d) in %d secs" % (retries, sleeptime))
-		time.sleep(sleeptime)
-	except urllib2.URLError as e:
-		# This is a generic error (bad url, ...)
-		# retry until we can't anylonger
-		pass
-	except socket.timeout as e:
-		# Timed out waiting
-		pass
-	except Exception as e:
+	retryAfter = 0
+	slot = None
+	unknown = 0
+	for e in errors:
+		if isinstance(e, urllib2.HTTPError):
+			try:
+				if e.headers.has_key("X-Rocks-Slot"):
+					slot = float(e.headers["X-Rocks-Slot"])
+				if e.headers.has_key("X-Rocks-Token"):
+					headers = filter(lambda x: x[0] != "X-Rocks-Token", headers)
+					headers.append(("X-Rocks-Token", e.headers["X-Rocks-Token"]))
+				if e.headers.has_key("Retry-After"):
+					retryAfter = max(retryAfter, int(e.headers["Retry-After"]))
+			except (ValueError, TypeError):
+				pass
+		elif isinstance(e, urllib2.URLError):
+			# This is a generic error (bad url, ...)
+			# retry until we can't anylonger
+			pass
+		elif isinstance(e, socket.timeout):
+			# Timed out waiting
+			pass
+		else:
+			unknown += 1
+
+	if len(errors) > 0 and unknown == len(errors):
 		# Unknown exception, bad stuff, so just print the rescue
 		# kickstart file
-		break	
+		break
 
-## Read the response
-try:
-	ksContents = response.read()
-except:
-	ksContents = ""
+	if slot is not None:
+		# The frontend told us when to come back, don't grow the backoff.
+		# A slot of 0 (or less) means ask again right away
+		wait = max(slot, SLOTFLOOR)
+	else:
+		sleeptime = backoff(sleeptime, retryAfter)
+		wait = sleeptime
+	remaining = giveUp - time.time()
+	if remaining <= 0:
+		break
+	wait = min(wait, remaining)
+	# syslog.syslog(syslog.LOG_INFO,"ROCKS: Kickstart Service Busy. Retry in %d secs" % wait)
+	print "# Kickstart service busy, retry in %.1f secs" % wait
+	time.sleep(wait)
+
+if cacheMount is not None:
+	if goodResponse and etag != cachedTag:
+		writeCache(cacheMount, ksContents, etag)
+	closeCache(cacheMount)
 
 if goodResponse and len(ksContents) > 0:
 	print ksContents 
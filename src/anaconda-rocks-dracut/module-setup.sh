@@ -26,8 +26,10 @@ install() {
     for i in $(find /lighttpd -type f); do 
     	inst_binary $i 
     done
-    # get the fetchRocksKS.py script
+    # get the fetchRocksKS.py script, and what it needs to find the
+    # kickstart cache on the state partition
     inst_binary /fetchRocksKS.py
+    inst_multiple blkid mount umount
 
     # bring up lighttpd in initrd. Can get and cache installer,
     # xml files, pkgs. 
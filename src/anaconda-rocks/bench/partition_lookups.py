@@ -0,0 +1,289 @@
+#! /opt/rocks/bin/python
+#
+# 
+# @Copyright@
+# 
+# 				Rocks(r)
+# 		         www.rocksclusters.org
+# 		         version 6.2 (SideWinder)
+# 		         version 7.0 (Manzanita)
+# 
+# Copyright (c) 2000 - 2017 The Regents of the University of California.
+# All rights reserved.	
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement: 
+# 
+# 	"This product includes software developed by the Rocks(r)
+# 	Cluster Group at the San Diego Supercomputer Center at the
+# 	University of California, San Diego and its contributors."
+# 
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of 
+# the associated name, interested parties should contact Technology 
+# Transfer & Intellectual Property Services, University of California, 
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910, 
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+# 
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# @Copyright@
+#
+# Benchmark of the RocksPartition fstab, software raid and disk layout
+# lookups on a synthetic node with many disks, against the linear scans
+# they replaced. The results of both must be identical.
+#
+#	/opt/rocks/bin/python bench/partition_lookups.py [disks [partitions]]
+#
+
+import os
+import sys
+import string
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+	'..', 'product', 'run', 'install', 'product', 'pyanaconda'))
+
+import rocks_partition
+
+DISKS = 100
+PARTITIONS = 8
+REPEAT = 3
+
+
+#
+# the lookups as they were before they were indexed
+#
+def oldGetRaidName(raidinfo, partition_device):
+	raidname = ''
+
+	for info in raidinfo:
+		if len(info) > 3:
+			(device, partitions, raidlevel,
+				num_partitions) = info
+
+			if partition_device in partitions:
+				raidname = 'raid.%s' % partition_device
+				break
+
+	return raidname
+
+
+def oldFindMntInFstab(saved_fstab, identifier):
+	for line in saved_fstab:
+		l = string.split(line)
+		if len(l) > 0:
+			if l[0] == identifier:
+				return l[1]
+
+	return ''
+
+
+def oldFindFsTypeInFstab(saved_fstab, mntpoint):
+	for line in saved_fstab:
+		l = string.split(line)
+		if len(l) > 2:
+			if l[1] == mntpoint:
+				return l[2]
+
+	return ''
+
+
+def oldCompareDiskInfo(dbpartinfo, nodepartinfo):
+	if len(dbpartinfo) != len(nodepartinfo):
+		return 0
+
+	for db in dbpartinfo:
+		if len(db) == 1:
+			continue
+
+		found = 0
+		for node in nodepartinfo:
+			if len(node) == 1:
+				continue
+
+			if db[1:] == node[1:]:
+				found = 1
+				break
+
+		if not found:
+			return 0
+
+	return 1
+
+
+def diskName(i):
+	#
+	# sda .. sdz, sdaa .. sdaz, ...
+	#
+	letters = string.ascii_lowercase
+	name = ''
+	i += 1
+	while i > 0:
+		(i, r) = divmod(i - 1, 26)
+		name = letters[r] + name
+	return 'sd' + name
+
+
+def layout(disks, partitions):
+	#
+	# returns (fstab lines, raidinfo, { disk : partinfo }) of a node.
+	# the first two partitions of every disk pair are software raid
+	# members, in both the list and the getRaidParts() string forms
+	#
+	fstab = [ '# synthetic fstab\n' ]
+	raidinfo = []
+	partinfo = {}
+
+	for d in range(0, disks):
+		disk = diskName(d)
+		parts = []
+		for p in range(1, partitions + 1):
+			dev = '%s%d' % (disk, p)
+			uuid = '%08x-%04x' % (d, p)
+			mnt = '/state/partition%d' % (d * partitions + p)
+			if p == 1:
+				fstab.append('/dev/%s %s ext4 defaults 1 2\n'
+					% (dev, mnt))
+			elif p == partitions:
+				mnt = 'swap'
+				fstab.append('UUID=%s swap swap defaults 0 0\n'
+					% uuid)
+			else:
+				fstab.append('UUID=%s %s xfs defaults 1 2\n'
+					% (uuid, mnt))
+			parts.append([ dev, str(2048 * p), str(1024 * p), '83',
+				'ext4', '', '', mnt ])
+		partinfo[disk] = parts
+
+		if d % 2 == 1:
+			prev = diskName(d - 1)
+			md = 'md%d' % (d / 2)
+			if d % 4 == 1:
+				members = [ '%s1' % prev, '%s1' % disk ]
+			else:
+				members = 'raid.%s2 raid.%s2' % (prev, disk)
+			raidinfo.append((md, members, '1', '2'))
+
+	return (fstab, raidinfo, partinfo)
+
+
+def queries(fstab, partinfo):
+	identifiers = []
+	mntpoints = []
+	for line in fstab:
+		l = string.split(line)
+		if len(l) > 2 and l[0][0] != '#':
+			identifiers.append(l[0])
+			mntpoints.append(l[1])
+	identifiers.append('UUID=missing')
+	mntpoints.append('/missing')
+
+	devices = []
+	for parts in partinfo.values():
+		for part in parts:
+			devices.append(part[0])
+
+	return (identifiers, mntpoints, devices)
+
+
+def shuffled(partinfo):
+	#
+	# the same layout as the database would have it: same partitions,
+	# different order
+	#
+	db = {}
+	for (disk, parts) in partinfo.items():
+		copy = map(list, parts)
+		random.shuffle(copy)
+		db[disk] = copy
+	return db
+
+
+def runOld(fstab, raidinfo, partinfo, db, q):
+	(identifiers, mntpoints, devices) = q
+	return ([ oldFindMntInFstab(fstab, x) for x in identifiers ],
+		[ oldFindFsTypeInFstab(fstab, x) for x in mntpoints ],
+		[ oldGetRaidName(raidinfo, x) for x in devices ],
+		[ oldCompareDiskInfo(db[x], partinfo[x])
+			for x in sorted(partinfo.keys()) ])
+
+
+def runNew(fstab, raidinfo, partinfo, db, q):
+	(identifiers, mntpoints, devices) = q
+	p = rocks_partition.RocksPartition()
+	p.saved_fstab = list(fstab)
+	p.raidinfo = list(raidinfo)
+	return ([ p.findMntInFstab(x) for x in identifiers ],
+		[ p.findFsTypeInFstab(x) for x in mntpoints ],
+		[ p.getRaidName(x) for x in devices ],
+		[ p.compareDiskInfo(db[x], partinfo[x])
+			for x in sorted(partinfo.keys()) ])
+
+
+def best(func, *args):
+	times = []
+	for i in range(0, REPEAT):
+		start = time.time()
+		result = func(*args)
+		times.append(time.time() - start)
+	return (min(times), result)
+
+
+if __name__ == '__main__':
+	disks = DISKS
+	partitions = PARTITIONS
+	if len(sys.argv) > 1:
+		disks = int(sys.argv[1])
+	if len(sys.argv) > 2:
+		partitions = int(sys.argv[2])
+
+	random.seed(0)
+	(fstab, raidinfo, partinfo) = layout(disks, partitions)
+	db = shuffled(partinfo)
+	#
+	# one disk whose layout differs, so compareDiskInfo sees a miss
+	#
+	db[diskName(0)][0][2] = '1'
+	q = queries(fstab, partinfo)
+
+	(oldtime, old) = best(runOld, fstab, raidinfo, partinfo, db, q)
+	(newtime, new) = best(runNew, fstab, raidinfo, partinfo, db, q)
+
+	for (name, o, n) in zip([ 'findMntInFstab', 'findFsTypeInFstab',
+			'getRaidName', 'compareDiskInfo' ], old, new):
+		assert o == n, '%s results differ' % name
+
+	print '%d disks, %d partitions: %d fstab, %d raid and %d layout ' \
+		'lookups' % (disks, disks * partitions, len(q[0]) + len(q[1]),
+		len(q[2]), len(partinfo))
+	print 'linear scans  %.4fs' % oldtime
+	print 'indexed       %.4fs' % newtime
+	print 'results identical'
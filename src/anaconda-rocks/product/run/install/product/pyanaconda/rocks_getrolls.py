@@ -134,6 +134,7 @@ import rocks.media
 import rocks.roll
 import rocks.installcgi
 import rocks.file
+import rocks.download
 
 
 def RocksGetRolls(anaconda):
@@ -198,10 +199,8 @@ def RocksGetRolls(anaconda):
 		#
 		# then, for each selected roll on this disk, copy it
 		#
-		for roll in generator.rolls:
-			(name, version, arch, url, diskid) = roll
-			if diskid == d:
-				downloadRoll(anaconda, roll)
+		downloadRolls(anaconda,
+			filter(lambda x: x[4] == d, generator.rolls))
 
 	if media.mounted():
 		media.ejectCD()
@@ -209,13 +208,8 @@ def RocksGetRolls(anaconda):
 	#
 	# now get all the network rolls
 	#
-	for roll in generator.rolls:
-		(rollname, rollversion, rollarch, rollurl, diskid) = roll
-
-		if diskid != '':
-			continue
-
-		downloadRoll(anaconda, roll)
+	downloadRolls(anaconda,
+		filter(lambda x: x[4] == '', generator.rolls))
 
 	os.chdir(cwd)
 
@@ -286,12 +280,40 @@ def checkCD(anaconda, media, diskname):
 	return
 
 
-def downloadRoll(anaconda, roll):
-	(rollname, rollversion, rollarch, rollurl, diskid) = roll
+def downloadRolls(anaconda, rolls):
+	#
+	# download all the rolls in one parallel batch
+	#
+	if len(rolls) == 0:
+		return
 
 	w = anaconda.intf.waitWindow(_("Downloading"),
-			 _("Downloading Roll") + 
-			" '%s' " % (rollname))
+			 _("Downloading Rolls") + 
+			" '%s' " % ' '.join(map(lambda x: x[0], rolls)))
+
+	cmd = '/opt/rocks/bin/rocks report distro'
+	for line in os.popen(cmd).readlines():
+		distrodir = line[:-1]
+
+	downloader = rocks.download.Downloader(progress=downloadProgress)
+	for roll in rolls:
+		queueRoll(downloader, roll, distrodir)
+
+	for (url, error) in downloader.run():
+		log.error("ROCKS: could not download %s: %s" % (url, error))
+
+	w.pop()
+	return
+
+
+def downloadProgress(filesDone, files, bytes, totalBytes):
+	log.info("ROCKS: downloading rolls %d/%d files, %d MB" %
+		(filesDone, files, bytes / (1024 * 1024)))
+	return
+
+
+def queueRoll(downloader, roll, distrodir):
+	(rollname, rollversion, rollarch, rollurl, diskid) = roll
 
 	#
 	# test if this roll is in rocks format
@@ -312,10 +334,6 @@ def downloadRoll(anaconda, roll):
 
 	path = os.path.join(rollname, rollversion, rollarch)
 
-	cmd = '/opt/rocks/bin/rocks report distro'
-	for line in os.popen(cmd).readlines():
-		distrodir = line[:-1]
-
 	localpath = '/mnt/sysimage/%s/rolls/%s' % (distrodir, path)
 
 	if isrocksroll:
@@ -341,36 +359,9 @@ def downloadRoll(anaconda, roll):
 		
 		url = os.path.join('http://127.0.0.1/mnt/cdrom', dirpath)
 
-	cutdirs = len(string.split(url[7:], '/'))
-	if isrocksroll:
-		#
-		# for rolls in rocks format, make sure we copy all the
-		# files from the roll (e.g., 'RedHat' and 'base' directories)
-		# this is useful for the kernel roll.
-		#
-		cutdirs -= 1
+	if not os.path.exists(localpath):
+		os.makedirs(localpath)
 
-	subprocess.call('mkdir -p %s' % localpath, shell=True)
-	os.chdir(localpath)
+	downloader.mirror(url, localpath)
 
-	if os.path.exists('/tmp/updates/rocks/bin/wget'):
-		wget = '/tmp/updates/rocks/bin/wget'
-	else:
-		wget = '/usr/bin/wget'
-
-	#
-	# add resiliency flags to wget
-	#
-	flags = '--dns-timeout=3 --connect-timeout=3 --read-timeout=10 '
-	flags += '--tries=3'
-
-	cmd = '%s -m -nv -np -nH %s --cut-dirs=%d %s' \
-		% (wget, flags, cutdirs, url)
-	cmd += ' >> /tmp/wget.debug'
-	subprocess.call(cmd, shell=True)
-
-	subprocess.call('echo "%s" >> /tmp/wget.debug' % (cmd), shell=True)
-
-	w.pop()
 	return
-
@@ -6,6 +6,9 @@ import os
 import re
 import tempfile
 import sys
+import threading
+import Queue
+import json
 sys.path.append('/usr/lib/anaconda')
 
 # sys.path.append('/usr/lib64/python2.6/site-packages')
@@ -18,10 +21,18 @@ sys.path.append('/usr/lib/anaconda')
 
 import time
 
+#
+# how many disks to probe at the same time
+#
+PROBETHREADS = 16
+
+#
+# what discoverPartitions() found on each partition. it outlives the
+# process so do_partition.py and record_partitions.py share one pass
+#
+DISCOVERED = '/tmp/rocks-partitions.json'
+
 class RocksPartition:
-	saved_fstab = []
-	raidinfo = ''
-	mountpoints = []
 
 	def getDisks(self):
 		disks = []
@@ -70,17 +81,106 @@ class RocksPartition:
 
 		return raids
 
+	def probeDisks(self, disks):
+		#
+		# collect the facts about all the disks in one sweep: 'parted'
+		# for every disk and 'mdadm --detail' for every md device run
+		# in parallel, while a single 'blkid' call covers all the
+		# partitions. everything is kept for the rest of the run, so
+		# the helpers below never fork the same command twice
+		#
+		todo = Queue.Queue()
+		for disk in disks:
+			if not self.diskinfo.has_key(disk):
+				todo.put(disk)
+
+		workers = []
+		for i in range(0, min(PROBETHREADS, todo.qsize())):
+			t = threading.Thread(target=self.probeWorker,
+				args=(todo,))
+			t.start()
+			workers.append(t)
+
+		self.probeBlkid()
+
+		for t in workers:
+			t.join()
+
+		return
+
+
+	def probeWorker(self, todo):
+		while 1:
+			try:
+				disk = todo.get_nowait()
+			except Queue.Empty:
+				break
+
+			self.getDiskInfo(disk)
+			if disk[0:2] == 'md':
+				self.getRaidDetail(disk)
+
+		return
+
+
+	def probeBlkid(self):
+		#
+		# 'blkid -o export' for every block device at once. the
+		# cache file is bypassed so we see what is on the disks now
+		#
+		cmd = 'blkid -c /dev/null -o export 2> /dev/null'
+
+		blkid = {}
+		device = None
+		for line in os.popen(cmd).readlines():
+			if line.strip() == '':
+				device = None
+				continue
+
+			if line[0:8] == 'DEVNAME=':
+				device = self.getDevice(line[8:])
+				blkid[device] = []
+
+			if device:
+				blkid[device].append(line)
+
+		if len(blkid) > 0:
+			self.blkid = blkid
+
+		return
+
+
+	def getBlkid(self, devicename):
+		#
+		# the 'blkid -o export' lines for one device
+		#
+		if self.blkid is not None:
+			return self.blkid.get(devicename, [])
+
+		cmd = 'blkid -o export /dev/%s 2> /dev/null' % devicename
+		return os.popen(cmd).readlines()
+
+
+	def getLabel(self, devicename):
+		if self.blkid is not None:
+			for line in self.getBlkid(devicename):
+				if line[0:6] == 'LABEL=':
+					return line[6:-1]
+			return ''
+
+		cmd = '%s /dev/%s 2> /dev/null' % (self.e2label, devicename)
+		label = string.join(os.popen(cmd).readlines())
+		return label[:-1]
+
+
 	def gptDrive(self, devname):
 		#
 		# if this is a drive with a GPT format, then return '1'
 		#
 		retval = 0
 
-		cmd = '%s /dev/%s print -s 2> /dev/null' % \
-			(self.parted, devname)
-
 		label = 'Partition Table:'
-		for line in os.popen(cmd).readlines():
+		for line in self.getDiskInfo(devname):
 			if len(line) > len(label) and \
 				line[0:len(label)] == label:
 
@@ -149,9 +249,8 @@ class RocksPartition:
 	def getMountPoint(self, devicename):
 		mntpoint = ''
 
-		cmd = 'blkid -o export /dev/%s | grep UUID ' % devicename
-		cmd += ' 2> /dev/null'
-		uuid = os.popen(cmd).readlines()
+		uuid = filter(lambda x: 'UUID' in x,
+			self.getBlkid(devicename))
 		if len(uuid) > 0:
 			mntpoint = self.findMntInFstab(uuid[0][:-1])
 		
@@ -165,51 +264,83 @@ class RocksPartition:
 			mntpoint = self.getRaidName(devicename)
 
 		if mntpoint == '':
-			cmd = '%s /dev/%s 2> /dev/null' % \
-				(self.e2label, devicename)
-			label = os.popen(cmd).readlines()
-
-			label = string.join(label)
-			id = 'LABEL=%s' % (label[:-1])
+			id = 'LABEL=%s' % (self.getLabel(devicename))
 
 			mntpoint = self.findMntInFstab(id)
 
 		return mntpoint
 
 
-	def getRaidName(self, partition_device):
-		raidname = ''
+	def indexFstab(self):
+		#
+		# device/UUID/LABEL -> mount point and mount point -> fstype.
+		# the first matching fstab line wins
+		#
+		self.fstabmnt = {}
+		self.fstabtype = {}
+
+		for line in self.saved_fstab:
+			l = string.split(line)
+			if len(l) > 1 and not self.fstabmnt.has_key(l[0]):
+				self.fstabmnt[l[0]] = l[1]
+			if len(l) > 2 and not self.fstabtype.has_key(l[1]):
+				self.fstabtype[l[1]] = l[2]
+
+		return
+
+
+	def indexRaids(self):
+		#
+		# partition -> software raid it belongs to
+		#
+		self.raidindex = {}
 
 		for info in self.raidinfo:
 			if len(info) > 3:
 				(device, partitions, raidlevel,
 					num_partitions) = info
 
-				if partition_device in partitions:
-					raidname = 'raid.%s' % partition_device
-					break
+				if type(partitions) == type(''):
+					partitions = string.split(partitions)
 
-		return raidname
+				#
+				# members may be named raid.<partition>, see
+				# getRaidParts(); look them up either way
+				#
+				for partition in partitions:
+					names = [ partition ]
+					if partition[0:5] == 'raid.':
+						names.append(partition[5:])
 
+					for name in names:
+						if not self.raidindex.has_key(name):
+							self.raidindex[name] = device
 
-	def findMntInFstab(self, identifier):
-		for line in self.saved_fstab:
-			l = string.split(line)
-			if len(l) > 0:
-				if l[0] == identifier:
-					return l[1]
+		return
+
+
+	def getRaidName(self, partition_device):
+		if self.raidindex is None:
+			self.indexRaids()
+
+		if self.raidindex.has_key(partition_device):
+			return 'raid.%s' % partition_device
 
 		return ''
 
 
+	def findMntInFstab(self, identifier):
+		if self.fstabmnt is None:
+			self.indexFstab()
+
+		return self.fstabmnt.get(identifier, '')
+
+
 	def findFsTypeInFstab(self, mntpoint):
-		for line in self.saved_fstab:
-			l = string.split(line)
-			if len(l) > 2:
-				if l[1] == mntpoint:
-					return l[2]
+		if self.fstabtype is None:
+			self.indexFstab()
 
-		return ''
+		return self.fstabtype.get(mntpoint, '')
 
 
 	def formatPartedNodePartInfo(self, devname, info):
@@ -335,6 +466,9 @@ class RocksPartition:
 
 
 	def getDiskInfo(self, disk):
+		if self.diskinfo.has_key(disk):
+			return self.diskinfo[disk]
+
 		syslog.syslog('getDiskInfo: disk:%s' % (disk))
 
 		cmd = '%s /dev/%s ' % (self.parted, disk)
@@ -343,15 +477,23 @@ class RocksPartition:
 		
 		syslog.syslog('getNodePartInfo: diskinfo:%s' % (diskinfo))
 
+		self.diskinfo[disk] = diskinfo
 		return diskinfo
 
 
+	def getRaidDetail(self, device):
+		if not self.raiddetail.has_key(device):
+			cmd = '%s --query --detail ' % (self.mdadm)
+			cmd += '/dev/%s' % (device)
+			self.raiddetail[device] = os.popen(cmd).readlines()
+
+		return self.raiddetail[device]
+
+
 	def getRaidLevel(self, device):
 		level = None
 
-		cmd = '%s --query --detail ' % (self.mdadm)
-		cmd += '/dev/%s' % (device)
-		for line in os.popen(cmd).readlines():
+		for line in self.getRaidDetail(device):
 			l = line.split()
 			if len(l) > 3 and l[0] == 'Raid' and l[1] == 'Level':
 				if l[3][0:4] == 'raid':
@@ -365,9 +507,7 @@ class RocksPartition:
 		parts = []
 
 		foundparts = 0
-		cmd = '%s --query --detail ' % (self.mdadm)
-		cmd += '/dev/%s' % (device)
-		for line in os.popen(cmd).readlines():
+		for line in self.getRaidDetail(device):
 			l = line.split()
 			if len(l) > 4 and l[3] == 'RaidDevice':
 				foundparts = 1
@@ -395,8 +535,11 @@ class RocksPartition:
 		#
 		# try to get the 
 		#
+		self.probeDisks(disks)
+
 		for line in self.getFstab(disks):
 			self.saved_fstab.append(line)
+		self.indexFstab()
 
 		for devname in disks:
 			diskinfo = self.getDiskInfo(devname)
@@ -572,6 +715,132 @@ class RocksPartition:
 		return parts
 
 
+	def getUUID(self, devicename):
+		for line in self.getBlkid(devicename):
+			if line[0:5] == 'UUID=':
+				return line[5:-1]
+
+		return ''
+
+
+	def loadDiscovered(self):
+		#
+		# an entry from an earlier run is only good if the
+		# filesystem is still the same one (e.g., it wasn't
+		# reformatted by the install in between)
+		#
+		try:
+			file = open(DISCOVERED, 'r')
+			saved = json.load(file)
+			file.close()
+		except:
+			return
+
+		for partition in saved.keys():
+			(uuid, lines, isrocks) = saved[partition]
+			partition = str(partition)
+
+			if uuid and uuid == self.getUUID(partition):
+				self.discovered[partition] = (uuid,
+					map(str, lines), isrocks)
+
+		return
+
+
+	def saveDiscovered(self):
+		try:
+			tmpfile = DISCOVERED + '.tmp'
+			file = open(tmpfile, 'w')
+			json.dump(self.discovered, file)
+			file.close()
+			os.rename(tmpfile, DISCOVERED)
+		except:
+			pass
+
+		return
+
+
+	def discoverDisk(self, partitions):
+		#
+		# mount each partition read-only, grab its /etc/fstab and
+		# check for the '.rocks-release' marker
+		#
+		for partition in partitions:
+			mountpoint = tempfile.mkdtemp()
+
+			lines = []
+			isrocks = 0
+
+			if os.system('mount -o ro /dev/%s %s' \
+					% (partition, mountpoint) + \
+					' > /dev/null 2>&1') == 0:
+
+				fstab = mountpoint + '/etc/fstab'
+				try:
+					if os.path.exists(fstab):
+						file = open(fstab)
+						lines = file.readlines()
+						file.close()
+				except:
+					pass
+
+				if os.path.exists(mountpoint + '/.rocks-release'):
+					isrocks = 1
+
+				os.system('umount %s 2> /dev/null' %
+					(mountpoint))
+
+			try:
+				os.rmdir(mountpoint)
+			except:
+				pass
+
+			self.discovered[partition] = (self.getUUID(partition),
+				lines, isrocks)
+
+		return
+
+
+	def discoverPartitions(self, partinfo):
+		#
+		# 'partinfo' is a list of (partition, fstype) lists, one list
+		# per disk. partitions we haven't seen yet are mounted exactly
+		# once, one thread per disk
+		#
+		if self.discovered is None:
+			self.discovered = {}
+			self.loadDiscovered()
+
+		todo = []
+		for parts in partinfo:
+			partitions = []
+			for (partition, fstype) in parts:
+				if not fstype or fstype == 'linux-swap':
+					continue
+				if self.discovered.has_key(partition):
+					continue
+				partitions.append(partition)
+
+			if len(partitions) > 0:
+				todo.append(partitions)
+
+		if len(todo) == 0:
+			return
+
+		workers = []
+		for partitions in todo:
+			t = threading.Thread(target=self.discoverDisk,
+				args=(partitions,))
+			t.start()
+			workers.append(t)
+
+		for t in workers:
+			t.join()
+
+		self.saveDiscovered()
+		return
+
+
 	def getFstab(self, disks):
 		if os.path.exists('/upgrade/etc/fstab'):
 			file = open('/upgrade/etc/fstab')
@@ -582,83 +851,82 @@ class RocksPartition:
 		#
 		# if we are here, let's go look at all the disks for /etc/fstab
 		#
-		mountpoint = tempfile.mktemp()
-		os.makedirs(mountpoint)
-		fstab = mountpoint + '/etc/fstab'
-
-		lines = []
+		partinfo = []
 		for disk in disks:
-			for (partition, fstype) in \
-					self.listDiskPartitions(disk):
-
-				if not fstype or fstype == 'linux-swap':
-					continue
-
-				os.system('mount /dev/%s %s' \
-					% (partition, mountpoint) + \
-					' > /dev/null 2>&1')
+			partinfo.append(self.listDiskPartitions(disk))
 
-				if os.path.exists(fstab):
-					file = open(fstab)
-					lines = file.readlines()
-					file.close()
+		self.discoverPartitions(partinfo)
 
-				os.system('umount %s 2> /dev/null' %
-					(mountpoint))
+		for parts in partinfo:
+			for (partition, fstype) in parts:
+				if not self.discovered.has_key(partition):
+					continue
 
+				(uuid, lines, isrocks) = \
+					self.discovered[partition]
 				if len(lines) > 0:
-					break
-
-			if len(lines) > 0:
-				break
-
-		try:
-			os.removedirs(mountpoint)
-		except:
-			pass
+					return lines
 
-		return lines
+		return []
 
 
 	def isRocksDisk(self, partinfo, touchit = 0):
 		retval = 0
 
-		mountpoint = tempfile.mktemp()
-		os.makedirs(mountpoint)
-
+		parts = []
 		for part in partinfo:
 			(dev,start,size,id,fstype,bootflags,partflags,mnt) = \
 				part
+			parts.append((dev, fstype))
+
+		self.discoverPartitions([ parts ])
 
-			if not fstype or fstype == 'linux-swap':
+		for (dev, fstype) in parts:
+			if not self.discovered.has_key(dev):
 				continue
 
-			devname = '/dev/%s' % (dev)
+			(uuid, lines, isrocks) = self.discovered[dev]
 
-			os.system('mount %s %s' % (devname, mountpoint))
+			if touchit == 1 and not isrocks:
+				isrocks = self.touchRocksRelease(dev)
 
-			try:
-				filename = mountpoint + '/.rocks-release'
+			if isrocks:
+				retval = 1
+				break
 
-				if touchit == 1:
-					os.system('touch %s' % filename)
+		return retval
 
-				if os.path.exists(filename):
-					retval = 1
-			except:
-				pass
+
+	def touchRocksRelease(self, dev):
+		#
+		# the one place we need a writable mount
+		#
+		retval = 0
+
+		mountpoint = tempfile.mkdtemp()
+
+		if os.system('mount /dev/%s %s' % (dev, mountpoint) +
+				' > /dev/null 2>&1') == 0:
+
+			filename = mountpoint + '/.rocks-release'
+			os.system('touch %s' % filename)
+
+			if os.path.exists(filename):
+				retval = 1
 
 			os.system('umount %s' % (mountpoint) +
 				' > /dev/null 2>&1')
 
-			if retval == 1:
-				break
-
 		try:
-			os.removedirs(mountpoint)
+			os.rmdir(mountpoint)
 		except:
 			pass
 
+		if retval:
+			(uuid, lines, isrocks) = self.discovered[dev]
+			self.discovered[dev] = (uuid, lines, 1)
+			self.saveDiscovered()
+
 		return retval
 
 
@@ -745,40 +1013,24 @@ class RocksPartition:
 		if len(dbpartinfo) != len(nodepartinfo):
 			return 0
 
+		#
+		# a partition matches if everything but the device name is
+		# the same, so compare on that key
+		#
+		nodekeys = {}
+		for node in nodepartinfo:
+			if len(node) == 1:
+				continue
+
+			nodekeys[tuple(node[1:])] = 1
+
 		for db in dbpartinfo:
 			if len(db) == 1:
 				continue
-                
-			(dbdevice, dbsectorstart, dbpartsize, dbpartid,
-				dbfstype, dbbootflags, dbpartflags,
-				dbmntpoint) = db
-                
-			found = 0
-			for node in nodepartinfo:
-				if len(node) == 1:
-					continue
-                        
-				(nodedevice, nodesectorstart, nodepartsize,
-					nodepartid, nodefstype, nodebootflags,
-					nodepartflags, nodemntpoint) = node
-                        
-				# print 'compareDiskInfo:node: ', node
-				# print 'compareDiskInfo:db: ', db
-
-				if dbsectorstart == nodesectorstart and \
-					dbpartsize == nodepartsize and \
-					dbpartid == nodepartid and \
-					dbfstype == nodefstype and \
-					dbbootflags == nodebootflags and \
-					dbpartflags == nodepartflags and \
-					dbmntpoint == nodemntpoint:
-
-					found = 1
-					break
-                        
-			if not found:
+
+			if not nodekeys.has_key(tuple(db[1:])):
 				return 0
-                        
+
 		return 1
 
 
@@ -806,5 +1058,29 @@ class RocksPartition:
 		else:
 			self.mdadm = '/sbin/mdadm'
 
+		#
+		# probe results, see probeDisks()
+		#
+		self.diskinfo = {}
+		self.raiddetail = {}
+		self.blkid = None
+
+		#
+		# fstab and software raid lookups, see indexFstab() and
+		# indexRaids()
+		#
+		self.saved_fstab = []
+		self.fstabmnt = None
+		self.fstabtype = None
+		self.raidinfo = []
+		self.raidindex = None
+
+		self.mountpoints = []
+
+		#
+		# mount results, see discoverPartitions()
+		#
+		self.discovered = None
+
 		return
 
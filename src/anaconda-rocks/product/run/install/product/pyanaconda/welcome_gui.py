@@ -280,6 +280,7 @@ class WelcomeWindow(InstallWindow):
 	def lightsOut(self):
 		import rocks.installcgi
 		import rocks.roll
+		import rocks.download
 		
 		installcgi = rocks.installcgi.InstallCGI()
 		generator = rocks.roll.Generator()
@@ -288,8 +289,10 @@ class WelcomeWindow(InstallWindow):
 		rollList = generator.rolls
 
 		os.environ['PYTHONPATH'] = '/tmp/updates/usr/share/createrepo'
+		downloader = rocks.download.Downloader()
 		for roll in rollList:
-			installcgi.getKickstartFiles(roll)
+			installcgi.getKickstartFiles(roll, downloader)
+		downloader.run()
 
 		installcgi.rebuildDistro(rollList)
 
@@ -135,6 +135,7 @@ import rocks.media
 import rocks.roll
 import rocks.installcgi
 import rocks.file
+import rocks.download
 
 from pyanaconda.progress import progress_message
 from pyanaconda import iutil
@@ -205,10 +206,7 @@ def RocksGetRolls():
 		#
 		# then, for each selected roll on this disk, copy it
 		#
-		for roll in generator.rolls:
-			(name, version, arch, url, diskid) = roll
-			if diskid == d:
-				downloadRoll(anaconda, roll)
+		downloadRolls(filter(lambda x: x[4] == d, generator.rolls))
 
 	if media.mounted():
 		media.ejectCD()
@@ -216,13 +214,7 @@ def RocksGetRolls():
 	#
 	# now get all the network rolls
 	#
-	for roll in generator.rolls:
-		(rollname, rollversion, rollarch, rollurl, diskid) = roll
-
-		if diskid != 'None':
-			continue
-
-		downloadRoll(roll)
+	downloadRolls(filter(lambda x: x[4] == 'None', generator.rolls))
 
 	os.chdir(cwd)
 
@@ -290,11 +282,38 @@ def checkCD(media, diskname):
 	return
 
 
-def downloadRoll(roll):
-	(rollname, rollversion, rollarch, rollurl, diskid) = roll
+def downloadRolls(rolls):
+	#
+	# download all the rolls in one parallel batch
+	#
+	if len(rolls) == 0:
+		return
+
+	progress_message(_("Downloading Rolls") + " '%s' " %
+		' '.join(map(lambda x: x[0], rolls)))
+
+	cmd = '/opt/rocks/bin/rocks report distro'
+	for line in os.popen(cmd).readlines():
+		distrodir = line[:-1]
+
+	downloader = rocks.download.Downloader(progress=downloadProgress)
+	for roll in rolls:
+		queueRoll(downloader, roll, distrodir)
+
+	for (url, error) in downloader.run():
+		log.error("ROCKS: could not download %s: %s" % (url, error))
+
+	return
+
+
+def downloadProgress(filesDone, files, bytes, totalBytes):
+	progress_message(_("Downloading Rolls") + " %d/%d files, %d MB" %
+		(filesDone, files, bytes / (1024 * 1024)))
+	return
+
 
-	progress_message( _("Downloading Roll") + 
-			" '%s' " % (rollname))
+def queueRoll(downloader, roll, distrodir):
+	(rollname, rollversion, rollarch, rollurl, diskid) = roll
 
 	#
 	# test if this roll is in rocks format
@@ -315,10 +334,6 @@ def downloadRoll(roll):
 
 	path = os.path.join(rollname, rollversion, rollarch)
 
-	cmd = '/opt/rocks/bin/rocks report distro'
-	for line in os.popen(cmd).readlines():
-		distrodir = line[:-1]
-
 	localpath = '%s/%s/rolls/%s' % (iutil.getSysroot(),distrodir, path)
 
 	if isrocksroll:
@@ -344,35 +359,9 @@ def downloadRoll(roll):
 		
 		url = os.path.join('http://127.0.0.1/mnt/cdrom', dirpath)
 
-	cutdirs = len(string.split(url[7:], '/'))
-	if isrocksroll:
-		#
-		# for rolls in rocks format, make sure we copy all the
-		# files from the roll (e.g., 'RedHat' and 'base' directories)
-		# this is useful for the kernel roll.
-		#
-		cutdirs -= 1
-
-	subprocess.call('mkdir -p %s' % localpath, shell=True)
-	os.chdir(localpath)
+	if not os.path.exists(localpath):
+		os.makedirs(localpath)
 
-	if os.path.exists('/tmp/updates/rocks/bin/wget'):
-		wget = '/tmp/updates/rocks/bin/wget'
-	else:
-		wget = '/usr/bin/wget'
-
-	#
-	# add resiliency flags to wget
-	#
-	flags = '--dns-timeout=3 --connect-timeout=3 --read-timeout=10 '
-	flags += '--tries=3'
-
-	cmd = '%s -m -nv -np -nH %s --cut-dirs=%d %s' \
-		% (wget, flags, cutdirs, url)
-	cmd += ' >> /tmp/wget.debug'
-	subprocess.call(cmd, shell=True)
-
-	subprocess.call('echo "%s" >> /tmp/wget.debug' % (cmd), shell=True)
+	downloader.mirror(url, localpath)
 
 	return
-
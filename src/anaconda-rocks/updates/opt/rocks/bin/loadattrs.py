@@ -0,0 +1,39 @@
+#!/opt/rocks/bin/python
+#
+# Load a batch of global attributes into the rocks database during a
+# frontend install. 'rocks add attr' once per attribute pays for a new
+# interpreter and a new database connection every time; this runs all of
+# them in one process, over one connection, inside one transaction.
+#
+# stdin: a JSON list of [ attr, value ] pairs
+# stdout: the output of 'rocks report host attr pydict=true' after the
+#	attributes were added, so the caller does not start rocks again
+#
+import sys
+import json
+import rocks.db.database
+import rocks.commands
+
+def main():
+	attrs = json.load(sys.stdin)
+
+	database = rocks.db.database.Database()
+	database.connect()
+	command = rocks.commands.Command(database)
+
+	command.db.execute('set autocommit=0')
+	try:
+		for (attr, value) in attrs:
+			if attr is None or value is None:
+				continue
+			command.command('add.attr', [ attr, value ])
+	except:
+		command.db.execute('rollback')
+		raise
+	command.db.execute('commit')
+
+	sys.stdout.write(command.command('report.host.attr',
+		[ 'pydict=true' ]))
+
+if __name__ == '__main__':
+	main()
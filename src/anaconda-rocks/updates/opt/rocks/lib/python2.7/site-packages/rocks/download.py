@@ -0,0 +1,688 @@
+#! /opt/rocks/bin/python
+#
+# 
+# @Copyright@
+# 
+# 				Rocks(r)
+# 		         www.rocksclusters.org
+# 		         version 6.2 (SideWinder)
+# 		         version 7.0 (Manzanita)
+# 
+# Copyright (c) 2000 - 2017 The Regents of the University of California.
+# All rights reserved.	
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement: 
+# 
+# 	"This product includes software developed by the Rocks(r)
+# 	Cluster Group at the San Diego Supercomputer Center at the
+# 	University of California, San Diego and its contributors."
+# 
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of 
+# the associated name, interested parties should contact Technology 
+# Transfer & Intellectual Property Services, University of California, 
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910, 
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+# 
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# @Copyright@
+#
+# Download engine for the installer. Replaces one 'wget -m' per roll and
+# one 'wget' per roll kickstart RPM with a single batch:
+#
+#  - a bounded pool of worker threads, each keeping one persistent
+#    (keep-alive) connection per server
+#  - directory listings are crawled by the same workers that download the
+#    files, so all queued rolls and files are fetched in parallel
+#  - files are written to <file>.part and resumed with a Range request
+#    after a failure; only complete files get their final name
+#  - a roll that publishes a manifest (see rocks/rollindex.py) is queued
+#    straight from it, without crawling its directory listings. the
+#    manifest is only trusted while its repomd checksum matches the roll's
+#    repodata, and a file that is missing or fails its checksum makes
+#    the roll get crawled after all
+#  - RPMs are verified against the checksums in the manifest or in the
+#    roll's repodata
+#  - progress for the whole batch goes to a single callback, always called
+#    from the thread that called run()
+#
+
+import os
+import os.path
+import re
+import gzip
+import StringIO
+import hashlib
+import httplib
+import urllib
+import urlparse
+import socket
+import ssl
+import threading
+import Queue
+import fnmatch
+import logging
+import json
+import xml.etree.cElementTree as ElementTree
+
+WORKERS = 8
+TRIES = 3
+TIMEOUT = 10
+CHUNK = 256 * 1024
+PROGRESSINTERVAL = 1.0
+MAXREDIRECTS = 5
+
+REPO_NS = 'http://linux.duke.edu/metadata/repo'
+COMMON_NS = 'http://linux.duke.edu/metadata/common'
+MANIFEST = 'manifest.json'
+
+#
+# apache and lighttpd autoindex pages both use <a href="name">, skip the
+# sort links ('?C=N;O=D'), anchors and absolute links
+#
+HREF_RE = re.compile(r'<a\s+href="([^"?#/][^"]*)"', re.IGNORECASE)
+
+
+class DownloadError(Exception):
+	pass
+
+
+def parsePrimary(data):
+	#
+	# returns { location href : (checksum type, checksum) } for every
+	# package in a repodata primary.xml
+	#
+	checksums = {}
+	for pkg in ElementTree.fromstring(data).findall('{%s}package'
+			% COMMON_NS):
+		checksum = pkg.find('{%s}checksum' % COMMON_NS)
+		location = pkg.find('{%s}location' % COMMON_NS)
+		if checksum is None or location is None:
+			continue
+
+		checksums[location.get('href')] = (checksum.get('type'),
+			checksum.text.strip())
+
+	return checksums
+
+
+class Downloader:
+
+	def __init__(self, workers=WORKERS, progress=None, tries=TRIES,
+			timeout=TIMEOUT):
+		self.workers = workers
+		self.progress = progress
+		self.tries = tries
+		self.timeout = timeout
+		self.log = logging.getLogger('anaconda')
+
+		self.jobs = Queue.Queue()
+		self.lock = threading.Condition()
+		self.pending = 0
+
+		#
+		# url -> (checksum type, checksum) from repodata
+		#
+		self.checksums = {}
+		self.failed = []
+
+		#
+		# url of a file queued from a manifest -> the 'list' job to
+		# crawl its roll with if the manifest turns out to be wrong
+		#
+		self.manifestFiles = {}
+		self.recrawled = []
+
+		self.files = 0
+		self.filesDone = 0
+		self.bytes = 0
+		self.totalBytes = 0
+
+		if hasattr(ssl, '_create_unverified_context'):
+			self.sslContext = ssl._create_unverified_context()
+		else:
+			self.sslContext = None
+
+		return
+
+
+	def mirror(self, url, localdir, pattern=None, recursive=1,
+			manifest=None):
+		#
+		# like 'wget -m -np -nH --cut-dirs', the contents of url end up
+		# directly in localdir. pattern (a glob) restricts which files
+		# are downloaded
+		#
+		# manifest is the url of a roll manifest that covers url. it
+		# defaults to the one in url itself for recursive mirrors. the
+		# directory listings are only crawled if there is no manifest
+		#
+		if url[-1] != '/':
+			url += '/'
+		if manifest is None and recursive:
+			manifest = url + MANIFEST
+		self.queue(('list', url, localdir, pattern, recursive,
+			manifest))
+		return
+
+
+	def get(self, url, filename, checksum=None, size=None):
+		self.queue(('get', url, filename, checksum, size))
+		return
+
+
+	def queue(self, job):
+		self.lock.acquire()
+		self.pending += 1
+		if job[0] in [ 'get', 'mget' ]:
+			self.files += 1
+			if job[4] is not None:
+				self.totalBytes += job[4]
+		self.lock.release()
+
+		self.jobs.put(job)
+		return
+
+
+	def run(self):
+		#
+		# download everything queued so far (and everything found
+		# while crawling). returns a list of (url, error) that could not
+		# be fetched
+		#
+		threads = []
+		for i in range(0, self.workers):
+			t = threading.Thread(target=self.worker)
+			t.setDaemon(True)
+			t.start()
+			threads.append(t)
+
+		while 1:
+			self.lock.acquire()
+			if self.pending > 0:
+				self.lock.wait(PROGRESSINTERVAL)
+			pending = self.pending
+			status = (self.filesDone, self.files, self.bytes,
+				self.totalBytes)
+			self.lock.release()
+
+			if self.progress:
+				self.progress(*status)
+
+			if pending == 0:
+				break
+
+		for t in threads:
+			self.jobs.put(None)
+		for t in threads:
+			t.join()
+
+		return self.failed
+
+
+	def worker(self):
+		connections = {}
+
+		while 1:
+			job = self.jobs.get()
+			if job is None:
+				break
+
+			try:
+				if job[0] == 'list':
+					self.doList(connections, *job[1:])
+				else:
+					self.doGet(connections, *job[1:])
+			except Exception, e:
+				if job[0] != 'mget' or not self.recrawl(job[1], e):
+					self.log.error('ROCKS download %s failed: %s'
+						% (job[1], str(e)))
+					self.lock.acquire()
+					self.failed.append((job[1], str(e)))
+					self.lock.release()
+
+			self.lock.acquire()
+			self.pending -= 1
+			if job[0] in [ 'get', 'mget' ]:
+				self.filesDone += 1
+			self.lock.notify()
+			self.lock.release()
+
+		for conn in connections.values():
+			conn.close()
+
+		return
+
+
+	def connect(self, connections, scheme, netloc):
+		key = (scheme, netloc)
+		if not connections.has_key(key):
+			if scheme == 'https' and self.sslContext:
+				conn = httplib.HTTPSConnection(netloc,
+					timeout=self.timeout,
+					context=self.sslContext)
+			elif scheme == 'https':
+				conn = httplib.HTTPSConnection(netloc,
+					timeout=self.timeout)
+			else:
+				conn = httplib.HTTPConnection(netloc,
+					timeout=self.timeout)
+			connections[key] = conn
+
+		return connections[key]
+
+
+	def disconnect(self, connections, url):
+		(scheme, netloc) = urlparse.urlsplit(url)[0:2]
+		key = (scheme, netloc)
+		if connections.has_key(key):
+			connections[key].close()
+			del connections[key]
+		return
+
+
+	def request(self, connections, url, headers={}):
+		#
+		# GET url over this worker's connection to the server. follows
+		# redirects (e.g., a directory without its trailing '/')
+		#
+		for redirect in range(0, MAXREDIRECTS):
+			(scheme, netloc, path, query, fragment) = \
+				urlparse.urlsplit(url)
+			if query:
+				path += '?' + query
+
+			for attempt in range(0, 2):
+				conn = self.connect(connections, scheme, netloc)
+				try:
+					conn.request('GET', path, headers=headers)
+					response = conn.getresponse()
+					break
+				except (httplib.HTTPException, socket.error):
+					#
+					# the server closed a kept-alive
+					# connection, reconnect once
+					#
+					self.disconnect(connections, url)
+					if attempt == 1:
+						raise
+
+			if response.status not in [ 301, 302, 303, 307 ]:
+				return (url, response)
+
+			response.read()
+			url = urlparse.urljoin(url,
+				response.getheader('location'))
+
+		raise DownloadError('%s: too many redirects' % url)
+
+
+	def read(self, connections, url):
+		if url.startswith('file:'):
+			file = open(urllib.url2pathname(url[5:]), 'r')
+			data = file.read()
+			file.close()
+			return data
+
+		(url, response) = self.request(connections, url)
+		data = response.read()
+		if response.status != 200:
+			raise DownloadError('%s: %d %s' % (url, response.status,
+				response.reason))
+
+		return data
+
+
+	def listdir(self, connections, url):
+		#
+		# returns the (files, directories) in a directory listing.
+		# directories keep their trailing '/'
+		#
+		if url.startswith('file:'):
+			path = urllib.url2pathname(url[5:])
+			files = []
+			dirs = []
+			for name in sorted(os.listdir(path)):
+				if os.path.isdir(os.path.join(path, name)):
+					dirs.append(urllib.quote(name) + '/')
+				else:
+					files.append(urllib.quote(name))
+			return (files, dirs)
+
+		files = []
+		dirs = []
+		for href in HREF_RE.findall(self.read(connections, url)):
+			if '://' in href or href.startswith('.'):
+				continue
+			if href in files or href in dirs:
+				continue
+
+			if href[-1] == '/':
+				dirs.append(href)
+			else:
+				files.append(href)
+
+		return (files, dirs)
+
+
+	def loadRepodata(self, connections, url):
+		#
+		# remember the checksum of every package listed in the repodata
+		# of the repository at url
+		#
+		repomd = ElementTree.fromstring(self.read(connections,
+			url + 'repodata/repomd.xml'))
+
+		primary = None
+		for data in repomd.findall('{%s}data' % REPO_NS):
+			if data.get('type') == 'primary':
+				location = data.find('{%s}location' % REPO_NS)
+				primary = location.get('href')
+		if not primary:
+			return
+
+		data = self.read(connections, urlparse.urljoin(url, primary))
+		if primary.endswith('.gz'):
+			data = gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+		checksums = {}
+		for (href, checksum) in parsePrimary(data).items():
+			checksums[urlparse.urljoin(url, href)] = checksum
+
+		self.lock.acquire()
+		self.checksums.update(checksums)
+		self.lock.release()
+
+		return
+
+
+	def manifestFresh(self, connections, base, data):
+		#
+		# a manifest is stale once its roll's repodata was rebuilt.
+		# manifests without a repomd checksum predate this check
+		#
+		if not data.has_key('repomd'):
+			return 0
+		if data['repomd'] is None:
+			return 1
+
+		try:
+			repomd = self.read(connections, base + 'repodata/repomd.xml')
+		except Exception:
+			return 0
+
+		(type, value) = data['repomd']
+		return hashlib.new(type, repomd).hexdigest() == value
+
+
+	def queueManifest(self, connections, url, localdir, pattern,
+			recursive, manifest):
+		#
+		# queue the files under url from a roll manifest. returns 0 if
+		# there is no usable manifest
+		#
+		try:
+			data = json.loads(self.read(connections, manifest))
+			entries = data['files']
+		except Exception, e:
+			self.log.info('ROCKS no manifest %s: %s'
+				% (manifest, str(e)))
+			return 0
+
+		base = manifest[:manifest.rfind('/') + 1]
+		if not self.manifestFresh(connections, base, data):
+			self.log.warning('ROCKS manifest %s is out of date, '
+				'crawling %s' % (manifest, url))
+			return 0
+
+		crawl = ('list', url, localdir, pattern, recursive, None)
+		for entry in entries:
+			fileurl = base + urllib.quote(entry['path'])
+			if not fileurl.startswith(url):
+				continue
+
+			path = urllib.unquote(fileurl[len(url):])
+			if not recursive and '/' in path:
+				continue
+			if pattern and not fnmatch.fnmatch(os.path.basename(path),
+					pattern):
+				continue
+
+			checksum = entry.get('checksum')
+			if checksum:
+				checksum = tuple(checksum)
+
+			self.lock.acquire()
+			self.manifestFiles[fileurl] = crawl
+			self.lock.release()
+
+			#
+			# 'mget' is a 'get' that recrawl() can stand in for
+			#
+			self.queue(('mget', fileurl, os.path.join(localdir, path),
+				checksum, entry.get('size')))
+
+		return 1
+
+
+	def recrawl(self, url, error):
+		#
+		# a file queued from a manifest could not be fetched (gone,
+		# or a different file now). crawl its roll instead, once; the
+		# crawl fetches this file too if it still exists. returns 1 if
+		# the crawl takes care of url
+		#
+		self.lock.acquire()
+		crawl = self.manifestFiles.get(url)
+		if crawl is None:
+			self.lock.release()
+			return 0
+		if crawl in self.recrawled:
+			self.lock.release()
+			return 1
+		self.recrawled.append(crawl)
+		self.lock.release()
+
+		self.log.warning('ROCKS %s does not match its manifest (%s), '
+			'crawling %s' % (url, str(error), crawl[1]))
+		self.queue(crawl)
+		return 1
+
+
+	def doList(self, connections, url, localdir, pattern, recursive,
+			manifest):
+		if manifest and self.queueManifest(connections, url, localdir,
+				pattern, recursive, manifest):
+			return
+
+		(files, dirs) = self.listdir(connections, url)
+
+		if recursive and 'repodata/' in dirs:
+			try:
+				self.loadRepodata(connections, url)
+			except Exception, e:
+				self.log.warning('ROCKS no checksums for %s: %s'
+					% (url, str(e)))
+
+		for name in files:
+			if pattern and not fnmatch.fnmatch(urllib.unquote(name),
+					pattern):
+				continue
+
+			self.lock.acquire()
+			checksum = self.checksums.get(url + name)
+			self.lock.release()
+
+			self.get(url + name, os.path.join(localdir,
+				urllib.unquote(name)), checksum)
+
+		if recursive:
+			for name in dirs:
+				self.queue(('list', url + name,
+					os.path.join(localdir,
+						urllib.unquote(name[:-1])),
+					pattern, recursive, None))
+
+		return
+
+
+	def doGet(self, connections, url, filename, checksum, size):
+		if os.path.exists(filename):
+			#
+			# complete files only appear under their final name, so
+			# this is left over from an earlier run
+			#
+			if checksum is None or self.verify(filename, checksum):
+				return
+			os.unlink(filename)
+
+		dir = os.path.dirname(filename)
+		if dir and not os.path.exists(dir):
+			try:
+				os.makedirs(dir)
+			except OSError:
+				# another worker got there first
+				pass
+
+		partial = filename + '.part'
+		error = None
+		for attempt in range(0, self.tries):
+			try:
+				self.fetch(connections, url, partial, size is None)
+			except (DownloadError, httplib.HTTPException,
+					socket.error, IOError), e:
+				error = e
+				continue
+
+			if checksum is None or self.verify(partial, checksum):
+				os.rename(partial, filename)
+				return
+
+			error = '%s checksum mismatch' % checksum[0]
+			os.unlink(partial)
+
+		raise DownloadError(str(error))
+
+
+	def fetch(self, connections, url, partial, countsize=1):
+		#
+		# download url into partial, resuming where an earlier attempt
+		# stopped. countsize adds the content length to the total of
+		# the batch when the size was not known up front
+		#
+		offset = 0
+		if os.path.exists(partial):
+			offset = os.path.getsize(partial)
+
+		if url.startswith('file:'):
+			src = open(urllib.url2pathname(url[5:]), 'rb')
+			src.seek(offset)
+			self.copy(src, open(partial, 'ab'))
+			src.close()
+			return
+
+		headers = {}
+		if offset > 0:
+			headers['Range'] = 'bytes=%d-' % offset
+
+		try:
+			(u, response) = self.request(connections, url, headers)
+
+			if response.status == 416:
+				#
+				# the partial file is already complete
+				#
+				response.read()
+				return
+			elif response.status == 206:
+				file = open(partial, 'ab')
+			elif response.status == 200:
+				file = open(partial, 'wb')
+			else:
+				response.read()
+				raise DownloadError('%s: %d %s' % (url,
+					response.status, response.reason))
+
+			length = response.getheader('content-length')
+			if length and countsize:
+				self.lock.acquire()
+				self.totalBytes += int(length)
+				self.lock.release()
+
+			self.copy(response, file)
+		except (httplib.HTTPException, socket.error):
+			#
+			# the connection is in an unknown state
+			#
+			self.disconnect(connections, url)
+			raise
+
+		return
+
+
+	def copy(self, src, dst):
+		while 1:
+			chunk = src.read(CHUNK)
+			if not chunk:
+				break
+			dst.write(chunk)
+
+			self.lock.acquire()
+			self.bytes += len(chunk)
+			self.lock.release()
+
+		dst.close()
+		return
+
+
+	def verify(self, filename, checksum):
+		(type, value) = checksum
+		if type == 'sha':
+			type = 'sha1'
+
+		try:
+			h = hashlib.new(type)
+		except ValueError:
+			#
+			# unknown checksum type, nothing to verify against
+			#
+			return 1
+
+		file = open(filename, 'rb')
+		while 1:
+			chunk = file.read(CHUNK)
+			if not chunk:
+				break
+			h.update(chunk)
+		file.close()
+
+		return h.hexdigest() == value
+
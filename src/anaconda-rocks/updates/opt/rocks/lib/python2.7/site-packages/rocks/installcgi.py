@@ -114,6 +114,8 @@ import string
 import shutil
 import rocks.file
 import rocks.util
+import rocks.download
+import rocks.rollindex
 import logging
 
 class InstallCGI:
@@ -209,73 +211,47 @@ class InstallCGI:
 		return
 
 
-	def getKickstartFiles(self, roll):
+	def getKickstartFiles(self, roll, downloader=None):
 		#
 		# for every selected roll, find the roll-{name}-kickstart*rpm
 		# file
 		#
-		cwd = os.getcwd()
-
+		# pass a rocks.download.Downloader to queue the files of
+		# several rolls and fetch them in one parallel batch (the
+		# caller runs it), otherwise they are downloaded right away
+		#
 		self.createPopt(self.rootdir)
 
 		contribdir = os.path.join(self.rootdir, 'contrib', self.version,
 			self.arch, 'RPMS')
 
 		os.system('mkdir -p %s' % (contribdir))
-		os.chdir(contribdir)
 
 		(rollname, rollver, rollarch, rollurl, diskid) = roll
 		url = rollurl + '%s/%s/%s/' % (rollname, rollver, rollarch)
 		url += 'RedHat/RPMS/'
 
-		if os.path.exists('/tmp/updates/rocks/bin/wget'):
-			wget = '/tmp/updates/rocks/bin/wget'
+		self.log.info("ROCKS get %sroll-*-kickstart*.rpm" % url)
+
+		if downloader:
+			d = downloader
 		else:
-			wget = '/usr/bin/wget'
+			d = rocks.download.Downloader()
 
-		cmd = '%s -O - -nv %s 2> /dev/null' % (wget, url)
-		self.log.info("ROCKS %s" % cmd)
+		#
+		# the roll's manifest (if it has one) saves parsing the
+		# listing of the RPMS directory
+		#
+		manifest = rollurl + '%s/%s/%s/%s' % (rollname, rollver,
+			rollarch, rocks.download.MANIFEST)
 
-		for line in os.popen(cmd).readlines():
-			a = string.split(line, '"')
-
-			if a[0] == '<a href=':
-				#
-				# apache style listing
-				#
-				filename = a[1]
-			elif len(a) > 2 and a[2] == '><a href=':
-				#
-				# lighttpd style listing
-				#
-				filename = a[3]
-			else:
-				continue
-
-			l = filename.split('-')
-
-			if l[0] != 'roll':
-				continue
-			try:
-				k = l.index('kickstart')
-				rollname = '-'.join(l[1:k])
-			except ValueError:
-				continue
-
-			#
-			# if we're here, we know we have a
-			# roll-<rollname>-kickstart*rpm file, so download
-			# the RPM
-			#
-			roll_kickstart_rpm = url + filename
-			getcmd = '%s --quiet %s' % (wget, roll_kickstart_rpm)
-			os.system(getcmd)
-
-		cmd = '%s -nv %s' % (wget, url)
-		self.log.info("ROCKS %s" % cmd)
-		self.log.info("ROCKS cwd %s" % cwd)
-		os.system(cmd)
-		os.chdir(cwd)
+		d.mirror(url, contribdir, pattern='roll-*-kickstart*.rpm',
+			recursive=0, manifest=manifest)
+
+		if not downloader:
+			for (u, error) in d.run():
+				self.log.error("ROCKS could not get %s: %s"
+					% (u, error))
 		return
 
 
@@ -312,5 +288,17 @@ class InstallCGI:
 
 		os.chdir(cwd)
 
+		#
+		# the set of rolls may have changed, refresh the roll index and
+		# the manifests of the rolls that did, so installs that use
+		# this machine as their roll server don't have to crawl it
+		#
+		try:
+			rocks.rollindex.createIndex(os.path.join(self.rootdir,
+				'rolls'))
+		except Exception, e:
+			self.log.error("ROCKS could not index the rolls: %s"
+				% str(e))
+
 		return
 
@@ -0,0 +1,312 @@
+#! /opt/rocks/bin/python
+#
+# 
+# @Copyright@
+# 
+# 				Rocks(r)
+# 		         www.rocksclusters.org
+# 		         version 6.2 (SideWinder)
+# 		         version 7.0 (Manzanita)
+# 
+# Copyright (c) 2000 - 2017 The Regents of the University of California.
+# All rights reserved.	
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided 
+# with the distribution.
+# 
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement: 
+# 
+# 	"This product includes software developed by the Rocks(r)
+# 	Cluster Group at the San Diego Supercomputer Center at the
+# 	University of California, San Diego and its contributors."
+# 
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of 
+# the associated name, interested parties should contact Technology 
+# Transfer & Intellectual Property Services, University of California, 
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910, 
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+# 
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# @Copyright@
+#
+# Roll manifests and the roll index, so the installer does not have to
+# crawl (and parse) the web server's directory listings.
+#
+# <rolls>/rolls.json lists every roll the server carries:
+#
+#	{ "rolls": [ { "name": "base", "version": "7.0", "arch": "x86_64" } ] }
+#
+# <rolls>/<name>/<version>/<arch>/manifest.json lists every file of that
+# roll, relative to the roll directory:
+#
+#	{ "repomd": [ "sha256", "..." ],
+#	  "files": [ { "path": "RedHat/RPMS/foo-1.0-1.x86_64.rpm",
+#		"size": 1234, "mtime": 1500000000,
+#		"checksum": [ "sha256", "..." ] } ] }
+#
+# repomd is the checksum of the roll's repodata/repomd.xml (null if it has
+# none). Clients compare it with the served repomd.xml and crawl the roll
+# instead when they differ, so a rebuilt roll is never fetched from a stale
+# manifest. The roll index is checked against the listing of the rolls
+# directory the same way.
+#
+# Refresh both whenever rolls are added, removed or rebuilt with
+#
+#	/opt/rocks/bin/python -m rocks.rollindex /export/rocks/install/rolls
+#
+# Only the manifests of rolls whose files changed (by size or mtime) are
+# rewritten, so this is cheap to run after every change.
+#
+
+import os
+import os.path
+import sys
+import gzip
+import json
+import hashlib
+import ssl
+import urllib2
+import xml.etree.cElementTree as ElementTree
+import rocks.download
+
+INDEX = 'rolls.json'
+MANIFEST = rocks.download.MANIFEST
+TIMEOUT = 10
+
+
+def writeJSON(filename, data):
+	#
+	# write to a temporary file and rename it, so a web server never
+	# hands out a half written index
+	#
+	file = open(filename + '.new', 'w')
+	json.dump(data, file, indent=1, sort_keys=True)
+	file.close()
+	os.rename(filename + '.new', filename)
+	return
+
+
+def repodataChecksums(rolldir):
+	#
+	# the checksums createrepo already computed for the roll's packages
+	#
+	try:
+		repomd = ElementTree.parse(os.path.join(rolldir, 'repodata',
+			'repomd.xml'))
+	except (IOError, SyntaxError):
+		return {}
+
+	for data in repomd.findall('{%s}data' % rocks.download.REPO_NS):
+		if data.get('type') != 'primary':
+			continue
+
+		href = data.find('{%s}location'
+			% rocks.download.REPO_NS).get('href')
+		filename = os.path.join(rolldir, href)
+		if filename.endswith('.gz'):
+			file = gzip.open(filename)
+		else:
+			file = open(filename)
+		primary = file.read()
+		file.close()
+
+		return rocks.download.parsePrimary(primary)
+
+	return {}
+
+
+def fileChecksum(filename):
+	h = hashlib.sha256()
+	file = open(filename, 'rb')
+	while 1:
+		chunk = file.read(rocks.download.CHUNK)
+		if not chunk:
+			break
+		h.update(chunk)
+	file.close()
+
+	return [ 'sha256', h.hexdigest() ]
+
+
+def rollFiles(rolldir):
+	#
+	# { path : (size, mtime) } of every file in the roll
+	#
+	files = {}
+	for (dir, dirs, names) in os.walk(rolldir):
+		for name in names:
+			if name in [ MANIFEST, MANIFEST + '.new' ] or \
+					name.endswith('.part'):
+				continue
+
+			filename = os.path.join(dir, name)
+			if not os.path.isfile(filename):
+				continue
+
+			st = os.stat(filename)
+			files[os.path.relpath(filename, rolldir)] = \
+				(st.st_size, int(st.st_mtime))
+
+	return files
+
+
+def repomdChecksum(rolldir):
+	filename = os.path.join(rolldir, 'repodata', 'repomd.xml')
+	if not os.path.exists(filename):
+		return None
+	return fileChecksum(filename)
+
+
+def manifestFresh(rolldir):
+	#
+	# true if the roll's manifest still lists exactly its files, with
+	# the same sizes and mtimes
+	#
+	try:
+		file = open(os.path.join(rolldir, MANIFEST))
+		data = json.load(file)
+		file.close()
+
+		listed = {}
+		for entry in data['files']:
+			listed[entry['path']] = (entry['size'], entry['mtime'])
+		if not data.has_key('repomd'):
+			return 0
+	except (IOError, ValueError, KeyError, TypeError):
+		return 0
+
+	return listed == rollFiles(rolldir)
+
+
+def createManifest(rolldir):
+	checksums = repodataChecksums(rolldir)
+
+	files = []
+	for (path, (size, mtime)) in sorted(rollFiles(rolldir).items()):
+		if checksums.has_key(path):
+			checksum = list(checksums[path])
+		else:
+			checksum = fileChecksum(os.path.join(rolldir, path))
+
+		files.append({ 'path' : path, 'size' : size, 'mtime' : mtime,
+			'checksum' : checksum })
+
+	writeJSON(os.path.join(rolldir, MANIFEST), { 'files' : files,
+		'repomd' : repomdChecksum(rolldir) })
+	return
+
+
+def createIndex(rollsdir, force=0):
+	#
+	# write a manifest for every roll under rollsdir
+	# (<name>/<version>/<arch>) whose files changed since its manifest
+	# was written (every roll with force), and the index of all of them
+	#
+	rolls = []
+	for name in sorted(os.listdir(rollsdir)):
+		namedir = os.path.join(rollsdir, name)
+		if not os.path.isdir(namedir):
+			continue
+
+		for version in sorted(os.listdir(namedir)):
+			versiondir = os.path.join(namedir, version)
+			if not os.path.isdir(versiondir):
+				continue
+
+			for arch in sorted(os.listdir(versiondir)):
+				rolldir = os.path.join(versiondir, arch)
+				if not os.path.isdir(rolldir):
+					continue
+
+				if force or not manifestFresh(rolldir):
+					createManifest(rolldir)
+				rolls.append({ 'name' : name,
+					'version' : version, 'arch' : arch })
+
+	writeJSON(os.path.join(rollsdir, INDEX), { 'rolls' : rolls })
+	return
+
+
+def readIndex(url):
+	#
+	# returns the [ (name, version, arch) ] of the rolls served at url,
+	# or None if the server publishes no index
+	#
+	if url[-1] != '/':
+		url += '/'
+
+	kwargs = {}
+	if hasattr(ssl, '_create_unverified_context'):
+		kwargs['context'] = ssl._create_unverified_context()
+
+	try:
+		response = urllib2.urlopen(url + INDEX, None, TIMEOUT, **kwargs)
+		data = json.loads(response.read())
+		response.close()
+
+		rolls = []
+		for roll in data['rolls']:
+			rolls.append((roll['name'], roll['version'],
+				roll['arch']))
+	except Exception:
+		return None
+
+	#
+	# a roll added or removed since the index was written shows up in
+	# the listing of the rolls directory. one small request, against
+	# one per roll, version and arch for the crawl
+	#
+	try:
+		response = urllib2.urlopen(url, None, TIMEOUT, **kwargs)
+		listing = response.read()
+		response.close()
+	except Exception:
+		return rolls
+
+	names = []
+	for href in rocks.download.HREF_RE.findall(listing):
+		if href[-1] == '/' and '://' not in href and \
+				not href.startswith('.'):
+			names.append(urllib2.unquote(href[:-1]))
+
+	if sorted(set(names)) != sorted(set(map(lambda x: x[0], rolls))):
+		return None
+
+	return rolls
+
+
+if __name__ == '__main__':
+	force = 0
+	args = sys.argv[1:]
+	if args[:1] == [ '--force' ]:
+		force = 1
+		args = args[1:]
+	for rollsdir in args:
+		createIndex(rollsdir, force)
+
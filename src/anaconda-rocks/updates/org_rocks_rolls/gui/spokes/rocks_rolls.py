@@ -361,8 +361,16 @@ class RocksRollsSpoke(NormalSpoke):
                     rollList.append((roll, version, arch, "file:%s" % url, diskid))
                     
         if self.rollSource == NETWORK:
+            import rocks.rollindex
             netRoll = []
-            self.media.listRolls(url, url, netRoll) 
+            ## The roll index if the server has one and it still agrees
+            ## with the rolls directory, otherwise crawl its listings
+            index = rocks.rollindex.readIndex(url)
+            if index is not None:
+                for (name,version,arch) in index:
+                    netRoll.append((name,version,arch,url))
+            else:
+                self.media.listRolls(url, url, netRoll) 
             for (name,version,arch,url) in netRoll:
                 rollList.append((name, version, arch, url, None))
 
@@ -375,7 +383,9 @@ class RocksRollsSpoke(NormalSpoke):
             self.listStore.append(row=(False,"NO ROLLS FOUND!","","","",""))
 
     def selectRolls(self,widget):
+        import rocks.download
         selected = filter(lambda x : x[0], self.listStore)
+        downloader = rocks.download.Downloader()
         for r in selected:
             name,version,arch,url,diskid = r[1],r[2],r[3],r[4],r[5]
             for a in self.selectStore:
@@ -384,7 +394,8 @@ class RocksRollsSpoke(NormalSpoke):
             if len(url) > 0:
                 self.selectStore.append((name,version,arch,url,diskid))      
                 self.log.info("ROCKS - Select Rolls %s" % (name,version,arch,url,diskid).__str__()) 
-                self.install.getKickstartFiles((name,version,arch,"%s/" % url,diskid))
+                self.install.getKickstartFiles((name,version,arch,"%s/" % url,diskid),downloader)
+        downloader.run()
         self.listStore.clear()
 
     def doPopup(self,tview,path,c):
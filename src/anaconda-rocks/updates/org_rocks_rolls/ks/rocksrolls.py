@@ -23,6 +23,9 @@
 import os.path
 import logging
 import subprocess
+import json
+import shlex
+import pipes
 
 from pyanaconda.addons import AddonData
 from pyanaconda.iutil import getSysroot
@@ -32,6 +35,7 @@ from org_rocks_rolls import RocksEnv
 
 from pykickstart.options import KSOptionParser
 from pykickstart.errors import KickstartParseError, formatErrorMsg
+from pykickstart.sections import PostScriptSection
 
 # export RocksRolls class to prevent Anaconda's collect method from taking
 # AddonData class instead of the HelloWorldData class
@@ -39,6 +43,40 @@ from pykickstart.errors import KickstartParseError, formatErrorMsg
 __all__ = ["RocksRollsData"]
 
 ROLLS_FILE_PATH = "/root/rocks-rolls.txt"
+LOADATTRS = "/opt/rocks/bin/loadattrs.py"
+KGEN = "/opt/rocks/sbin/kgen"
+
+# the %-lines that open a section running to %end; others (%include,
+# %ksappend) are one-line directives
+SECTIONS = ("%pre", "%pre-install", "%post", "%packages", "%traceback",
+            "%onerror", "%addon")
+
+def splitSections(text):
+    """
+    Split a generated kickstart file into its sections.
+
+    :param text: the kickstart file
+    :type text: str
+    :returns: section name (e.g. "%post") -> list of (lineno, header args,
+              body lines) for every such section; lines outside sections,
+              %include and %ksappend among them, are left out
+    :rtype: dict
+
+    """
+    sections = {}
+    current = None
+    for (lineno, line) in enumerate(text.splitlines(True), 1):
+        if current is None:
+            if line.startswith("%") and line.split(None, 1)[0] in SECTIONS:
+                current = (lineno, shlex.split(line), [])
+                sections.setdefault(current[1][0], []).append(current)
+            continue
+        if line.strip() == "%end":
+            current = None
+            continue
+        current[2].append(line)
+
+    return sections
 
 class RocksRollsData(AddonData):
     """
@@ -173,13 +211,8 @@ class RocksRollsData(AddonData):
         ## We don't have "rolls" if we are a clientInstall
         if self.clientInstall or ksdata.addons.org_rocks_rolls.info is None:
             return
-        for row in ksdata.addons.org_rocks_rolls.info:
-            log.info("ROCKS ADD ATTR %s=%s" % (row[2],row[1]))
-            self.addAttr(row[2],row[1])
-        cmd = ["/opt/rocks/bin/rocks","report","host","attr","pydict=true"]
-        p = subprocess.Popen(cmd,stdout=subprocess.PIPE)
-        attrs = p.stdout.readlines()[0].strip()
-        
+        attrs = self.addAttrs(ksdata.addons.org_rocks_rolls.info)
+
         f = open("/tmp/site.attrs","w")
         atdict = eval(attrs)
         for key in atdict.keys():
@@ -201,33 +234,98 @@ class RocksRollsData(AddonData):
         p = subprocess.Popen(cmd,stdout=subprocess.PIPE)
         nodexml = p.stdout.readlines()
 
-        cmd = ["/opt/rocks/sbin/kgen","--section=packages"]
-        p = subprocess.Popen(cmd,stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        out,err = p.communicate(input="".join(nodexml))
-        pkgs = filter(lambda x: len(x) > 0, out.split("\n")) 
+        ## One kgen run over the node XML generates every section
+        log.info("ROCKS GENERATING PACKAGES AND POST SCRIPTS")
+        sections = splitSections(self.kgen("".join(nodexml)))
+        if "%packages" in sections and "%post" in sections:
+            pkgs = []
+            for (lineno,args,body) in sections["%packages"]:
+                pkgs.extend(body)
+            posts = sections["%post"]
+        else:
+            ## kgen did not hand back a whole kickstart, ask for each
+            ## section on its own
+            out = self.kgen("".join(nodexml),"packages")
+            pkgs = out.split("\n")
+            posts = splitSections(self.kgen("".join(nodexml),"post")).get("%post",[])
 
-        for pkg in pkgs:
+        for pkg in filter(lambda x: len(x) > 0, map(lambda x: x.strip(), pkgs)):
             if "%" in pkg or "#" in pkg:
                 continue
             if not pkg in ksdata.packages.packageList:
                 ksdata.packages.packageList.append(pkg)
 
-        ## Generate the post scripts section
-        log.info("ROCKS GENERATING POST SCRIPTS")
-        cmd = ["/opt/rocks/sbin/kgen","--section=post"]
-        p = subprocess.Popen(cmd,stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        self.postscripts,err = p.communicate(input="".join(nodexml))
+        ## Hand the post scripts straight to the %post section handler
+        ## instead of running the parser over them again
+        section = PostScriptSection(ksdata, dataObj=kickstart.AnacondaKSScript)
+        self.postscripts = ""
+        for (lineno,args,body) in posts:
+            section.handleHeader(lineno,args)
+            for line in body:
+                section.handleLine(line)
+            section.finalize()
+            self.postscripts += "%s\n%s%%end\n" % (" ".join(map(pipes.quote,args)),"".join(body))
         log.info("ROCKS POST SCRIPTS GENERATED")
 
-        ksparser = kickstart.AnacondaKSParser(ksdata)
-        ksparser.readKickstartFromString(self.postscripts, reset=False)
-
         ## Add eula and firstboot stanzas 
         log.info("ROCKS FIRSTBOOT/EULA")
         ksparser = kickstart.AnacondaKSParser(ksdata)
         ksparser.readKickstartFromString("eula --agreed", reset=False)
         ksparser.readKickstartFromString("firstboot --disable", reset=False)
         log.info("ROCKS FIRSBOOT/EULA END ")
+    def kgen(self,nodexml,section=None):
+        """
+        Run kgen over the node XML.
+
+        :param nodexml: output of 'rocks list node xml'
+        :type nodexml: str
+        :param section: only generate this section, e.g. "packages"
+        :type section: str
+        :rtype: str
+
+        """
+        cmd = [KGEN]
+        if section is not None:
+            cmd.append("--section=%s" % section)
+        p = subprocess.Popen(cmd,stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out,err = p.communicate(input=nodexml)
+        return out
+
+    def addAttrs(self,info):
+        """
+        Add every (attr, value) of the info rows to the database in one
+        rocks process and return the resulting host attributes, i.e. the
+        output of 'rocks report host attr pydict=true'.
+
+        :param info: rows of ksdata.addons.org_rocks_rolls.info
+        :type info: list
+        :rtype: str
+
+        """
+        log = logging.getLogger("anaconda")
+        pairs = []
+        for row in info:
+            log.info("ROCKS ADD ATTR %s=%s" % (row[2],row[1]))
+            pairs.append([row[2],row[1]])
+
+        try:
+            p = subprocess.Popen([LOADATTRS],stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+            out,err = p.communicate(input=json.dumps(pairs))
+            lines = filter(lambda x: len(x) > 0, out.split("\n"))
+            if p.returncode == 0 and len(lines) > 0:
+                return lines[0].strip()
+        except OSError:
+            pass
+
+        ## Fall back to one rocks process per attribute
+        log.info("ROCKS %s failed, adding attributes one by one" % LOADATTRS)
+        for (attr,value) in pairs:
+            self.addAttr(attr,value)
+        cmd = ["/opt/rocks/bin/rocks","report","host","attr","pydict=true"]
+        p = subprocess.Popen(cmd,stdout=subprocess.PIPE)
+        return p.stdout.readlines()[0].strip()
+
     def addAttr(self,attr,value):
         if value is None or attr is None:
             return
@@ -40,10 +40,12 @@ import yum
 import pylorax.ltmpl as ltmpl
 
 import pylorax.imgutils as imgutils
+import pylorax.executils as executils
 from pylorax.sysutils import joinpaths, linktree, remove
 from rpmUtils.arch import getBaseArch
 
-from pylorax.treebuilder import RuntimeBuilder, TreeBuilder
+from pylorax.treebuilder import RuntimeBuilder, TreeBuilder, InitramfsCache, StageCache
+from pylorax.treebuilder import installed_packages
 from pylorax.buildstamp import BuildStamp
 from pylorax.treeinfo import TreeInfo
 from pylorax.discinfo import DiscInfo
@@ -98,6 +100,8 @@ class Lorax(BaseLoraxClass):
         self.conf.add_section("lorax")
         self.conf.set("lorax", "debug", "1")
         self.conf.set("lorax", "sharedir", "/usr/share/lorax")
+        self.conf.set("lorax", "cachedir", "")
+        self.conf.set("lorax", "directimages", "0")
 
         self.conf.add_section("output")
         self.conf.set("output", "colors", "1")
@@ -114,6 +118,9 @@ class Lorax(BaseLoraxClass):
         self.conf.set("compression", "type", "xz")
         self.conf.set("compression", "args", "")
         self.conf.set("compression", "bcj", "on")
+        self.conf.set("compression", "processors", "")
+        self.conf.set("compression", "blocksize", "")
+        self.conf.set("compression", "memory", "")
 
         # read the config file
         if os.path.isfile(conf_file):
@@ -167,7 +174,10 @@ class Lorax(BaseLoraxClass):
             add_arch_templates=None,
             add_arch_template_vars=None,
             template_tempdir=None,
-            user_dracut_args=None):
+            user_dracut_args=None,
+            incremental=False,
+            dryrun=False,
+            benchmark=False):
 
         assert self._configured
 
@@ -243,16 +253,58 @@ class Lorax(BaseLoraxClass):
             sys.exit(1)
 
         templatedir = self.conf.get("lorax", "sharedir")
+        cachedir = self.conf.get("lorax", "cachedir")
+        template_cache = None
+        if cachedir:
+            template_cache = ltmpl.TemplateCache(joinpaths(cachedir, "templates"))
+
         # NOTE: rb.root = ybo.conf.installroot (== self.inroot)
         rb = RuntimeBuilder(product=self.product, arch=self.arch,
                             yum=ybo, templatedir=templatedir,
                             installpkgs=installpkgs,
                             add_templates=add_templates,
-                            add_template_vars=add_template_vars)
-
-        logger.info("installing runtime packages")
-        rb.yum.conf.skip_broken = self.conf.getboolean("yum", "skipbroken")
-        rb.install()
+                            add_template_vars=add_template_vars,
+                            template_cache=template_cache,
+                            dryrun=dryrun)
+
+        # incremental builds pick up from the last stage whose inputs
+        # haven't changed since it was snapshotted
+        stages, stage_keys, restored = None, {}, []
+        if incremental and not cachedir:
+            logger.warning("incremental builds need cachedir in lorax.conf, doing a full build")
+        elif incremental:
+            stages = StageCache(joinpaths(cachedir, "runtime"))
+            stage_keys = rb.stage_keys()
+            restored = stages.available(stage_keys)
+            stage_keys = dict(stage_keys)
+            resume = [stage for stage in restored if stage != "cleanup"]
+            if resume and not dryrun:
+                stages.restore(resume[-1], stage_keys[resume[-1]], self.inroot)
+                ybo.closeRpmDB()
+            logger.info("reusing runtime stages: %s", ", ".join(restored) or "none")
+
+        if dryrun:
+            # plan each runtime template against the snapshot of the stage
+            # before it when there is one, and stop there
+            for stage, previous, func in (("install", None, rb.install),
+                                          ("postinstall", "install", rb.postinstall),
+                                          ("cleanup", "postinstall", rb.cleanup)):
+                if previous in restored:
+                    stages.restore(previous, stage_keys[previous], self.inroot)
+                    ybo.closeRpmDB()
+                func()
+            if not os.listdir(self.outputdir):
+                os.rmdir(self.outputdir)
+            if remove_temp:
+                remove(self.workdir)
+            return
+
+        if "install" not in restored:
+            logger.info("installing runtime packages")
+            rb.yum.conf.skip_broken = self.conf.getboolean("yum", "skipbroken")
+            rb.install()
+            if stages:
+                stages.save("install", stage_keys["install"], self.inroot)
 
         # write .buildstamp
         buildstamp = BuildStamp(self.product.name, self.product.version,
@@ -264,25 +316,46 @@ class Lorax(BaseLoraxClass):
             rb.writepkglists(joinpaths(logdir, "pkglists"))
             rb.writepkgsizes(joinpaths(logdir, "original-pkgsizes.txt"))
 
-        logger.info("doing post-install configuration")
-        rb.postinstall()
+        if "postinstall" not in restored:
+            logger.info("doing post-install configuration")
+            rb.postinstall()
+            if stages:
+                stages.save("postinstall", stage_keys["postinstall"], self.inroot)
 
         # write .discinfo
         discinfo = DiscInfo(self.product.release, self.arch.basearch)
         discinfo.write(joinpaths(self.outputdir, ".discinfo"))
 
+        # the rpmdb is gone after cleanup, so note what went into the root
+        # now for the initramfs cache key: the packages with their checksums,
+        # and the runtime key, which changes with the templates and config
+        # files that changed the root after them
+        initramfs_cache = None
+        if cachedir:
+            runtime_key = stage_keys.get("cleanup") or dict(rb.stage_keys())["cleanup"]
+            initramfs_cache = InitramfsCache(joinpaths(cachedir, "initramfs"),
+                                "\n".join(installed_packages(self.inroot) + [runtime_key]))
+            logger.debug("using initramfs cache %s", initramfs_cache.cachedir)
+
         logger.info("backing up installroot")
         installroot = joinpaths(self.workdir, "installroot")
         linktree(self.inroot, installroot)
 
-        logger.info("generating kernel module metadata")
-        rb.generate_module_data()
+        if "cleanup" not in restored:
+            logger.info("generating kernel module metadata")
+            rb.generate_module_data()
 
-        logger.info("cleaning unneeded files")
-        rb.cleanup()
+            logger.info("cleaning unneeded files")
+            rb.cleanup()
+            if stages:
+                stages.save("cleanup", stage_keys["cleanup"], self.inroot)
+        else:
+            stages.restore("cleanup", stage_keys["cleanup"], self.inroot)
+            buildstamp.write(joinpaths(self.inroot, ".buildstamp"))
 
+        runtime_sizes = None
         if self.debug:
-            rb.writepkgsizes(joinpaths(logdir, "final-pkgsizes.txt"))
+            runtime_sizes = rb.writepkgsizes(joinpaths(logdir, "final-pkgsizes.txt"))
 
         logger.info("creating the runtime image")
         runtime = "images/install.img"
@@ -293,9 +366,32 @@ class Lorax(BaseLoraxClass):
                 compressargs += ["-Xbcj", self.arch.bcj]
             else:
                 logger.info("no BCJ filter for arch %s", self.arch.basearch)
-        rb.create_runtime(joinpaths(installroot,runtime),
+        candidates = None
+        if benchmark:
+            candidates = [("xz", "xz", []), ("lz4", "lz4", []),
+                          ("zstd", "zstd", []), ("gzip", "gzip", [])]
+            if self.arch.bcj:
+                candidates.insert(1, ("xz+bcj", "xz", ["-Xbcj", self.arch.bcj]))
+        results = rb.create_runtime(joinpaths(installroot,runtime),
                           compression=compression, compressargs=compressargs,
-                          size=size)
+                          size=size, sizes=runtime_sizes,
+                          direct=self.conf.getboolean("lorax", "directimages"),
+                          processors=self.conf.get("compression", "processors"),
+                          blocksize=self.conf.get("compression", "blocksize"),
+                          memory=self.conf.get("compression", "memory"),
+                          benchmark=candidates)
+        if results:
+            with open(joinpaths(logdir, "squashfs-benchmark.txt"), "w") as f:
+                f.write("%-10s %10s %12s %14s\n" % ("compressor", "build (s)", "size (MiB)",
+                                                    "read (MiB/s)"))
+                for name, built, imgsize, readrate in results:
+                    if built is None:
+                        line = "%-10s %10s\n" % (name, "unsupported")
+                    else:
+                        line = "%-10s %10.1f %12.1f %14s\n" % (name, built, imgsize/1024.0**2,
+                               "%.1f" % (readrate/1024.0**2) if readrate else "-")
+                    f.write(line)
+                    logger.info(line.rstrip())
 
         logger.info("preparing to build output tree and boot images")
         treebuilder = TreeBuilder(product=self.product, arch=self.arch,
@@ -305,7 +401,9 @@ class Lorax(BaseLoraxClass):
                                   templatedir=templatedir,
                                   add_templates=add_arch_templates,
                                   add_template_vars=add_arch_template_vars,
-                                  workdir=self.workdir)
+                                  workdir=self.workdir,
+                                  initramfs_cache=initramfs_cache,
+                                  template_cache=template_cache)
 
         logger.info("rebuilding initramfs images")
         if not user_dracut_args:
@@ -327,22 +425,26 @@ class Lorax(BaseLoraxClass):
 
         logger.info("dracut args = %s", dracut_args)
         logger.info("anaconda args = %s", anaconda_args)
-        treebuilder.rebuild_initrds(add_args=anaconda_args)
+        variants = [("", anaconda_args, None)]
 
         if doupgrade:
             # Build upgrade.img. It'd be nice if these could coexist in the same
             # image, but that would increase the size of the anaconda initramfs,
             # which worries some people (esp. PPC tftpboot). So they're separate.
+            upgrade_env = None
             try:
                 # If possible, use the 'redhat-upgrade-tool' plymouth theme
                 themes = runcmd_output(['plymouth-set-default-theme', '--list'],
                                        root=installroot)
                 if 'redhat-upgrade-tool' in themes.splitlines():
-                    os.environ['PLYMOUTH_THEME_NAME'] = 'redhat-upgrade-tool'
+                    upgrade_env = {'PLYMOUTH_THEME_NAME': 'redhat-upgrade-tool'}
             except RuntimeError:
                 pass
             upgrade_args = dracut_args + ["--add", "system-upgrade convertfs"]
-            treebuilder.rebuild_initrds(add_args=upgrade_args, prefix="upgrade")
+            variants.append(("upgrade", upgrade_args, upgrade_env))
+
+        # both sets of images are built in one pool of dracut runs
+        treebuilder.rebuild_initrd_variants(variants)
 
         logger.info("populating output tree and building boot images")
         treebuilder.build()
@@ -354,6 +456,11 @@ class Lorax(BaseLoraxClass):
             treeinfo.add_section(section, data)
         treeinfo.write(joinpaths(self.outputdir, ".treeinfo"))
 
+        # how long the external commands took
+        executils.profile.write(joinpaths(logdir, "exec-profile.json"))
+        for program, count, secs in executils.profile.summary()[:10]:
+            logger.debug("%-24s %5i runs %9.2fs", program, count, secs)
+
         # cleanup
         if remove_temp:
             remove(self.workdir)
@@ -36,7 +36,7 @@ from pykickstart.version import makeVersion, RHEL7
 from pylorax import ArchData
 from pylorax.base import DataHolder
 from pylorax.treebuilder import TreeBuilder, RuntimeBuilder
-from pylorax.treebuilder import findkernels
+from pylorax.treebuilder import findkernels, InitramfsCache, installed_packages, digest_tree
 from pylorax.sysutils import joinpaths, remove
 from pylorax.imgutils import Mount, PartitionMount, copytree, mount, umount
 from pylorax.imgutils import mksquashfs, mkrootfsimg
@@ -230,6 +230,12 @@ def rebuild_initrds_for_live(opts, sys_root_dir, results_dir):
     if not kernels:
         raise Exception("No initrds found, cannot rebuild_initrds")
 
+    cache = None
+    if opts.initramfs_cache:
+        # the kickstart's %post can change any file in the root
+        ks = [digest_tree(opts.ks[0])] if opts.ks else []
+        cache = InitramfsCache(opts.initramfs_cache, "\n".join(installed_packages(sys_root_dir) + ks))
+
     # Hush some dracut warnings. TODO: bind-mount proc in place?
     open(joinpaths(sys_root_dir,"/proc/modules"),"w")
 
@@ -254,11 +260,14 @@ def rebuild_initrds_for_live(opts, sys_root_dir, results_dir):
 
         kver = kernel.version
 
-        cmd = dracut + [outfile, kver]
-        runcmd(cmd, root=sys_root_dir)
-
         new_initrd_path = joinpaths(results_dir, os.path.basename(kernel.initrd.path))
-        shutil.move(joinpaths(sys_root_dir, outfile), new_initrd_path)
+        key = cache.key(sys_root_dir, kver, dracut) if cache else None
+        if not key or not cache.fetch(key, new_initrd_path):
+            cmd = dracut + [outfile, kver]
+            runcmd(cmd, root=sys_root_dir)
+            if key:
+                cache.store(key, joinpaths(sys_root_dir, outfile))
+            shutil.move(joinpaths(sys_root_dir, outfile), new_initrd_path)
         os.chmod(new_initrd_path, 0644)
         shutil.copy2(joinpaths(sys_root_dir, kernel.path), results_dir)
 
@@ -24,6 +24,11 @@ import os, sys
 import subprocess
 import time
 import threading
+import select
+import errno
+import collections
+import heapq
+import json
 
 import logging
 log = logging.getLogger("pylorax")
@@ -35,39 +40,154 @@ class ExecProduct(object):
         self.stdout = stdout
         self.stderr = stderr
 
-class tee(threading.Thread):
-    """ Python reimplementation of the shell tee process, so we can
-        feed the pipe output into two places at the same time
+# how much of a command's output _run_polled keeps for error reports, how
+# much it reads at a time and how often it checks callback_func (seconds)
+RING_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+POLL_INTERVAL = 1
+# how many of the slowest commands ExecProfile keeps in full
+PROFILE_RECORDS = 200
+
+class RingBuffer(object):
+    """ Keep the last maxbytes of the data written to it
+    """
+    def __init__(self, maxbytes=RING_SIZE):
+        self.maxbytes = maxbytes
+        self.total = 0
+        self._chunks = collections.deque()
+        self._size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        self.total += len(data)
+        while self._size - len(self._chunks[0]) >= self.maxbytes:
+            self._size -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        return "".join(self._chunks)[-self.maxbytes:]
+
+class ExecProfile(object):
+    """ How long the commands run by execWithRedirect/execWithCapture took:
+        the runs and total time per program, and the maxrecords slowest
+        commands in full
     """
-    def __init__(self, inputdesc, outputdesc, logmethod, command):
-        threading.Thread.__init__(self)
-        self.inputdesc = os.fdopen(inputdesc, "r")
-        self.outputdesc = outputdesc
-        self.logmethod = logmethod
-        self.running = True
-        self.command = command
-
-    def run(self):
-        while self.running:
+    def __init__(self, maxrecords=PROFILE_RECORDS):
+        self._lock = threading.Lock()
+        self.maxrecords = maxrecords
+        self.totals = {}        # program -> (count, seconds)
+        self._slowest = []      # heap of (elapsed, seq, record)
+        self._seq = 0
+
+    def record(self, argv, start, elapsed, rc, outbytes, errbytes):
+        with self._lock:
+            count, secs = self.totals.get(argv[0], (0, 0.0))
+            self.totals[argv[0]] = (count+1, secs+elapsed)
+            self._seq += 1
+            item = (elapsed, self._seq, {"argv": argv, "start": start, "elapsed": elapsed,
+                                         "rc": rc, "stdout": outbytes, "stderr": errbytes})
+            if len(self._slowest) < self.maxrecords:
+                heapq.heappush(self._slowest, item)
+            elif item > self._slowest[0]:
+                heapq.heapreplace(self._slowest, item)
+
+    @property
+    def records(self):
+        """ The slowest commands, slowest first
+        """
+        with self._lock:
+            return [r for _elapsed, _seq, r in sorted(self._slowest, reverse=True)]
+
+    def summary(self):
+        """ Return [(program, count, seconds), ...], slowest first
+        """
+        with self._lock:
+            totals = dict(self.totals)
+        return sorted(((k, c, t) for k, (c, t) in totals.items()),
+                      key=lambda i: i[2], reverse=True)
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "commands": self.records}, f, indent=1)
+
+profile = ExecProfile()
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def _run_polled(argv, stdin, stdout, stderr, preexec_fn, cwd, env,
+                capture=False, callback_func=None):
+    """ Run argv, reading its stdout and stderr on this thread with poll().
+        Output goes to the stdout and stderr descriptors as it arrives (stdout
+        is collected instead when capture is True) and to program_log, a
+        chunk of whole lines per record. The last RING_SIZE bytes are kept
+        for the CalledProcessError if it fails.
+        @return (returncode, captured stdout, tail of the output)
+    """
+    start = time.time()
+    proc = subprocess.Popen(argv, stdin=stdin,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            preexec_fn=preexec_fn, cwd=cwd,
+                            env=env)
+    out_fd, err_fd = proc.stdout.fileno(), proc.stderr.fileno()
+    # fd -> [where it goes, log method, partial line, bytes read]
+    streams = {out_fd: [stdout, program_log.info, "", 0],
+               err_fd: [stderr, program_log.error, "", 0]}
+    poller = select.poll()
+    for fd in streams:
+        poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
+    captured = []
+    tail = RingBuffer()
+    counts = {}
+    try:
+        while streams:
             try:
-                data = self.inputdesc.readline()
-            except IOError:
-                self.logmethod("Can't read from pipe during a call to %s. "
-                               "(program terminated suddenly?)" % self.command)
-                break
-            if data == "":
-                self.running = False
-            else:
-                self.logmethod(data.rstrip('\n'))
-                os.write(self.outputdesc, data)
+                events = poller.poll(POLL_INTERVAL * 1000)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if callback_func and callback_func():
+                proc.terminate()
+                callback_func = None
+            for fd, _event in events:
+                stream = streams[fd]
+                data = os.read(fd, CHUNK_SIZE)
+                if not data:
+                    if stream[2]:
+                        stream[1](stream[2])
+                    poller.unregister(fd)
+                    counts[fd] = stream[3]
+                    del streams[fd]
+                    continue
+                stream[3] += len(data)
+                tail.write(data)
+                if capture and fd == out_fd:
+                    captured.append(data)
+                else:
+                    _write_all(stream[0], data)
+                lines = (stream[2] + data).split("\n")
+                stream[2] = lines.pop()
+                if len(stream[2]) > CHUNK_SIZE:
+                    lines.append(stream[2])
+                    stream[2] = ""
+                if lines:
+                    stream[1]("\n".join(lines))
+    finally:
+        proc.stdout.close()
+        proc.stderr.close()
+        proc.wait()
+        profile.record([argv[0]] + list(argv[1:]), start, time.time() - start,
+                       proc.returncode, counts.get(out_fd, 0), counts.get(err_fd, 0))
 
-    def stop(self):
-        self.running = False
-        return self
+    return proc.returncode, "".join(captured), tail.getvalue()
 
 def execWithRedirect(command, argv, stdin = None, stdout = None,
                      stderr = None, root = None, preexec_fn=None, cwd=None,
-                     raise_err=False, callback_func=None, callback_args=None):
+                     raise_err=False, callback_func=None, callback_args=None,
+                     env_add=None):
     """ Run an external program and redirect the output to a file.
         @param command The command to run.
         @param argv A list of arguments.
@@ -78,6 +198,7 @@ def execWithRedirect(command, argv, stdin = None, stdout = None,
         @param preexec_fn function to pass to Popen
         @param cwd working directory to pass to Popen
         @param raise_err raise CalledProcessError when the returncode is not 0
+        @param env_add dict of environment variables to add for this command
         @return The return code of command.
     """
     def chroot ():
@@ -115,12 +236,10 @@ def execWithRedirect(command, argv, stdin = None, stdout = None,
 
     program_log.info("Running... %s", " ".join([command] + argv))
 
-    #prepare os pipes for feeding tee proceses
-    pstdout, pstdin = os.pipe()
-    perrout, perrin = os.pipe()
-
     env = os.environ.copy()
     env.update({"LC_ALL": "C"})
+    if env_add:
+        env.update(env_add)
 
     if root:
         preexec_fn = chroot
@@ -130,61 +249,24 @@ def execWithRedirect(command, argv, stdin = None, stdout = None,
         program_log.info("chdiring into %s", cwd)
 
     try:
-        #prepare tee proceses
-        proc_std = tee(pstdout, stdout, program_log.info, command)
-        proc_err = tee(perrout, stderr, program_log.error, command)
-
-        #start monitoring the outputs
-        proc_std.start()
-        proc_err.start()
-
-        proc = subprocess.Popen([command] + argv, stdin=stdin,
-                                stdout=pstdin,
-                                stderr=perrin,
-                                preexec_fn=preexec_fn, cwd=cwd,
-                                env=env)
-
-        # Wait for the process to finish, calling callback_func to test for early termination
-        while proc.returncode is None:
-            time.sleep(5)
-            if callback_func and callback_func():
-                proc.terminate()
-                callback_func = None
-            proc.poll()
-
-        ret = proc.returncode
-
-        #close the input ends of pipes so we get EOF in the tee processes
-        os.close(pstdin)
-        os.close(perrin)
-
-        #wait for the output to be written and destroy them
-        proc_std.join()
-        del proc_std
-
-        proc_err.join()
-        del proc_err
-
-        stdinclose()
-        stdoutclose()
-        stderrclose()
+        (ret, _output, tail) = _run_polled([command] + argv, stdin, stdout, stderr,
+                                           preexec_fn, cwd, env,
+                                           callback_func=callback_func)
     except OSError as e:
         errstr = "Error running %s: %s" % (command, e.strerror)
         log.error(errstr)
         program_log.error(errstr)
-        #close the input ends of pipes so we get EOF in the tee processes
-        os.close(pstdin)
-        os.close(perrin)
-        proc_std.join()
-        proc_err.join()
-
         stdinclose()
         stdoutclose()
         stderrclose()
         raise RuntimeError, errstr
 
+    stdinclose()
+    stdoutclose()
+    stderrclose()
+
     if ret and raise_err:
-        raise subprocess.CalledProcessError(ret, [command]+argv)
+        raise subprocess.CalledProcessError(ret, [command]+argv, output=tail)
 
     return ret
 
@@ -209,7 +291,6 @@ def execWithCapture(command, argv, stdin = None, stderr = None, root=None,
         stderrclose()
 
     stdinclose = stderrclose = lambda : None
-    rc = ""
     argv = list(argv)
 
     if isinstance(stdin, str):
@@ -244,31 +325,16 @@ def execWithCapture(command, argv, stdin = None, stderr = None, root=None,
         program_log.info("chdiring into %s", cwd)
 
     try:
-        proc = subprocess.Popen([command] + argv, stdin=stdin,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                preexec_fn=preexec_fn, cwd=cwd,
-                                env=env)
-
-        while True:
-            (outStr, errStr) = proc.communicate()
-            if outStr:
-                map(program_log.info, outStr.splitlines())
-                rc += outStr
-            if errStr:
-                map(program_log.error, errStr.splitlines())
-                os.write(stderr, errStr)
-
-            if proc.returncode is not None:
-                break
+        (ret, rc, tail) = _run_polled([command] + argv, stdin, None, stderr,
+                                      preexec_fn, cwd, env, capture=True)
     except OSError as e:
         log.error ("Error running " + command + ": " + e.strerror)
         closefds()
         raise RuntimeError, "Error running " + command + ": " + e.strerror
 
     closefds()
-    if proc.returncode and raise_err:
-        raise subprocess.CalledProcessError(proc.returncode, [command]+argv)
+    if ret and raise_err:
+        raise subprocess.CalledProcessError(ret, [command]+argv, output=tail)
 
     return rc
 
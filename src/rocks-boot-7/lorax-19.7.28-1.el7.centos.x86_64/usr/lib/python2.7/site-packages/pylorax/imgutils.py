@@ -24,22 +24,35 @@ import os, tempfile
 from os.path import join, dirname
 from subprocess import Popen, PIPE, CalledProcessError
 import sys
+import stat
 import time
+import tarfile
+import threading
+import Queue
 import traceback
 import multiprocessing
+import atexit
+import errno
+import fcntl
+import select
+import socket
+import struct
 from time import sleep
 
-from pylorax.sysutils import cpfile
+try:
+    import xattr
+except ImportError:
+    xattr = None
+
+from pylorax.sysutils import cpfile, remove
+from pylorax.treecopy import copy_tree
 from pylorax.executils import execWithRedirect, execWithCapture
 from pylorax.executils import runcmd, runcmd_output
 
 ######## Functions for making container images (cpio, tar, squashfs) ##########
 
-def compress(command, rootdir, outfile, compression="xz", compressargs=None):
-    '''Make a compressed archive of the given rootdir.
-    command is a list of the archiver commands to run
-    compression should be "xz", "gzip", "lzma", "bzip2", or None.
-    compressargs will be used on the compression commandline.'''
+def compressor(compression="xz", compressargs=None):
+    '''Return the compression command line for compress() and stream_compress()'''
     if compressargs is None:
         compressargs = ["-9"]
     if compression not in (None, "xz", "gzip", "lzma", "bzip2"):
@@ -54,14 +67,22 @@ def compress(command, rootdir, outfile, compression="xz", compressargs=None):
     if compression in ("xz", "lzma"):
         compressargs.insert(0, "-T%d" % multiprocessing.cpu_count())
 
-    logger.debug("find %s -print0 |%s | %s %s > %s", rootdir, " ".join(command),
-                 compression, " ".join(compressargs), outfile)
+    return [compression] + compressargs
+
+def compress(command, rootdir, outfile, compression="xz", compressargs=None):
+    '''Make a compressed archive of the given rootdir.
+    command is a list of the archiver commands to run
+    compression should be "xz", "gzip", "lzma", "bzip2", or None.
+    compressargs will be used on the compression commandline.'''
+    comp_cmd = compressor(compression, compressargs)
+
+    logger.debug("find %s -print0 |%s | %s > %s", rootdir, " ".join(command),
+                 " ".join(comp_cmd), outfile)
     find, archive, comp = None, None, None
     try:
         find = Popen(["find", ".", "-print0"], stdout=PIPE, cwd=rootdir)
         archive = Popen(command, stdin=find.stdout, stdout=PIPE, cwd=rootdir)
-        comp = Popen([compression] + compressargs,
-                     stdin=archive.stdout, stdout=open(outfile, "wb"))
+        comp = Popen(comp_cmd, stdin=archive.stdout, stdout=open(outfile, "wb"))
         (_stdout, _stderr) = comp.communicate()
         return comp.returncode
     except OSError as e:
@@ -70,23 +91,277 @@ def compress(command, rootdir, outfile, compression="xz", compressargs=None):
         _ = [p.kill() for p in (find, archive, comp) if p]
         return 1
 
-def mkcpio(rootdir, outfile, compression="xz", compressargs=None):
+def walk_tree(rootdir, sort=False):
+    '''Yield (path, stat) for everything under rootdir, with paths starting
+    with "./" like 'find .' prints them. A directory always comes before its
+    contents. Each directory is listed and stat'ed in one batch, and with
+    sort the names in it are sorted.'''
+    yield (".", os.lstat(rootdir))
+    dirs = ["."]
+    while dirs:
+        top = dirs.pop()
+        names = os.listdir(join(rootdir, top))
+        if sort:
+            names.sort()
+        entries = [(top + "/" + n, os.lstat(join(rootdir, top, n))) for n in names]
+        subdirs = []
+        for path, st in entries:
+            yield (path, st)
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(path)
+        dirs.extend(reversed(subdirs))
+
+class ArchiveStream(object):
+    '''File-like object that feeds an archive into the compressor in
+    large chunks and reports progress.'''
+    CHUNK = 1024*1024
+
+    def __init__(self, fobj, progress=None, interval=1.0):
+        self.fobj = fobj
+        self.progress = progress
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = self.last = time.time()
+        self._buf = []
+        self._buflen = 0
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buflen += len(data)
+        self.bytes += len(data)
+        if self._buflen >= self.CHUNK:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            self.fobj.write("".join(self._buf))
+            self._buf = []
+            self._buflen = 0
+
+    def tell(self):
+        return self.bytes
+
+    def added(self, force=False):
+        '''Count a file and call progress(files, bytes, bytes_per_sec)
+        at most once per interval.'''
+        self.files += 1
+        now = time.time()
+        if self.progress and (force or now - self.last >= self.interval):
+            self.last = now
+            elapsed = max(now - self.start, 0.001)
+            self.progress(self.files, self.bytes, self.bytes / elapsed)
+
+class CpioWriter(object):
+    '''Write a newc cpio archive, like 'cpio -H newc -o' does'''
+    def __init__(self, fobj, reproducible=False, mtime_clamp=None):
+        self.fobj = fobj
+        self.reproducible = reproducible
+        self.mtime_clamp = mtime_clamp
+        self._inodes = {}
+        self._links = {}
+
+    def _ino(self, st):
+        if not self.reproducible:
+            return st.st_ino
+        return self._inodes.setdefault((st.st_dev, st.st_ino), len(self._inodes) + 1)
+
+    def _header(self, name, fields):
+        hdr = "070701" + "".join("%08X" % f for f in fields) + name + "\0"
+        self.fobj.write(hdr + "\0" * (-len(hdr) % 4))
+
+    def _write(self, name, st, fullpath=None, data=""):
+        '''Write an entry, its data is data or the contents of fullpath'''
+        # like cpio, store "./foo" as "foo"
+        while name.startswith("./"):
+            name = name[2:].lstrip("/")
+        mtime = int(st.st_mtime)
+        if self.mtime_clamp is not None:
+            mtime = min(mtime, self.mtime_clamp)
+        dev = 0 if self.reproducible else st.st_dev
+        size = st.st_size if fullpath else len(data)
+        self._header(name, (self._ino(st), st.st_mode, st.st_uid, st.st_gid,
+                            st.st_nlink, mtime, size, os.major(dev), os.minor(dev),
+                            os.major(st.st_rdev), os.minor(st.st_rdev),
+                            len(name) + 1, 0))
+        if fullpath:
+            written = 0
+            with open(fullpath, "rb") as f:
+                for data in iter(lambda: f.read(ArchiveStream.CHUNK), ""):
+                    self.fobj.write(data)
+                    written += len(data)
+            if written != size:
+                raise IOError("%s changed size while archiving it" % fullpath)
+        else:
+            self.fobj.write(data)
+        self.fobj.write("\0" * (-size % 4))
+
+    def add(self, name, fullpath, st):
+        if stat.S_ISLNK(st.st_mode):
+            self._write(name, st, data=os.readlink(fullpath))
+        elif stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1:
+                # like cpio, hardlinks go out together with the data on the last one
+                key = (st.st_dev, st.st_ino)
+                self._links.setdefault(key, []).append((name, fullpath, st))
+                if len(self._links[key]) == st.st_nlink:
+                    self._write_links(self._links.pop(key))
+                return
+            self._write(name, st, fullpath)
+        else:
+            self._write(name, st)
+
+    def _write_links(self, links):
+        for name, _fullpath, st in links[:-1]:
+            self._write(name, st)
+        name, fullpath, st = links[-1]
+        self._write(name, st, fullpath)
+
+    def close(self):
+        for key in sorted(self._links):
+            self._write_links(self._links[key])
+        self._links = {}
+        self._header("TRAILER!!!", (0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 11, 0))
+
+class TarWriter(object):
+    '''Write a pax tar archive. When the xattr module is available the
+    xattrs with text values (incl. SELinux labels) are stored like
+    'tar --selinux --xattrs' does, ACLs are not.'''
+    def __init__(self, fobj, reproducible=False, mtime_clamp=None):
+        self.tar = tarfile.open(fileobj=fobj, mode="w|", format=tarfile.PAX_FORMAT)
+        self.mtime_clamp = mtime_clamp
+        if xattr is None:
+            logger.warning("python xattr module missing, xattrs will not be archived")
+
+    def add(self, name, fullpath, _st):
+        info = self.tar.gettarinfo(fullpath, arcname=name)
+        if self.mtime_clamp is not None:
+            info.mtime = min(info.mtime, self.mtime_clamp)
+        if xattr is not None:
+            for key, value in xattr.get_all(fullpath, nofollow=True):
+                try:
+                    info.pax_headers[u"SCHILY.xattr." + key] = value.decode("utf-8")
+                except UnicodeDecodeError:
+                    logger.debug("not archiving binary xattr %s of %s", key, fullpath)
+        if info.isreg():
+            with open(fullpath, "rb") as f:
+                self.tar.addfile(info, f)
+        else:
+            self.tar.addfile(info)
+
+    def close(self):
+        self.tar.close()
+
+def stream_compress(writer, rootdir, outfile, compression="xz", compressargs=None,
+                    reproducible=False, mtime_clamp=None, progress=None):
+    '''Make a compressed archive of rootdir without running find and an
+    archiver: writer (CpioWriter or TarWriter) builds the archive in-process
+    and it is streamed into the compressor.
+    If reproducible is True entries are sorted and inode numbers are
+    renumbered, and mtimes are clamped to mtime_clamp (default:
+    $SOURCE_DATE_EPOCH or 0).
+    progress(files, bytes, bytes_per_sec) is called about once a second.'''
+    comp_cmd = compressor(compression, compressargs)
+    if reproducible and mtime_clamp is None:
+        mtime_clamp = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+
+    logger.debug("%s %s | %s > %s", writer.__name__, rootdir, " ".join(comp_cmd), outfile)
+    comp = None
+    try:
+        comp = Popen(comp_cmd, stdin=PIPE, stdout=open(outfile, "wb"))
+        stream = ArchiveStream(comp.stdin, progress)
+        archive = writer(stream, reproducible=reproducible, mtime_clamp=mtime_clamp)
+        for path, st in walk_tree(rootdir, sort=reproducible):
+            archive.add(path, join(rootdir, path), st)
+            stream.added()
+        archive.close()
+        stream.flush()
+        stream.added(force=True)
+        comp.stdin.close()
+        return comp.wait()
+    except (OSError, IOError) as e:
+        logger.error(e)
+        if comp:
+            comp.kill()
+        return 1
+
+def mkcpio(rootdir, outfile, compression="xz", compressargs=None,
+           streaming=False, reproducible=False, progress=None):
+    '''Make a compressed cpio archive of rootdir. With streaming (implied by
+    reproducible and progress) the archive is written by stream_compress.'''
+    if streaming or reproducible or progress:
+        return stream_compress(CpioWriter, rootdir, outfile, compression, compressargs,
+                               reproducible=reproducible, progress=progress)
     return compress(["cpio", "--null", "--quiet", "-H", "newc", "-o"],
                     rootdir, outfile, compression, compressargs)
 
-def mktar(rootdir, outfile, compression="xz", compressargs=None):
+def mktar(rootdir, outfile, compression="xz", compressargs=None,
+          streaming=False, reproducible=False, progress=None):
+    '''Make a compressed tar archive of rootdir. With streaming (implied by
+    reproducible and progress) the archive is written by stream_compress.'''
+    if streaming or reproducible or progress:
+        return stream_compress(TarWriter, rootdir, outfile, compression, compressargs,
+                               reproducible=reproducible, progress=progress)
     return compress(["tar", "--no-recursion", "--selinux", "--acls", "--xattrs", "-cf-", "--null", "-T-"],
                     rootdir, outfile, compression, compressargs)
 
-def mksquashfs(rootdir, outfile, compression="default", compressargs=None):
-    '''Make a squashfs image containing the given rootdir.'''
+def mksquashfs(rootdir, outfile, compression="default", compressargs=None,
+               processors=None, blocksize=None, memory=None):
+    '''Make a squashfs image containing the given rootdir.
+    processors limits the compressor threads, blocksize and memory are
+    passed to mksquashfs -b and -mem as given (eg. "1M", "512M").'''
     if compressargs is None:
         compressargs = []
     if compression != "default":
         compressargs = ["-comp", compression] + compressargs
+    if processors:
+        compressargs += ["-processors", str(processors)]
+    if blocksize:
+        compressargs += ["-b", str(blocksize)]
+    if memory:
+        compressargs += ["-mem", str(memory)]
     return execWithRedirect("mksquashfs", [rootdir, outfile] + compressargs)
 
-def mkrootfsimg(rootdir, outfile, label, size=2, sysroot=""):
+def benchmark_squashfs(rootdir, workdir, candidates, processors=None, blocksize=None,
+                       memory=None):
+    '''Squash rootdir with each of candidates, [(name, compression, compressargs), ...],
+    in workdir, then unpack each image again to see how fast it reads back.
+    Returns [(name, seconds to build, image size, bytes unpacked per second), ...];
+    the numbers are None for compressors mksquashfs or unsquashfs can't handle.'''
+    logical = sum(os.lstat(join(top, f)).st_size
+                  for top, _dirs, files in os.walk(rootdir) for f in files)
+    results = []
+    for name, compression, compressargs in candidates:
+        img = join(workdir, "benchmark-%s.img" % name)
+        unpacked = join(workdir, "benchmark-%s" % name)
+        start = time.time()
+        try:
+            rc = mksquashfs(rootdir, img, compression, list(compressargs),
+                            processors, blocksize, memory)
+        except RuntimeError:
+            rc = -1
+        built = time.time() - start
+        if rc != 0:
+            logger.warning("mksquashfs can't build a %s image", name)
+            results.append((name, None, None, None))
+            continue
+        size = os.path.getsize(img)
+        start = time.time()
+        try:
+            rc = execWithRedirect("unsquashfs", ["-no-progress", "-d", unpacked, img])
+        except RuntimeError:
+            rc = -1
+        readback = time.time() - start
+        if rc != 0:
+            logger.warning("unsquashfs can't read a %s image", name)
+        results.append((name, built, size, logical/readback if rc == 0 else None))
+        for path in (img, unpacked):
+            if os.path.exists(path):
+                remove(path)
+    return results
+
+def mkrootfsimg(rootdir, outfile, label, size=2, sysroot="", sizes=None, direct=False,
+                free=None):
     """
     Make rootfs image from a directory
 
@@ -95,20 +370,75 @@ def mkrootfsimg(rootdir, outfile, label, size=2, sysroot=""):
     :param str label: Filesystem label
     :param int size: Size of the image in GiB, if None computed automatically
     :param str sysroot: path to system (deployment) root relative to physical root
+    :param TreeSize sizes: sizes of rootdir, if already collected
+    :param bool direct: populate the image without a loop device if mke2fs can,
+                        see mkfsimage. The SELinux labels are then set on rootdir
+                        itself and copied into the image with the other xattrs.
+    :param int free: with size None, build the image with room to spare and then
+                     shrink it to what the tree needs plus this many bytes
+
+    The free blocks of the image are discarded either way, see compact_ext4img.
     """
     if size:
         fssize = size * (1024*1024*1024) # 2GB sparse file compresses down to nothin'
+    elif free is not None:
+        # too big is fine, compact_ext4img shrinks it afterwards
+        fssize = int(estimate_size(rootdir, fstype="ext4", sizes=sizes) * 1.2) + free
     else:
         fssize = None       # Let mkext4img figure out the needed size
 
-    mkext4img(rootdir, outfile, label=label, size=fssize)
-    # Reset selinux context on new rootfs
-    with LoopDev(outfile) as loopdev:
-        with Mount(loopdev) as mnt:
-            cmd = [ "setfiles", "-e", "/proc", "-e", "/sys", "-e", "/dev", "-e", "/install",
-                    "/etc/selinux/targeted/contexts/files/file_contexts", "/"]
-            root = join(mnt, sysroot.lstrip("/"))
-            runcmd(cmd, root=root)
+    cmd = [ "setfiles", "-e", "/proc", "-e", "/sys", "-e", "/dev", "-e", "/install",
+            "/etc/selinux/targeted/contexts/files/file_contexts", "/"]
+    if direct and can_populate("ext4", rootdir):
+        runcmd(cmd, root=join(rootdir, sysroot.lstrip("/")))
+        mkext4img(rootdir, outfile, label=label, size=fssize, sizes=sizes, direct=True)
+    else:
+        mkext4img(rootdir, outfile, label=label, size=fssize, sizes=sizes)
+        # Reset selinux context on new rootfs
+        with LoopDev(outfile) as loopdev:
+            with Mount(loopdev) as mnt:
+                root = join(mnt, sysroot.lstrip("/"))
+                runcmd(cmd, root=root)
+
+    compact_ext4img(outfile, free=None if size else free)
+
+def e2fsck(outfile, *args):
+    '''Force a check of the ext2/3/4 image outfile, answering yes to any
+    question. Raises CalledProcessError unless it is clean or was fixed.'''
+    argv = ["-f", "-y"] + list(args) + [outfile]
+    rc = execWithRedirect("e2fsck", argv)
+    if rc not in (0, 1):
+        raise CalledProcessError(rc, ["e2fsck"] + argv)
+
+def ext4_blocks(outfile):
+    '''Return (block size, block count) of the ext2/3/4 image outfile'''
+    fields = dict(l.split(":", 1) for l in runcmd_output(["dumpe2fs", "-h", outfile]).splitlines()
+                  if ":" in l)
+    return int(fields["Block size"]), int(fields["Block count"])
+
+def compact_ext4img(outfile, free=None):
+    '''Discard the free blocks of the ext2/3/4 image outfile so that they are
+    holes reading back as zeros, whatever the copy left in them; mksquashfs
+    then compresses them away. If free is not None the filesystem is first
+    resized to the smallest size holding its contents plus free bytes, and
+    the file truncated to match.'''
+    e2fsck(outfile)
+    if free is not None:
+        blocksize, blocks = ext4_blocks(outfile)
+        out = runcmd_output(["resize2fs", "-P", outfile])
+        minimum = int(out.split("minimum size of the filesystem:")[1].split()[0])
+        target = minimum + (free + blocksize - 1) / blocksize
+        if target < blocks:
+            runcmd(["resize2fs", outfile, str(target)])
+            with open(outfile, "r+") as f:
+                os.ftruncate(f.fileno(), target * blocksize)
+            logger.debug("shrank %s from %i to %i blocks", outfile, blocks, target)
+    e2fsck(outfile, "-E", "discard")
+
+def image_sizes(path):
+    '''Return (logical size, bytes allocated) of the file at path'''
+    st = os.stat(path)
+    return st.st_size, st.st_blocks * 512
 
 def mkdiskfsimage(diskimage, fsimage, label="Anaconda"):
     """
@@ -145,62 +475,231 @@ def mkqcow2(outfile, size, options=None):
         options.extend(["-f", "qcow2"])
     runcmd(["qemu-img", "create"] + options + [outfile, str(size)])
 
-def loop_waitfor(loop_dev, outfile):
-    """Make sure the loop device is attached to the outfile.
+######## Loop and device-mapper devices ##################################
+
+# linux/loop.h
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+LO_NAME_SIZE = 64
+# struct loop_info64
+LOOP_INFO64 = "=5Q4I%ds%ds32s2Q" % (LO_NAME_SIZE, LO_NAME_SIZE)
+# asm-generic/fcntl.h, python 2's os module doesn't have it
+O_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
 
-    It seems that on rare occasions losetup can return before the /dev/loopX is
-    ready for use, causing problems with mkfs. This tries to make sure that the
-    loop device really is associated with the backing file before continuing.
+NETLINK_KOBJECT_UEVENT = 15
+UDEV_EVENTS = 2   # multicast group of events udevd has finished processing
+DEVICE_TIMEOUT = 30
+
+class UeventMonitor(object):
+    '''Listen for device events while setting up a device, so we can wait
+    for it to be ready without sleeping.
+    Open the monitor *before* acting so the event can't be missed:
+
+        with UeventMonitor() as events:
+            runcmd([...])
+            events.wait(lambda: os.path.exists(path))
+    '''
+    def __init__(self):
+        self.sock = None
+    def __enter__(self):
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                      NETLINK_KOBJECT_UEVENT)
+            self.sock.bind((0, UDEV_EVENTS))
+        except (socket.error, AttributeError) as e:
+            logger.debug("can't listen for device events: %s", e)
+            self.sock = None
+        return self
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
 
-    Raise RuntimeError if it isn't setup after 5 tries.
+    def wait(self, ready, timeout=DEVICE_TIMEOUT):
+        '''Wait until ready() returns True; it is checked again whenever a device
+        event arrives. If there is no event source, or nothing happens before
+        the timeout, fall back to a single udevadm settle.
+        Raises RuntimeError if the device still isn't ready.'''
+        deadline = time.time() + timeout
+        while not ready():
+            remaining = deadline - time.time()
+            if not self.sock or remaining <= 0:
+                execWithRedirect("udevadm", ["settle", "--timeout", str(timeout)])
+                if ready():
+                    break
+                raise RuntimeError("device not ready after %ds" % timeout)
+            try:
+                readable, _, _ = select.select([self.sock], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            # drain everything queued, then check again
+            while readable:
+                try:
+                    self.sock.recv(65536, socket.MSG_DONTWAIT)
+                except socket.error:
+                    readable = None
+
+class DevicePool(object):
+    '''Hands out loop and device-mapper devices to image builders, which may
+    run concurrently, and removes whatever is still attached at exit.
+
+    Loop devices are attached with the loop-control ioctls rather than
+    losetup; the pool holds the device open and sets the autoclear flag, so
+    the kernel detaches it even if we die without cleaning up. Device-mapper
+    names come from a per-process counter.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loops = {}     # loop device -> open fd
+        self.dms = []       # device-mapper names, in creation order
+        self.counter = 0
+        atexit.register(self.cleanup)
+
+    def _loop_setup(self, outfile):
+        '''Attach outfile to a free loop device and return (device, fd)'''
+        # everything is opened close-on-exec from the start, so a command
+        # forked by another builder thread can't inherit the loop device and
+        # keep autoclear from releasing it
+        flags = os.O_RDWR | O_CLOEXEC
+        lo_flags = LO_FLAGS_AUTOCLEAR
+        try:
+            backing = os.open(outfile, flags)
+        except OSError as e:
+            if e.errno not in (errno.EACCES, errno.EROFS):
+                raise
+            flags = os.O_RDONLY | O_CLOEXEC
+            lo_flags |= LO_FLAGS_READ_ONLY
+            backing = os.open(outfile, flags)
+        try:
+            control = os.open("/dev/loop-control", os.O_RDWR | O_CLOEXEC)
+            try:
+                while True:
+                    dev = "/dev/loop%d" % fcntl.ioctl(control, LOOP_CTL_GET_FREE)
+                    fd = os.open(dev, flags)
+                    try:
+                        fcntl.ioctl(fd, LOOP_SET_FD, backing)
+                    except IOError as e:
+                        os.close(fd)
+                        # someone else got there first, ask for another one
+                        if e.errno == errno.EBUSY:
+                            continue
+                        raise
+                    break
+            finally:
+                os.close(control)
+        finally:
+            os.close(backing)
+        try:
+            name = os.path.abspath(outfile)[:LO_NAME_SIZE-1]
+            info = struct.pack(LOOP_INFO64, 0, 0, 0, 0, 0, 0, 0, 0, lo_flags,
+                               name, "", "", 0, 0)
+            fcntl.ioctl(fd, LOOP_SET_STATUS64, info)
+        except IOError:
+            fcntl.ioctl(fd, LOOP_CLR_FD)
+            os.close(fd)
+            raise
+        return dev, fd
+
+    def loop_attach(self, outfile):
+        '''Attach a loop device to outfile and return its name, once udev is done with it.'''
+        if not os.path.exists("/dev/loop-control"):
+            return _losetup_attach(outfile)
+        with UeventMonitor() as events:
+            with self.lock:
+                dev, fd = self._loop_setup(outfile)
+                self.loops[dev] = fd
+            logger.debug("attached %s to %s", dev, outfile)
+            events.wait(lambda: os.path.exists(dev) and
+                        get_loop_name(outfile) == os.path.basename(dev))
+        return dev
+
+    def loop_detach(self, loopdev):
+        '''Detach a loop device. Return False on failure.'''
+        with self.lock:
+            fd = self.loops.pop(loopdev, None)
+        if fd is None:
+            return (execWithRedirect("losetup", ["--detach", loopdev]) == 0)
+        try:
+            # if it is still busy the kernel clears it on last close (autoclear)
+            fcntl.ioctl(fd, LOOP_CLR_FD)
+        except IOError as e:
+            if e.errno != errno.ENXIO:
+                logger.error("failed to detach %s: %s", loopdev, e)
+                return False
+        finally:
+            os.close(fd)
+        return True
+
+    def dm_name(self):
+        '''Return a device-mapper name that nothing else is using'''
+        with self.lock:
+            self.counter += 1
+            return "lorax.imgutils.%d.%d" % (os.getpid(), self.counter)
+
+    def dm_attach(self, dev, size, name=None):
+        '''Map dev to /dev/mapper/<name> and return the name once the node exists.'''
+        if name is None:
+            name = self.dm_name()
+        with UeventMonitor() as events:
+            runcmd(["dmsetup", "create", name, "--table",
+                               "0 %i linear %s 0" % (size/512, dev)])
+            with self.lock:
+                self.dms.append(name)
+            events.wait(lambda: os.path.exists("/dev/mapper/"+name))
+        return name
+
+    def dm_detach(self, dev):
+        '''Remove a device-mapper device. Returns False if dmsetup fails.'''
+        name = dev.replace("/dev/mapper/", "") # strip prefix, if it's there
+        rc = execWithRedirect("dmsetup", ["remove", name])
+        # keep it for cleanup() to try again if it couldn't be removed
+        if rc == 0:
+            with self.lock:
+                if name in self.dms:
+                    self.dms.remove(name)
+        return rc
+
+    def cleanup(self):
+        '''Remove every device the pool still has, newest first.'''
+        for name in reversed(self.dms[:]):
+            logger.warning("removing leftover device-mapper device %s", name)
+            self.dm_detach(name)
+        for dev in sorted(self.loops.keys(), reverse=True):
+            logger.warning("detaching leftover loop device %s", dev)
+            self.loop_detach(dev)
+
+devices = DevicePool()
+
+def _losetup_attach(outfile):
+    """Attach a loop device to the given file with losetup, for systems
+    without /dev/loop-control. Return the loop device name.
+
+    Raises CalledProcessError if losetup fails.
     """
-    for _ in xrange(0,5):
-        runcmd(["udevadm", "settle", "--timeout", "300"])
+    with UeventMonitor() as events:
+        dev = runcmd_output(["losetup", "--find", "--show", outfile]).strip()
         ## XXX Note that losetup --list output can be truncated to 64 bytes in some
         ##     situations. Don't use it to lookup backing file, go the other way
         ##     and lookup the loop for the backing file. See util-linux lib/loopdev.c
         ##     loopcxt_get_backing_file()
-        if get_loop_name(outfile) == os.path.basename(loop_dev):
-            return
-
-        # If this really is a race, give it some time to settle down
-        time.sleep(1)
-
-    raise RuntimeError("Unable to setup %s on %s" % (loop_dev, outfile))
+        events.wait(lambda: get_loop_name(outfile) == os.path.basename(dev))
+    return dev
 
 def loop_attach(outfile):
     """Attach a loop device to the given file. Return the loop device name.
 
-    On rare occasions it appears that the device never shows up, some experiments
-    seem to indicate that it may be a race with another process using /dev/loop* devices.
-
-    So we now try 3 times before actually failing.
-
-    Raises CalledProcessError if losetup fails.
+    Raises RuntimeError if the device doesn't become ready.
     """
-    retries = 0
-    while True:
-        try:
-            retries += 1
-            dev = runcmd_output(["losetup", "--find", "--show", outfile]).strip()
-
-            # Sometimes the loop device isn't ready yet, make extra sure before returning
-            loop_waitfor(dev, outfile)
-        except CalledProcessError:
-            # Problems running losetup are always errors, raise immediately
-            raise
-        except RuntimeError as e:
-            # Try to setup the loop device 3 times
-            if retries == 3:
-                logger.error("loop_attach failed, retries exhausted.")
-                raise
-            logger.debug("Try %d failed, %s did not appear.", retries, dev)
-        break
-    return dev
+    return devices.loop_attach(outfile)
 
 def loop_detach(loopdev):
     '''Detach the given loop device. Return False on failure.'''
-    return (execWithRedirect("losetup", ["--detach", loopdev]) == 0)
+    return devices.loop_detach(loopdev)
 
 def get_loop_name(path):
     '''Return the loop device associated with the path.
@@ -214,18 +713,13 @@ def get_loop_name(path):
 
 def dm_attach(dev, size, name=None):
     '''Attach a devicemapper device to the given device, with the given size.
-    If name is None, a random name will be chosen. Returns the device name.
+    If name is None, a unique name will be chosen. Returns the device name.
     raises CalledProcessError if dmsetup fails.'''
-    if name is None:
-        name = tempfile.mktemp(prefix="lorax.imgutils.", dir="")
-    runcmd(["dmsetup", "create", name, "--table",
-                       "0 %i linear %s 0" % (size/512, dev)])
-    return name
+    return devices.dm_attach(dev, size, name)
 
 def dm_detach(dev):
     '''Detach the named devicemapper device. Returns False if dmsetup fails.'''
-    dev = dev.replace("/dev/mapper/", "") # strip prefix, if it's there
-    return execWithRedirect("dmsetup", ["remove", dev])
+    return devices.dm_detach(dev)
 
 def mount(dev, opts="", mnt=None):
     '''Mount the given device at the given mountpoint, using the given opts.
@@ -272,14 +766,16 @@ def umount(mnt,  lazy=False, maxretry=3, retrysleep=1.0):
     return (rv == 0)
 
 def copytree(src, dest, preserve=True):
-    '''Copy a tree of files using cp -a, thus preserving modes, timestamps,
-    links, acls, sparse files, xattrs, selinux contexts, etc.
+    '''Copy a tree of files like cp -a, thus preserving modes, timestamps,
+    links, acls, sparse files, xattrs, selinux contexts, etc; reflinked or
+    with parallel cp where possible, see treecopy.copy_tree.
     If preserve is False, uses cp -R (useful for modeless filesystems)
     raises CalledProcessError if copy fails.'''
     logger.debug("copytree %s %s", src, dest)
-    cp = ["cp", "-a"] if preserve else ["cp", "-R", "-L"]
-    cp += [".", os.path.abspath(dest)]
-    runcmd(cp, cwd=src)
+    if preserve:
+        copy_tree(src, dest)
+        return
+    runcmd(["cp", "-R", "-L", ".", os.path.abspath(dest)], cwd=src)
 
 def do_grafts(grafts, dest, preserve=True):
     '''Copy each of the items listed in grafts into dest.
@@ -305,26 +801,111 @@ def round_to_blocks(size, blocksize):
         size += blocksize - diff
     return size
 
+class TreeSize(object):
+    '''The lstat results for everything under roots (not the roots
+    themselves), collected on parallel threads. It can be shared by
+    everything that needs sizes of the same tree, see estimate_size()
+    and RuntimeBuilder.writepkgsizes().'''
+    def __init__(self, roots, workers=None):
+        self.roots = [os.path.normpath(r) for r in roots]
+        self.entries = {}
+        self._walk(workers or multiprocessing.cpu_count())
+
+    def _walk(self, workers):
+        todo = Queue.Queue()
+        errors = []
+
+        def worker():
+            while True:
+                top = todo.get()
+                if top is None:
+                    return
+                try:
+                    # like os.walk, unreadable directories are skipped
+                    names = os.listdir(top)
+                except OSError:
+                    names = []
+                try:
+                    found = {}
+                    for name in names:
+                        path = join(top, name)
+                        st = os.lstat(path)
+                        found[path] = st
+                        if stat.S_ISDIR(st.st_mode):
+                            todo.put(path)
+                    self.entries.update(found)
+                except OSError as e:
+                    errors.append(e)
+                finally:
+                    todo.task_done()
+
+        for root in self.roots:
+            if os.path.isdir(root):
+                todo.put(root)
+
+        threads = [threading.Thread(target=worker) for _ in xrange(workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        todo.join()
+        for t in threads:
+            todo.put(None)
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+
+    def size(self, path):
+        '''Return the size of path, 0 if it doesn't exist (or is a dangling
+        symlink) like os.lstat(f).st_size if os.path.exists(f) else 0'''
+        path = os.path.normpath(path)
+        st = self.entries.get(path)
+        if st is None:
+            return os.lstat(path).st_size if os.path.exists(path) else 0
+        if stat.S_ISLNK(st.st_mode) and not os.path.exists(path):
+            return 0
+        return st.st_size
+
+    def total(self, blocksize=4096, follow_symlinks=False):
+        '''Return the space everything takes with each file rounded up to
+        blocksize. Hardlinked files are counted once, unless follow_symlinks
+        is set for filesystems that store symlinks and hardlinks as copies.'''
+        total = 0
+        seen = set()
+        for path, st in self.entries.iteritems():
+            if follow_symlinks:
+                if stat.S_ISLNK(st.st_mode):
+                    st = os.stat(path)
+            elif st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += round_to_blocks(st.st_size, blocksize)
+        return total
+
 # TODO: move filesystem data outside this function
-def estimate_size(rootdir, graft=None, fstype=None, blocksize=4096, overhead=128):
+def estimate_size(rootdir, graft=None, fstype=None, blocksize=4096, overhead=128, sizes=None):
+    '''Estimate the size of a filesystem holding rootdir and graft.
+    sizes is a TreeSize to reuse, it is only used if it covers exactly the
+    same directories.'''
     if graft is None:
         graft = {}
-    getsize = lambda f: os.lstat(f).st_size
+    follow_symlinks = False
     if fstype == "btrfs":
         overhead = 64*1024 # don't worry, it's all sparse
     if fstype == "hfsplus":
         overhead = 200 # hack to deal with two bootloader copies
     if fstype in ("vfat", "msdos"):
         blocksize = 2048
-        getsize = lambda f: os.stat(f).st_size # no symlinks, count as copies
+        follow_symlinks = True # no symlinks, count as copies
     total = overhead*blocksize
     dirlist = graft.values()
     if rootdir:
         dirlist.append(rootdir)
-    for root in dirlist:
-        for top, dirs, files in os.walk(root):
-            for f in files + dirs:
-                total += round_to_blocks(getsize(join(top,f)), blocksize)
+    if sizes is None or sorted(sizes.roots) != sorted(os.path.normpath(d) for d in dirlist):
+        sizes = TreeSize(dirlist)
+    total += sizes.total(blocksize, follow_symlinks)
     if fstype == "btrfs":
         total = max(256*1024*1024, total) # btrfs minimum size: 256MB
     return total
@@ -439,11 +1020,36 @@ class PartitionMount(object):
 
 ######## Functions for making filesystem images ##########################
 
-def mkfsimage(fstype, rootdir, outfile, size=None, mkfsargs=None, mountargs="", graft=None):
+_mke2fs_populates = None
+
+def mke2fs_populates():
+    '''Return True if mke2fs can copy a directory into the new filesystem
+    (mke2fs -d, e2fsprogs 1.43 and later)'''
+    global _mke2fs_populates
+    if _mke2fs_populates is None:
+        try:
+            (out, err) = Popen(["mke2fs"], stdout=PIPE, stderr=PIPE).communicate()
+            _mke2fs_populates = "-d root-directory" in out + err
+        except OSError:
+            _mke2fs_populates = False
+        logger.debug("mke2fs -d is %savailable", "" if _mke2fs_populates else "not ")
+    return _mke2fs_populates
+
+def can_populate(fstype, rootdir, graft=None):
+    '''Return True if mkfsimage can build this image without a loop device'''
+    return fstype in ("ext2", "ext3", "ext4") and not graft \
+           and (not rootdir or mke2fs_populates())
+
+def mkfsimage(fstype, rootdir, outfile, size=None, mkfsargs=None, mountargs="", graft=None, sizes=None,
+              direct=False):
     '''Generic filesystem image creation function.
     fstype should be a filesystem type - "mkfs.${fstype}" must exist.
     graft should be a dict: {"some/path/in/image": "local/file/or/dir"};
       if the path ends with a '/' it's assumed to be a directory.
+    If direct is True and can_populate() allows it, mkfs writes the
+      filesystem and rootdir's contents (with xattrs) straight into outfile;
+      no loop device, mount, copy or sync is needed. Otherwise the image is
+      attached to a loop device, mounted and rootdir copied into it.
     Will raise CalledProcessError if something goes wrong.'''
     if mkfsargs is None:
         mkfsargs = []
@@ -451,7 +1057,21 @@ def mkfsimage(fstype, rootdir, outfile, size=None, mkfsargs=None, mountargs="",
         graft = {}
     preserve = (fstype not in ("msdos", "vfat"))
     if not size:
-        size = estimate_size(rootdir, graft, fstype)
+        size = estimate_size(rootdir, graft, fstype, sizes=sizes)
+    if direct and not can_populate(fstype, rootdir, graft):
+        logger.info("can't populate a %s image directly, using a loop device", fstype)
+        direct = False
+    if direct:
+        mksparse(outfile, size)
+        populate = ["-d", rootdir] if rootdir else []
+        try:
+            runcmd(["mkfs.%s" % fstype, "-F"] + mkfsargs + populate + [outfile])
+        except CalledProcessError as e:
+            logger.error("mkfs exited with a non-zero return code: %d", e.returncode)
+            logger.error(e.output)
+            sys.exit(e.returncode)
+        return
+
     with LoopDev(outfile, size) as loopdev:
         try:
             runcmd(["mkfs.%s" % fstype] + mkfsargs + [loopdev])
@@ -473,9 +1093,11 @@ def mkdosimg(rootdir, outfile, size=None, label="", mountargs="shortname=winnt,u
     mkfsimage("msdos", rootdir, outfile, size, mountargs=mountargs,
               mkfsargs=["-n", label], graft=graft)
 
-def mkext4img(rootdir, outfile, size=None, label="", mountargs="", graft=None):
+def mkext4img(rootdir, outfile, size=None, label="", mountargs="", graft=None, sizes=None,
+              direct=False):
     mkfsimage("ext4", rootdir, outfile, size, mountargs=mountargs,
-              mkfsargs=["-L", label, "-b", "1024", "-m", "0"], graft=graft)
+              mkfsargs=["-L", label, "-b", "1024", "-m", "0"], graft=graft, sizes=sizes,
+              direct=direct)
 
 def mkbtrfsimg(rootdir, outfile, size=None, label="", mountargs="", graft=None):
     mkfsimage("btrfs", rootdir, outfile, size, mountargs=mountargs,
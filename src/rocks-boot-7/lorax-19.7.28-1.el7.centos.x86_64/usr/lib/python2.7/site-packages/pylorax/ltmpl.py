@@ -23,7 +23,8 @@
 import logging
 logger = logging.getLogger("pylorax.ltmpl")
 
-import os, re, glob, shlex, fnmatch
+import os, re, glob, shlex, fnmatch, stat
+import hashlib, marshal, time
 from os.path import basename, isdir
 from subprocess import CalledProcessError
 import shutil
@@ -39,17 +40,63 @@ from mako.exceptions import text_error_template
 import sys, traceback
 import struct
 
+class TemplateCache(object):
+    '''On-disk cache for templates.
+
+    Mako keeps the compiled python module of each template under
+    cachedir/mako and only recompiles it when the template changes. The
+    split and brace-expanded command lines are kept under cachedir/lines,
+    keyed by a hash of the rendered text. The templates call glob() and
+    exists() on the tree they run on, so the rendering itself can't be
+    cached by template and variables alone.'''
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self._lines = dict()
+
+    def lookup(self, directories):
+        return TemplateLookup(directories=directories,
+                              module_directory=joinpaths(self.cachedir, "mako"))
+
+    def key(self, textbuf):
+        return hashlib.sha256(textbuf.encode("utf8")).hexdigest()
+
+    def fetch(self, key):
+        if key not in self._lines:
+            try:
+                with open(joinpaths(self.cachedir, "lines", key), "rb") as f:
+                    self._lines[key] = marshal.load(f)
+            except (IOError, OSError, EOFError, ValueError, TypeError):
+                return None
+        return self._lines[key]
+
+    def store(self, key, lines):
+        self._lines[key] = lines
+        linesdir = joinpaths(self.cachedir, "lines")
+        try:
+            if not isdir(linesdir):
+                os.makedirs(linesdir)
+            tmpfile = joinpaths(linesdir, "%s.%d" % (key, os.getpid()))
+            with open(tmpfile, "wb") as f:
+                marshal.dump(lines, f)
+            os.rename(tmpfile, joinpaths(linesdir, key))
+        except (IOError, OSError) as e:
+            logger.warning("could not cache template lines: %s", e)
+
 class LoraxTemplate(object):
-    def __init__(self, directories=None):
+    def __init__(self, directories=None, cache=None):
         if directories is None:
             directories = ["/usr/share/lorax"]
         # we have to add ["/"] to the template lookup directories or the
         # file includes won't work properly for absolute paths
         self.directories = ["/"] + directories
+        self.cache = cache
         self.lines = []
 
     def parse(self, template_file, variables):
-        lookup = TemplateLookup(directories=self.directories)
+        if self.cache:
+            lookup = self.cache.lookup(self.directories)
+        else:
+            lookup = TemplateLookup(directories=self.directories)
         template = lookup.get_template(template_file)
 
         try:
@@ -58,6 +105,14 @@ class LoraxTemplate(object):
             logger.error(text_error_template().render())
             raise
 
+        key = None
+        if self.cache:
+            key = self.cache.key(textbuf)
+            lines = self.cache.fetch(key)
+            if lines is not None:
+                self.lines = lines
+                return lines
+
         # split, strip and remove empty lines
         lines = textbuf.splitlines()
         lines = map(lambda line: line.strip(), lines)
@@ -78,6 +133,8 @@ class LoraxTemplate(object):
         except Exception as e:
             logger.error('shlex error processing "%s": %s', line, str(e))
             raise
+        if key:
+            self.cache.store(key, expanded_lines)
         self.lines = expanded_lines
         return expanded_lines
 
@@ -112,6 +169,244 @@ def rexists(pathname, root=""):
         return True
     return False
 
+class GlobMatcher(object):
+    '''Match paths against a list of fnmatch globs in one regex pass
+    instead of one pass per glob. Python's re only allows 100 groups,
+    so every 99 globs get a regex of their own.'''
+    def __init__(self, globs):
+        self.globs = list(globs)
+        self._regexes = []
+        for offset in range(0, len(self.globs), 99):
+            alternatives = []
+            for g in self.globs[offset:offset+99]:
+                pattern = fnmatch.translate(g)
+                if pattern.endswith("\\Z(?ms)"):
+                    pattern = pattern[:-len("\\Z(?ms)")]
+                alternatives.append("(%s)" % pattern)
+            regex = re.compile("(?ms)(?:%s)\\Z" % "|".join(alternatives))
+            self._regexes.append((offset, regex))
+
+    def match(self, path):
+        '''Return the index of the first glob matching path, or None'''
+        for offset, regex in self._regexes:
+            m = regex.match(path)
+            if m:
+                return offset + m.lastindex - 1
+        return None
+
+    def partition(self, paths):
+        '''Return (the paths matching any glob, the globs matching nothing)'''
+        matches, hit = set(), set()
+        for p in paths:
+            idx = self.match(p)
+            if idx is not None:
+                matches.add(p)
+                hit.add(idx)
+        # a glob may only match paths an earlier glob already claimed
+        unmatched = []
+        for idx, g in enumerate(self.globs):
+            if idx not in hit:
+                regex = re.compile(fnmatch.translate(g))
+                if not any(regex.match(p) for p in matches):
+                    unmatched.append(g)
+        return matches, unmatched
+
+# the forms of a package name that yum package patterns are matched against
+PACKAGE_NAME_FORMS = ("{0.name}", "{0.name}.{0.arch}", "{0.name}-{0.version}",
+                      "{0.name}-{0.version}-{0.release}",
+                      "{0.name}-{0.version}-{0.release}.{0.arch}",
+                      "{0.epoch}:{0.name}-{0.version}-{0.release}.{0.arch}",
+                      "{0.name}-{0.epoch}:{0.version}-{0.release}.{0.arch}")
+
+class PackageIndex(object):
+    '''The files of the installed packages, read from the rpmdb once and
+    kept until the rpmdb changes: run_pkg_transaction() invalidates it, and
+    it is reread whenever the rpmdb in the installroot has been replaced or
+    written to (eg. a restored tree). Sizes of the files are cached too;
+    they are the sizes as installed, files removed since then still count.'''
+    def __init__(self, yum_obj):
+        self.yum = yum_obj
+        self._stamp = None
+        self._packages = None # [(set of names, set of files), ...]
+        self._owners = None
+        self._sizes = dict()
+
+    def _rpmdb_stamp(self):
+        try:
+            st = os.stat(joinpaths(self.yum.conf.installroot, "var/lib/rpm/Packages"))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def invalidate(self):
+        self._packages = None
+        self._owners = None
+        self._sizes = dict()
+
+    def _index(self):
+        stamp = self._rpmdb_stamp()
+        if self._packages is not None and stamp == self._stamp:
+            return self._packages
+        start = time.time()
+        self.invalidate()
+        self._stamp = stamp
+        self._packages, self._owners = [], dict()
+        for po in self.yum.doPackageLists(pkgnarrow="installed").installed:
+            files = set(po.filelist + po.ghostlist)
+            self._packages.append((set(n.format(po) for n in PACKAGE_NAME_FORMS), files))
+            for f in files:
+                owners = self._owners.setdefault(f, [])
+                if po.name not in owners:
+                    owners.append(po.name)
+        logger.debug("indexed %i files from %i installed packages in %.2fs",
+                     len(self._owners), len(self._packages), time.time()-start)
+        return self._packages
+
+    def filelist(self, *patterns):
+        '''The files of the installed packages matching any of the patterns'''
+        exact = set(p for p in patterns if not glob.has_magic(p))
+        globs = [p for p in patterns if glob.has_magic(p)]
+        filelist = set()
+        for names, files in self._index():
+            if names & exact or any(fnmatch.fnmatchcase(n, g) for g in globs for n in names):
+                filelist.update(files)
+        return filelist
+
+    def owners(self, path):
+        '''The names of the installed packages owning path'''
+        self._index()
+        return self._owners.get(path, [])
+
+    def size(self, path):
+        if path not in self._sizes:
+            self._sizes[path] = os.path.getsize(path) if os.path.isfile(path) else 0
+        return self._sizes[path]
+
+# template commands that only delete things, see RemovalBatch
+REMOVE_COMMANDS = ("remove", "removefrom", "removekmod", "removepkg")
+
+class RemovalBatch(object):
+    '''Files queued by a run of consecutive remove/removefrom/removekmod/
+    removepkg template commands, deleted together by flush().
+
+    Removals don't depend on each other, so the paths are collected into
+    one set (package filelists overlap a lot), globs share one cache of
+    directory listings so no directory is read twice, and everything is
+    deleted in one pass with paths under removed directories skipped.
+
+    Set line to (line number, line, skiperror) before each command adds to
+    the batch; failures are reported against the line that queued the path
+    and ignored if that line had skiperror.'''
+    def __init__(self):
+        self.paths = dict()     # path -> line that queued it
+        self.globs = []         # (glob, line)
+        self.line = (0, "", False)
+        self.commands = 0
+        self.queued = 0
+        self._listings = dict()
+        self.listings_read = 0
+        self.listings_reused = 0
+        self.listing_time = 0.0
+
+    @staticmethod
+    def _norm(path):
+        return os.path.normpath("/" + path.lstrip("/"))
+
+    def _add(self, path, line):
+        # a line that doesn't skip errors wins over one that does
+        if self.paths.get(path, (0, "", True))[2]:
+            self.paths[path] = line
+
+    def add_paths(self, paths):
+        for p in paths:
+            self.queued += 1
+            self._add(self._norm(p), self.line)
+
+    def add_globs(self, globs):
+        for g in globs:
+            if glob.has_magic(g):
+                self.globs.append((self._norm(g), self.line))
+            else:
+                self.add_paths([g])
+
+    def _listdir(self, path):
+        if path in self._listings:
+            self.listings_reused += 1
+        else:
+            start = time.time()
+            try:
+                self._listings[path] = os.listdir(path)
+            except OSError:
+                self._listings[path] = []
+            self.listings_read += 1
+            self.listing_time += time.time() - start
+        return self._listings[path]
+
+    def saved_time(self):
+        '''Estimated seconds the shared listings saved over each glob
+        reading its directories itself'''
+        if not self.listings_read:
+            return 0.0
+        return self.listings_reused * self.listing_time / self.listings_read
+
+    def _glob(self, pattern):
+        '''glob.glob() for an absolute pattern, using the shared listings'''
+        parts = pattern.strip("/").split("/")
+        bases = ["/"]
+        for i, part in enumerate(parts):
+            last = (i == len(parts)-1)
+            if glob.has_magic(part):
+                # like glob, wildcards don't match dotfiles
+                bases = [os.path.join(b, n) for b in bases
+                         for n in fnmatch.filter(self._listdir(b), part)
+                         if part[0] == '.' or n[0] != '.']
+            elif last:
+                bases = [os.path.join(b, part) for b in bases]
+            else:
+                bases = [os.path.join(b, part) for b in bases
+                         if isdir(os.path.join(b, part))]
+            if not bases:
+                break
+        return bases
+
+    def flush(self):
+        '''Delete everything queued. Returns (paths removed, bytes freed,
+        errors), errors being a list of (line, exception) for the failures
+        whose line didn't have skiperror.'''
+        for g, line in self.globs:
+            for path in self._glob(g):
+                self._add(path, line)
+
+        removed, freed, errors = 0, 0, []
+        for path in sorted(self.paths):
+            # skip anything inside a directory that is going away anyway
+            parent = os.path.dirname(path)
+            while parent != "/" and parent not in self.paths:
+                parent = os.path.dirname(parent)
+            if parent in self.paths:
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            try:
+                if stat.S_ISDIR(st.st_mode):
+                    for top, _dirs, files in os.walk(path):
+                        for f in files:
+                            freed += os.lstat(os.path.join(top, f)).st_size
+                    shutil.rmtree(path)
+                else:
+                    freed += st.st_size
+                    os.unlink(path)
+                removed += 1
+            except (IOError, OSError) as e:
+                line = self.paths[path]
+                if line[2]:
+                    logger.debug("ignoring error removing %s: %s", path, e)
+                    continue
+                errors.append((line, e))
+        return removed, freed, errors
+
 # TODO: operate inside an actual chroot for safety? Not that RPM bothers..
 class LoraxTemplateRunner(object):
     '''
@@ -154,17 +449,33 @@ class LoraxTemplateRunner(object):
       on that line (after word splitting and brace expansion)
 
     * Commands should raise exceptions for errors - don't use sys.exit()
+
+    DRY RUNS:
+
+    * With dryrun=True the template is rendered and parsed as usual, but
+      instead of running each command the runner logs the files it would
+      act on (see _resolve()). Nothing in the trees is changed, errors are
+      logged and planning carries on with the next line.
+
+    * Every line is timed either way; the totals per command are logged
+      after each template and kept in self.profile.
     '''
     def __init__(self, inroot, outroot, yum_obj=None, fatalerrors=True,
-                                        templatedir=None, defaults=None):
+                                        templatedir=None, defaults=None,
+                                        cache=None, dryrun=False):
         if defaults is None:
             defaults = {}
         self.inroot = inroot
         self.outroot = outroot
         self.yum = yum_obj
+        self._packages = None # PackageIndex, see _package_index()
         self.fatalerrors = fatalerrors
         self.templatedir = templatedir or "/usr/share/lorax"
         self.templatefile = None
+        self.cache = cache
+        self.dryrun = dryrun
+        self.profile = [] # (templatefile, line number, line, seconds)
+        self._removals = None # RemovalBatch while running removal commands
         # some builtin methods
         self.builtins = DataHolder(exists=lambda p: rexists(p, root=inroot),
                                    glob=lambda g: list(rglob(g, root=inroot)))
@@ -177,27 +488,56 @@ class LoraxTemplateRunner(object):
     def _in(self, path):
         return joinpaths(self.inroot, path)
 
+    def _package_index(self):
+        if self._packages is None or self._packages.yum is not self.yum:
+            self._packages = PackageIndex(self.yum)
+        return self._packages
+
     def _filelist(self, *pkgs):
-        pkglist = self.yum.doPackageLists(pkgnarrow="installed", patterns=pkgs)
-        return set([f for pkg in pkglist.installed for f in pkg.filelist+pkg.ghostlist])
+        return self._package_index().filelist(*pkgs)
 
     def _getsize(self, *files):
-        return sum(os.path.getsize(self._out(f)) for f in files if os.path.isfile(self._out(f)))
+        index = self._package_index()
+        return sum(index.size(self._out(f)) for f in files)
 
     def run(self, templatefile, **variables):
         for k,v in self.defaults.items() + self.builtins.items():
             variables.setdefault(k,v)
         logger.debug("executing %s with variables=%s", templatefile, variables)
         self.templatefile = templatefile
-        t = LoraxTemplate(directories=[self.templatedir])
+        t = LoraxTemplate(directories=[self.templatedir], cache=self.cache)
         commands = t.parse(templatefile, variables)
         self._run(commands)
 
+    @classmethod
+    def _command_table(cls):
+        '''Map each template command name to its (unbound) method'''
+        table = cls.__dict__.get("_commands")
+        if table is None:
+            table = dict((name, getattr(cls, name)) for name in dir(cls)
+                         if name[0] != '_' and name != 'run'
+                         and callable(getattr(cls, name)))
+            cls._commands = table
+        return table
 
     def _run(self, parsed_template):
-        logger.info("running %s", self.templatefile)
+        logger.info("%s %s", "planning" if self.dryrun else "running", self.templatefile)
+        commands = self._command_table()
+        timings = dict()
+        removed = [0, 0, 0] # batches, paths, bytes
+        start = time.time()
+
+        def flush():
+            batchstart = time.time()
+            paths, freed = self._flush_removals()
+            count, total = timings.get("(removal batches)", (0, 0.0))
+            timings["(removal batches)"] = (count+1, total+time.time()-batchstart)
+            removed[0] += 1
+            removed[1] += paths
+            removed[2] += freed
+
+        self._removals = None
         for (num, line) in enumerate(parsed_template,1):
-            logger.debug("template line %i: %s", num, " ".join(line))
             skiperror = False
             (cmd, args) = (line[0], line[1:])
             # Following Makefile convention, if the command is prefixed with
@@ -205,12 +545,26 @@ class LoraxTemplateRunner(object):
             if cmd.startswith('-'):
                 cmd = cmd[1:]
                 skiperror = True
+            # consecutive removals are queued and done together before the
+            # next command that might depend on them
+            if cmd in REMOVE_COMMANDS and not self.dryrun:
+                if self._removals is None:
+                    self._removals = RemovalBatch()
+                self._removals.commands += 1
+                self._removals.line = (num, " ".join(line), skiperror)
+            elif self._removals is not None:
+                flush()
+            logger.debug("template line %i: %s", num, " ".join(line))
+            linestart = time.time()
             try:
                 # grab the method named in cmd and pass it the given arguments
-                f = getattr(self, cmd, None)
-                if cmd[0] == '_' or cmd == 'run' or not callable(f):
+                f = commands.get(cmd)
+                if f is None:
                     raise ValueError, "unknown command %s" % cmd
-                f(*args)
+                if self.dryrun:
+                    self._plan(num, line, cmd, args)
+                else:
+                    f(self, *args)
             except Exception:
                 if skiperror:
                     logger.debug("ignoring error")
@@ -226,8 +580,76 @@ class LoraxTemplateRunner(object):
                 # and log the entire traceback to the debug log
                 for l in ''.join(exclines).splitlines():
                     logger.debug("  " + l)
-                if self.fatalerrors:
+                if self.fatalerrors and not self.dryrun:
                     raise
+            finally:
+                elapsed = time.time() - linestart
+                self.profile.append((self.templatefile, num, " ".join(line), elapsed))
+                count, total = timings.get(cmd, (0, 0.0))
+                timings[cmd] = (count+1, total+elapsed)
+
+        if self._removals is not None:
+            flush()
+
+        logger.info("%s: %i commands in %.2fs", self.templatefile,
+                    len(parsed_template), time.time()-start)
+        if removed[0]:
+            logger.info("%s: removed %i paths (%ikb) in %i batches", self.templatefile,
+                        removed[1], removed[2]/1024, removed[0])
+        for cmd, (count, total) in sorted(timings.items(), key=lambda t: t[1][1], reverse=True):
+            logger.debug("  %-24s %6i %9.3fs", cmd, count, total)
+
+    def _flush_removals(self):
+        '''Delete the files queued by the current run of removal commands.
+        Returns (paths removed, bytes freed).'''
+        batch, self._removals = self._removals, None
+        duplicates = batch.queued - len(batch.paths)
+        paths, freed, errors = batch.flush()
+        logger.debug("removed %i paths (%ikb) for %i commands, skipped %i duplicate "
+                     "paths and %i directory reads (about %.3fs)", paths, freed/1024,
+                     batch.commands, duplicates, batch.listings_reused, batch.saved_time())
+        for (num, line, _skiperror), e in errors:
+            logger.error("template command error in %s:", self.templatefile)
+            logger.error("  line %i: %s", num, line)
+            logger.error("  %s: %s", type(e).__name__, e)
+        if errors and self.fatalerrors:
+            raise errors[0][1]
+        return paths, freed
+
+    def _plan(self, num, line, cmd, args):
+        paths = self._resolve(cmd, args)
+        if paths is None:
+            logger.info("plan %s:%i: %s", self.templatefile, num, " ".join(line))
+            return
+        logger.info("plan %s:%i: %s (%i files)", self.templatefile, num,
+                    " ".join(line), len(paths))
+        for p in sorted(paths):
+            logger.debug("  %s", p)
+
+    def _resolve(self, cmd, args):
+        '''Return the files cmd would act on given args, or None for commands
+        that don't work on files in the trees. This only reads the trees,
+        and raises the same errors the command would for missing files.'''
+        if cmd in ("install", "installimg"):
+            return list(rglob(self._in(args[0]), fatal=(cmd == "install")))
+        elif cmd in ("installkernel", "installinitrd", "installupgradeinitrd"):
+            return list(rglob(self._in(args[1]), fatal=True))
+        elif cmd in ("chmod", "copy", "move", "hardlink"):
+            return list(rglob(self._out(args[0]), fatal=True))
+        elif cmd == "replace":
+            paths = [f for g in args[2:] for f in rglob(self._out(g))]
+            if not paths:
+                raise IOError, "no files matched %s" % " ".join(args[2:])
+            return paths
+        elif cmd == "remove":
+            return [f for g in args for f in rglob(self._out(g))]
+        elif cmd == "removepkg":
+            return [f for p in args for f in self._filelist(p)]
+        elif cmd == "removefrom":
+            return list(self._removefrom_files(args[0], *args[1:])[1])
+        elif cmd == "removekmod":
+            return list(self._removekmod_files(*args))
+        return None
 
     def install(self, srcglob, dest):
         '''
@@ -396,6 +818,9 @@ class LoraxTemplateRunner(object):
           Remove all the named files or directories.
           Will *not* raise exceptions if the file(s) are not found.
         '''
+        if self._removals is not None:
+            self._removals.add_globs(self._out(g) for g in fileglobs)
+            return
         for g in fileglobs:
             for f in rglob(self._out(g)):
                 remove(f)
@@ -505,9 +930,17 @@ class LoraxTemplateRunner(object):
             Files are deleted, but directories are left behind.
         '''
         for p in pkgs:
-            filepaths = [f.lstrip('/') for f in self._filelist(p)]
+            filelist = self._filelist(p)
+            filepaths = [f.lstrip('/') for f in filelist]
+            shared = [f for f in filelist if len(self._package_index().owners(f)) > 1]
+            if shared:
+                logger.debug("removepkg %s: %i files are shared with other packages",
+                             p, len(shared))
             # TODO: also remove directories that aren't owned by anything else
-            if filepaths:
+            if filepaths and self._removals is not None:
+                logger.debug("removepkg %s: %i files", p, len(filepaths))
+                self._removals.add_paths(self._out(f) for f in filepaths)
+            elif filepaths:
                 logger.debug("removepkg %s: %ikb", p, self._getsize(*filepaths)/1024)
                 self.remove(*filepaths)
             else:
@@ -536,6 +969,7 @@ class LoraxTemplateRunner(object):
                 f.write("%s\n" % t.po)
 
         self.yum.closeRpmDB()
+        self._package_index().invalidate()
 
     def removefrom(self, pkg, *globs):
         '''
@@ -549,33 +983,36 @@ class LoraxTemplateRunner(object):
             removefrom xfsprogs --allbut /sbin/*
         '''
         cmd = "%s %s" % (pkg, " ".join(globs)) # save for later logging
+        filelist, files_to_remove = self._removefrom_files(pkg, *globs)
+        # remove the files
+        if files_to_remove and self._removals is not None:
+            logger.debug("%s: removing %i/%i files", cmd,
+                         len(files_to_remove), len(filelist))
+            self._removals.add_paths(self._out(f) for f in files_to_remove)
+        elif files_to_remove:
+            logger.debug("%s: removed %i/%i files, %ikb/%ikb", cmd,
+                             len(files_to_remove), len(filelist),
+                             self._getsize(*files_to_remove)/1024, self._getsize(*filelist)/1024)
+            self.remove(*files_to_remove)
+        else:
+            logger.debug("removefrom %s: no files to remove!", cmd)
+
+    def _removefrom_files(self, pkg, *globs):
+        '''Return the package filelist and the files removefrom would remove'''
         keepmatches = False
         if globs[0] == '--allbut':
             keepmatches = True
             globs = globs[1:]
         # get pkg filelist and find files that match the globs
         filelist = self._filelist(pkg)
-        matches = set()
-        for g in globs:
-            globs_re = re.compile(fnmatch.translate(g))
-            m = filter(globs_re.match, filelist)
-            if m:
-                matches.update(m)
-            else:
-                logger.debug("removefrom %s %s: no files matched!", pkg, g)
+        matches, unmatched = GlobMatcher(globs).partition(filelist)
+        for g in unmatched:
+            logger.debug("removefrom %s %s: no files matched!", pkg, g)
         # are we removing the matches, or keeping only the matches?
         if keepmatches:
-            files_to_remove = filelist.difference(matches)
-        else:
-            files_to_remove = matches
-        # remove the files
-        if files_to_remove:
-            logger.debug("%s: removed %i/%i files, %ikb/%ikb", cmd,
-                             len(files_to_remove), len(filelist),
-                             self._getsize(*files_to_remove)/1024, self._getsize(*filelist)/1024)
-            self.remove(*files_to_remove)
+            return filelist, filelist.difference(matches)
         else:
-            logger.debug("removefrom %s: no files to remove!", cmd)
+            return filelist, matches
 
     def removekmod(self, *globs):
         '''
@@ -595,6 +1032,19 @@ class LoraxTemplateRunner(object):
             removekmod drivers/char --allbut virtio_console hw_random
         '''
         cmd = " ".join(globs)
+        remove_files = self._removekmod_files(*globs)
+
+        if remove_files and self._removals is not None:
+            logger.debug("removekmod: removing %d files", len(remove_files))
+            self._removals.add_paths(remove_files)
+        elif remove_files:
+            logger.debug("removekmod: removing %d files", len(remove_files))
+            map(remove, remove_files)
+        else:
+            logger.debug("removekmod %s: no files to remove!", cmd)
+
+    def _removekmod_files(self, *globs):
+        '''Return the module files removekmod would remove'''
         if "--allbut" in globs:
             idx = globs.index("--allbut")
             if idx == 0:
@@ -610,28 +1060,23 @@ class LoraxTemplateRunner(object):
             # Nothing to keep
             keepglobs = []
 
+        # walk each directory once, even if another glob matched its parent
+        top_dirs = sorted(set(d for g in globs
+                                for d in rglob(self._out("/lib/modules/*/kernel/"+g))))
         filelist = set()
-        for g in globs:
-            for top_dir in rglob(self._out("/lib/modules/*/kernel/"+g)):
-                for root, _dirs, files in os.walk(top_dir):
-                    filelist.update(root+"/"+f for f in files)
+        walked = []
+        for top_dir in top_dirs:
+            if any(top_dir.startswith(w+"/") for w in walked):
+                continue
+            walked.append(top_dir)
+            for root, _dirs, files in os.walk(top_dir):
+                filelist.update(root+"/"+f for f in files)
 
         # Remove anything matching keepglobs from the list
-        matches = set()
-        for g in keepglobs:
-            globs_re = re.compile(fnmatch.translate("*"+g+"*"))
-            m = filter(globs_re.match, filelist)
-            if m:
-                matches.update(m)
-            else:
-                logger.debug("removekmod %s: no files matched!", g)
-        remove_files = filelist.difference(matches)
-
-        if remove_files:
-            logger.debug("removekmod: removing %d files", len(remove_files))
-            map(remove, remove_files)
-        else:
-            logger.debug("removekmod %s: no files to remove!", cmd)
+        matches, unmatched = GlobMatcher("*"+g+"*" for g in keepglobs).partition(filelist)
+        for g in unmatched:
+            logger.debug("removekmod %s: no files matched!", g[1:-1])
+        return filelist.difference(matches)
 
     def createaddrsize(self, addr, src, dest):
         '''
@@ -31,7 +31,7 @@ import grp
 import glob
 import shutil
 
-from pylorax.executils import runcmd
+from pylorax.treecopy import copy_tree
 
 def joinpaths(*args, **kwargs):
     path = os.path.sep.join(args)
@@ -105,4 +105,7 @@ def remove(target):
         os.unlink(target)
 
 def linktree(src, dst):
-    runcmd(["/bin/cp", "-alx", src, dst])
+    '''Make dst a copy of src that shares its data: reflinked where the
+    filesystem allows, else hardlinked (cp -alx), else copied.
+    Returns the treecopy.CopyStats.'''
+    return copy_tree(src, dst, hardlink=True)
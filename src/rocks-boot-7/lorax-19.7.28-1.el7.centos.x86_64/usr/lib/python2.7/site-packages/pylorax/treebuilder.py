@@ -20,9 +20,23 @@
 import logging
 logger = logging.getLogger("pylorax.treebuilder")
 
-import os, re
+import os, re, glob
+import hashlib
+import threading
+import Queue
+import tempfile
+import struct
+import gzip
+import subprocess
+from cStringIO import StringIO
+from multiprocessing import cpu_count
 from os.path import basename
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
 from pylorax.sysutils import joinpaths, remove
 from shutil import copytree, copy2
 from pylorax.base import DataHolder
@@ -43,34 +57,153 @@ templatemap = {
     'armhfp':  'arm.tmpl',
 }
 
-def generate_module_info(moddir, outfile=None):
-    def module_desc(mod):
+# how many .ko.xz modules one xz run decompresses
+XZ_BATCH = 256
+
+def read_modinfo_section(f):
+    '''Return the contents of the .modinfo section of the ELF file f'''
+    ident = f.read(16)
+    if ident[:4] != "\x7fELF":
+        raise ValueError("not an ELF file")
+    endian = "<" if ident[5] == "\x01" else ">"
+    if ident[4] == "\x02":
+        (shoff_at, shoff_fmt, shnum_at) = (0x28, "Q", 0x3a)
+        shdr_fmt = endian + "IIQQQQIIQQ"
+    else:
+        (shoff_at, shoff_fmt, shnum_at) = (0x20, "I", 0x2e)
+        shdr_fmt = endian + "IIIIIIIIII"
+    shdr_size = struct.calcsize(shdr_fmt)
+
+    f.seek(shoff_at)
+    (shoff,) = struct.unpack(endian + shoff_fmt, f.read(struct.calcsize(shoff_fmt)))
+    f.seek(shnum_at)
+    (shentsize, shnum, shstrndx) = struct.unpack(endian + "HHH", f.read(6))
+
+    f.seek(shoff)
+    table = f.read(shentsize * shnum)
+    # (sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, ...)
+    sections = [struct.unpack(shdr_fmt, table[i*shentsize:i*shentsize+shdr_size])
+                for i in range(shnum)]
+
+    f.seek(sections[shstrndx][4])
+    names = f.read(sections[shstrndx][5])
+    for sh in sections:
+        if names[sh[0]:names.find("\0", sh[0])] == ".modinfo":
+            f.seek(sh[4])
+            return f.read(sh[5])
+    return ""
+
+def open_module(path):
+    '''Open a kernel module, decompressing .ko.gz and .ko.xz'''
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return StringIO(f.read())
+    elif path.endswith(".xz"):
+        # a single module; read_module_info() decompresses them in batches
+        xz = subprocess.Popen(["xz", "-dc", path], stdout=subprocess.PIPE)
+        data = xz.communicate()[0]
+        if xz.returncode:
+            raise IOError("xz -dc %s failed" % path)
+        return StringIO(data)
+    return open(path, "rb")
+
+def xz_decompress(paths):
+    '''Return the decompressed contents of the .xz files in paths, in order.
+    Uses the lzma module if one is installed (python 2 has none of its own),
+    otherwise a single xz --list for the sizes and a single xz -dc whose
+    output is split at them, instead of an xz per file.
+    Raises IOError if xz fails.'''
+    if lzma is not None and hasattr(lzma, "decompress"):
+        data = []
+        for path in paths:
+            with open(path, "rb") as f:
+                data.append(lzma.decompress(f.read()))
+        return data
+
+    listing = subprocess.Popen(["xz", "--robot", "--list"] + paths, stdout=subprocess.PIPE)
+    sizes = [int(line.split("\t")[4]) for line in listing.communicate()[0].splitlines()
+             if line.startswith("file\t")]
+    xz = subprocess.Popen(["xz", "-dc"] + paths, stdout=subprocess.PIPE)
+    out = xz.communicate()[0]
+    if listing.returncode or xz.returncode or len(sizes) != len(paths) or sum(sizes) != len(out):
+        raise IOError("xz -dc of %d modules failed" % len(paths))
+    data = []
+    offset = 0
+    for size in sizes:
+        data.append(out[offset:offset+size])
+        offset += size
+    return data
+
+def module_desc(mod, data=None):
+    '''Return what 'modinfo -F description mod' would print, stripped.
+    data is the decompressed module, if the caller already has it.'''
+    try:
+        f = StringIO(data) if data is not None else open_module(mod)
+        try:
+            modinfo = read_modinfo_section(f)
+        finally:
+            f.close()
+    except (IOError, ValueError, IndexError, struct.error) as e:
+        logger.debug("reading .modinfo from %s failed (%s), using modinfo", mod, e)
         output = runcmd_output(["modinfo", "-F", "description", mod])
         return output.strip()
+
+    desc = [field[len("description="):] for field in modinfo.split("\0")
+            if field.startswith("description=")]
+    return "\n".join(desc).strip()
+
+def read_module_info(moddir):
+    '''Return the module-info entries for the kernel modules in moddir'''
     def read_module_set(name):
         return set(l.strip() for l in open(joinpaths(moddir,name)) if ".ko" in l)
     modsets = {'scsi':read_module_set("modules.block"),
                'eth':read_module_set("modules.networking")}
 
-    modinfo = list()
+    mods = list()
     for root, _dirs, files in os.walk(moddir):
         for modtype, modset in modsets.items():
             for mod in modset.intersection(files):  # modules in this dir
-                (name, _ext) = os.path.splitext(mod) # foo.ko -> (foo, .ko)
-                desc = module_desc(joinpaths(root,mod)) or "%s driver" % name
-                modinfo.append(dict(name=name, type=modtype, desc=desc))
+                mods.append((modtype, joinpaths(root,mod)))
 
-    out = open(outfile or joinpaths(moddir,"module-info"), "w")
+    # decompress the .ko.xz modules XZ_BATCH at a time
+    xzmods = [path for _modtype, path in mods if path.endswith(".xz")]
+    modinfo = list()
+    for i in range(0, len(mods), XZ_BATCH):
+        data = {}
+        batch = [path for _modtype, path in mods[i:i+XZ_BATCH] if path.endswith(".xz")]
+        if batch:
+            try:
+                data = dict(zip(batch, xz_decompress(batch)))
+            except (IOError, OSError) as e:
+                logger.debug("%s, decompressing them one by one", e)
+        for modtype, path in mods[i:i+XZ_BATCH]:
+            (name, _ext) = os.path.splitext(basename(path)) # foo.ko -> (foo, .ko)
+            desc = module_desc(path, data.get(path)) or "%s driver" % name
+            modinfo.append(dict(name=name, type=modtype, desc=desc))
+    logger.debug("read %d module descriptions, %d of them .xz", len(mods), len(xzmods))
+    return modinfo
+
+def write_module_info(modinfo, outfile):
+    out = open(outfile, "w")
     out.write("Version 0\n")
     for mod in sorted(modinfo, key=lambda m: m.get('name')):
         out.write('{name}\n\t{type}\n\t"{desc:.65}"\n'.format(**mod))
 
+def generate_module_info(moddir, outfile=None):
+    write_module_info(read_module_info(moddir),
+                      outfile or joinpaths(moddir,"module-info"))
+
+# free space left in an auto-sized runtime rootfs for the running installer
+RUNTIME_FREE = 256*1024*1024
+
 class RuntimeBuilder(object):
     '''Builds the anaconda runtime image.'''
     def __init__(self, product, arch, yum, templatedir=None,
                  installpkgs=None,
                  add_templates=None,
-                 add_template_vars=None):
+                 add_template_vars=None,
+                 template_cache=None,
+                 dryrun=False):
         root = yum.conf.installroot
         # use a copy of product so we can modify it locally
         product = product.copy()
@@ -79,7 +212,8 @@ class RuntimeBuilder(object):
                                basearch=arch.basearch, libdir=arch.libdir)
         self.yum = yum
         self._runner = LoraxTemplateRunner(inroot=root, outroot=root,
-                                           yum_obj=yum, templatedir=templatedir)
+                                           yum_obj=yum, templatedir=templatedir,
+                                           cache=template_cache, dryrun=dryrun)
         self.add_templates = add_templates or []
         self.add_template_vars = add_template_vars or {}
         self._installpkgs = installpkgs or []
@@ -116,6 +250,49 @@ class RuntimeBuilder(object):
         release, _suffix = release.split('-', 1)
         self._runner.installpkg('%s-logos' % release)
 
+    def _template_path(self, tmpl):
+        if os.path.isabs(tmpl):
+            return tmpl
+        return joinpaths(self._runner.templatedir, tmpl)
+
+    def stage_keys(self):
+        '''Return [(stage, key), ...] for install(), postinstall() and
+        generate_module_data()+cleanup(). Each key is a hash of the key of
+        the stage before it and that stage's own inputs.
+
+        The templates are rendered against the root they run on (glob,
+        exists), so their source and variables are hashed instead of the
+        rendered text: together with the previous stage's key they decide
+        what the rendered text is.'''
+        def key(*inputs):
+            h = hashlib.sha256()
+            for i in inputs:
+                h.update("%s\0" % i)
+            return h.hexdigest()
+
+        def template(tmpl, variables=None):
+            return "%s %s %r" % (tmpl, digest_tree(self._template_path(tmpl)),
+                                 sorted((variables or {}).items()))
+
+        # with the checksum, since the roll's own packages are often rebuilt
+        # without a new version or release
+        available = sorted("{0.name}-{0.epoch}:{0.version}-{0.release}.{0.arch} {0.checksum}".format(p)
+                           for p in self.yum.pkgSack.returnPackages())
+        pylorax_dir = os.path.dirname(os.path.abspath(__file__))
+        v = self.vars
+        install = key(digest_tree(pylorax_dir, match=".py"),
+                      v.arch.buildarch, v.product.name, v.product.version,
+                      v.product.release, v.product.variant, v.product.bugurl,
+                      v.product.isfinal, "\n".join(available),
+                      " ".join(self._installpkgs),
+                      template("runtime-install.tmpl"),
+                      *[template(t, self.add_template_vars) for t in self.add_templates])
+        configdir = joinpaths(self._runner.templatedir, "config_files")
+        postinstall = key(install, template("runtime-postinstall.tmpl"),
+                          digest_tree(configdir))
+        cleanup = key(postinstall, template("runtime-cleanup.tmpl"))
+        return [("install", install), ("postinstall", postinstall), ("cleanup", cleanup)]
+
     def install(self):
         '''Install packages and do initial setup with runtime-install.tmpl'''
         self._install_branding()
@@ -140,9 +317,10 @@ class RuntimeBuilder(object):
         configdir = joinpaths(self._runner.templatedir,"config_files")
         configdir_path = "tmp/config_files"
         fullpath = joinpaths(self.vars.root, configdir_path)
-        if os.path.exists(fullpath):
-            remove(fullpath)
-        copytree(configdir, fullpath)
+        if not self._runner.dryrun:
+            if os.path.exists(fullpath):
+                remove(fullpath)
+            copytree(configdir, fullpath)
         self._runner.run("runtime-postinstall.tmpl", configdir=configdir_path)
 
     def cleanup(self):
@@ -150,41 +328,86 @@ class RuntimeBuilder(object):
         self._runner.run("runtime-cleanup.tmpl")
 
     def writepkgsizes(self, pkgsizefile):
-        '''debugging data: write a big list of pkg sizes'''
+        '''debugging data: write a big list of pkg sizes.
+        Returns the TreeSize of the root so create_runtime can reuse it.'''
+        sizes = imgutils.TreeSize([self.vars.root])
         fobj = open(pkgsizefile, "w")
-        getsize = lambda f: os.lstat(f).st_size if os.path.exists(f) else 0
         for p in sorted(self.yum.doPackageLists(pkgnarrow='installed').installed):
-            pkgsize = sum(getsize(joinpaths(self.vars.root,f)) for f in p.filelist)
+            pkgsize = sum(sizes.size(joinpaths(self.vars.root,f)) for f in p.filelist)
             fobj.write("{0.name}.{0.arch}: {1}\n".format(p, pkgsize))
+        return sizes
 
     def generate_module_data(self):
+        '''Run depmod and collect the module-info entries for all kernels in
+        parallel. module-info is written in listdir order afterwards, so the
+        last kernel still wins like it did when this was done one by one.'''
         root = self.vars.root
         moddir = joinpaths(root, "lib/modules/")
-        for kver in os.listdir(moddir):
-            ksyms = joinpaths(root, "boot/System.map-%s" % kver)
-            logger.info("doing depmod and module-info for %s", kver)
-            runcmd(["depmod", "-a", "-F", ksyms, "-b", root, kver])
-            generate_module_info(moddir+kver, outfile=moddir+"module-info")
-
-    def create_runtime(self, outfile="/var/tmp/squashfs.img", compression="xz", compressargs=None, size=2):
+        kvers = os.listdir(moddir)
+        results = dict()
+
+        def module_data(kver):
+            try:
+                ksyms = joinpaths(root, "boot/System.map-%s" % kver)
+                logger.info("doing depmod and module-info for %s", kver)
+                runcmd(["depmod", "-a", "-F", ksyms, "-b", root, kver])
+                results[kver] = read_module_info(moddir+kver)
+            except Exception as e: # pylint: disable=broad-except
+                results[kver] = e
+
+        threads = [threading.Thread(target=module_data, args=(kver,)) for kver in kvers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for kver in kvers:
+            if isinstance(results[kver], Exception):
+                raise results[kver]
+            write_module_info(results[kver], moddir+"module-info")
+
+    def create_runtime(self, outfile="/var/tmp/squashfs.img", compression="xz", compressargs=None, size=2,
+                       sizes=None, direct=False, processors=None, blocksize=None, memory=None,
+                       benchmark=None):
+        '''Make the runtime image. size is the size of the rootfs in GiB; 0
+        or None sizes it from the tree, leaving RUNTIME_FREE bytes free.
+        processors, blocksize and memory tune mksquashfs. If benchmark is a
+        list of (name, compression, compressargs) the rootfs is squashed with
+        each of those first, and the imgutils.benchmark_squashfs results are
+        returned.'''
         if compressargs is None:
             compressargs = []
         # make live rootfs image - must be named "LiveOS/rootfs.img" for dracut
         workdir = joinpaths(os.path.dirname(outfile), "runtime-workdir")
         os.makedirs(joinpaths(workdir, "LiveOS"))
 
-        imgutils.mkrootfsimg(self.vars.root, joinpaths(workdir, "LiveOS/rootfs.img"),
-                             "Anaconda", size=size)
+        rootfs = joinpaths(workdir, "LiveOS/rootfs.img")
+        imgutils.mkrootfsimg(self.vars.root, rootfs, "Anaconda", size=size or None,
+                             sizes=sizes, direct=direct, free=RUNTIME_FREE)
+        logical, physical = imgutils.image_sizes(rootfs)
+
+        results = None
+        if benchmark:
+            results = imgutils.benchmark_squashfs(workdir, os.path.dirname(outfile), benchmark,
+                                                  processors, blocksize, memory)
 
         # squash the live rootfs and clean up workdir
-        imgutils.mksquashfs(workdir, outfile, compression, compressargs)
+        imgutils.mksquashfs(workdir, outfile, compression, compressargs,
+                            processors, blocksize, memory)
         remove(workdir)
 
+        squashed = os.path.getsize(outfile)
+        logger.info("runtime rootfs is %i MiB, %i MiB allocated, %i MiB squashed (%.1f:1 of the allocated)",
+                    logical/1024**2, physical/1024**2, squashed/1024**2,
+                    float(physical)/max(squashed, 1))
+        return results
+
 class TreeBuilder(object):
     '''Builds the arch-specific boot images.
     inroot should be the installtree root (the newly-built runtime dir)'''
     def __init__(self, product, arch, inroot, outroot, runtime, isolabel, domacboot=False, doupgrade=True,
-                 templatedir=None, add_templates=None, add_template_vars=None, workdir=None, extra_boot_args=""):
+                 templatedir=None, add_templates=None, add_template_vars=None, workdir=None, extra_boot_args="",
+                 initramfs_cache=None, template_cache=None):
 
         # NOTE: if you pass an arg named "runtime" to a mako template it'll
         # clobber some mako internal variables - hence "runtime_img".
@@ -194,56 +417,147 @@ class TreeBuilder(object):
                                basearch=arch.basearch, libdir=arch.libdir,
                                isolabel=isolabel, udev=udev_escape, domacboot=domacboot, doupgrade=doupgrade,
                                workdir=workdir, extra_boot_args=extra_boot_args)
-        self._runner = LoraxTemplateRunner(inroot, outroot, templatedir=templatedir)
+        self._runner = LoraxTemplateRunner(inroot, outroot, templatedir=templatedir,
+                                           cache=template_cache)
         self._runner.defaults = self.vars
         self.add_templates = add_templates or []
         self.add_template_vars = add_template_vars or {}
         self.templatedir = templatedir
         self.treeinfo_data = None
+        self.initramfs_cache = initramfs_cache
 
     @property
     def kernels(self):
         return findkernels(root=self.vars.inroot)
 
-    def rebuild_initrds(self, add_args=None, backup="", prefix=""):
+    def rebuild_initrds(self, add_args=None, backup="", prefix="", workers=None):
         '''Rebuild all the initrds in the tree. If backup is specified, each
         initrd will be renamed with backup as a suffix before rebuilding.
         If backup is empty, the existing initrd files will be overwritten.
         If suffix is specified, the existing initrd is untouched and a new
         image is built with the filename "${prefix}-${kernel.version}.img"
         '''
-        if add_args is None:
-            add_args = []
-        dracut = ["dracut", "--nomdadmconf", "--nolvmconf"] + add_args
-        if not backup:
-            dracut.append("--force")
-
+        self.rebuild_initrd_variants([(prefix, add_args, None)], backup=backup,
+                                     workers=workers)
+
+    def rebuild_initrd_variants(self, variants, backup="", workers=None):
+        '''Rebuild the initrds for several sets of dracut arguments at once.
+        variants is a list of (prefix, add_args, env) tuples, see
+        rebuild_initrds() for prefix. env is a dict of extra environment
+        variables for dracut, or None.
+
+        Every kernel/variant pair is a separate dracut run and up to workers
+        of them (default: the number of cpus) run at the same time, each with
+        its own --tmpdir. If one of them fails the runs after it (in kernel
+        order within variants order) are stopped, the ones before it finish,
+        and the first failure in that order is raised, however the runs
+        happened to be scheduled.
+
+        With an initramfs_cache, images whose inputs match an earlier build
+        are copied from the cache instead of running dracut.
+        '''
         kernels = [kernel for kernel in self.kernels if hasattr(kernel, "initrd")]
         if not kernels:
             raise Exception("No initrds found, cannot rebuild_initrds")
 
+        jobs = []
+        for prefix, add_args, env in variants:
+            dracut = ["dracut", "--nomdadmconf", "--nolvmconf"] + (add_args or [])
+            if not backup:
+                dracut.append("--force")
+
+            for kernel in kernels:
+                if prefix:
+                    idir = os.path.dirname(kernel.initrd.path)
+                    outfile = joinpaths(idir, prefix+'-'+kernel.version+'.img')
+                else:
+                    outfile = kernel.initrd.path
+                jobs.append(DataHolder(outfile=outfile, env=env, key=None,
+                                       cmd=dracut + [outfile, kernel.version]))
+
         # Hush some dracut warnings. TODO: bind-mount proc in place?
         open(joinpaths(self.vars.inroot,"/proc/modules"),"w")
-        for kernel in kernels:
-            if prefix:
-                idir = os.path.dirname(kernel.initrd.path)
-                outfile = joinpaths(idir, prefix+'-'+kernel.version+'.img')
-            else:
-                outfile = kernel.initrd.path
-            logger.info("rebuilding %s", outfile)
-            if backup:
-                initrd = joinpaths(self.vars.inroot, outfile)
-                os.rename(initrd, initrd + backup)
-            cmd = dracut + [outfile, kernel.version]
-            runcmd(cmd, root=self.vars.inroot)
-
+        try:
+            for job in jobs:
+                logger.info("rebuilding %s", job.outfile)
+                if backup:
+                    initrd = joinpaths(self.vars.inroot, job.outfile)
+                    os.rename(initrd, initrd + backup)
+
+            todo = jobs
+            if self.initramfs_cache:
+                cache = self.initramfs_cache
+                for job in jobs:
+                    kver = job.cmd[-1]
+                    job.key = cache.key(self.vars.inroot, kver, job.cmd[:-2], job.env)
+                todo = [job for job in jobs
+                        if not cache.fetch(job.key, joinpaths(self.vars.inroot, job.outfile))]
+
+            self._run_dracut_jobs(todo, workers or cpu_count())
+        finally:
+            os.unlink(joinpaths(self.vars.inroot,"/proc/modules"))
+
+        for job in jobs:
             # ppc64 cannot boot images > 32MiB, check size and warn
-            if self.vars.arch.basearch in ("ppc64", "ppc64le") and os.path.exists(outfile):
-                st = os.stat(outfile)
+            if self.vars.arch.basearch in ("ppc64", "ppc64le") and os.path.exists(job.outfile):
+                st = os.stat(job.outfile)
                 if st.st_size > 32 * 1024 * 1024:
-                    logging.warning("ppc64 initrd %s is > 32MiB", outfile)
+                    logging.warning("ppc64 initrd %s is > 32MiB", job.outfile)
+
+    def _run_dracut_jobs(self, jobs, workers):
+        '''Run the dracut jobs on a pool of worker threads, each one
+        waiting on its own dracut process. A failure cancels only the jobs
+        after it in the list, so the first failure in list order is raised.'''
+        pending = Queue.Queue()
+        for idx, job in enumerate(jobs):
+            pending.put((idx, job))
+        errors = [None] * len(jobs)
+        lock = threading.Lock()
+        first_failed = [len(jobs)]  # index of the earliest failed job so far
+
+        def worker():
+            while True:
+                try:
+                    idx, job = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                if idx > first_failed[0]:
+                    continue
+
+                tmpdir = tempfile.mkdtemp(prefix="dracut.",
+                                          dir=joinpaths(self.vars.inroot, "tmp"))
+                cmd = job.cmd[:1] + ["--tmpdir", tmpdir[len(self.vars.inroot.rstrip("/")):]] \
+                      + job.cmd[1:]
+                try:
+                    runcmd(cmd, root=self.vars.inroot, env_add=job.env,
+                           callback_func=lambda idx=idx: idx > first_failed[0])
+                    if job.key:
+                        self.initramfs_cache.store(job.key,
+                                                   joinpaths(self.vars.inroot, job.outfile))
+                except Exception as e: # pylint: disable=broad-except
+                    with lock:
+                        # a job after an earlier failure was cancelled, and
+                        # its error doesn't matter
+                        if idx < first_failed[0]:
+                            errors[idx] = e
+                            first_failed[0] = idx
+                finally:
+                    remove(tmpdir)
+
+        if not jobs:
+            return
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(max(1, min(workers, len(jobs))))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
 
-        os.unlink(joinpaths(self.vars.inroot,"/proc/modules"))
+        if first_failed[0] < len(jobs):
+            err = errors[first_failed[0]]
+            logger.error("rebuilding %s failed: %s", jobs[first_failed[0]].outfile, err)
+            raise err
 
     def build(self):
         templatefile = templatemap[self.vars.arch.basearch]
@@ -294,6 +608,193 @@ class TreeBuilder(object):
 
 #### TreeBuilder helper functions
 
+def digest_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.path.basename(path) == ".buildstamp":
+            # UUID= is the build time, leave it out of the key
+            for line in f:
+                if not line.startswith("UUID="):
+                    h.update(line)
+        else:
+            for data in iter(lambda: f.read(1024*1024), ""):
+                h.update(data)
+    return h.hexdigest()
+
+def digest_tree(path, match=None):
+    '''Hash the names, link targets and contents of everything under path,
+    or only of the files whose names end with match'''
+    h = hashlib.sha256()
+    if os.path.islink(path):
+        h.update("l %s\0" % os.readlink(path))
+    elif os.path.isfile(path):
+        h.update("f %s\0" % digest_file(path))
+    elif os.path.isdir(path):
+        for top, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files + [d for d in dirs if os.path.islink(joinpaths(top, d))]):
+                if match and not name.endswith(match):
+                    continue
+                fullpath = joinpaths(top, name)
+                relpath = os.path.relpath(fullpath, path)
+                if os.path.islink(fullpath):
+                    h.update("l %s %s\0" % (relpath, os.readlink(fullpath)))
+                elif os.path.isfile(fullpath):
+                    h.update("f %s %s\0" % (relpath, digest_file(fullpath)))
+    else:
+        h.update("missing\0")
+    return h.hexdigest()
+
+class StageCache(object):
+    '''Snapshots of the runtime root after each RuntimeBuilder stage, see
+    RuntimeBuilder.stage_keys(). Only the newest snapshot of each stage is
+    kept. Snapshots are full copies (reflinks where the filesystem can do
+    them), later stages change files in place so hardlinks won't do.'''
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    def _path(self, stage, key):
+        return joinpaths(self.cachedir, "%s-%s" % (stage, key))
+
+    def has(self, stage, key):
+        return os.path.isdir(self._path(stage, key))
+
+    def available(self, keys):
+        '''Return the stages, in order, that can be restored. keys is a list
+        of (stage, key), each key depends on the ones before it.'''
+        stages = []
+        for stage, key in keys:
+            if not self.has(stage, key):
+                break
+            stages.append(stage)
+        return stages
+
+    def save(self, stage, key, root):
+        snapshot = self._path(stage, key)
+        logger.info("saving %s snapshot %s", stage, snapshot)
+        tmp = snapshot + ".tmp"
+        if os.path.exists(tmp):
+            remove(tmp)
+        os.makedirs(tmp)
+        runcmd(["cp", "-a", "--reflink=auto", joinpaths(root, "."), tmp])
+        os.rename(tmp, snapshot)
+
+        for name in os.listdir(self.cachedir):
+            if name.startswith(stage + "-") and joinpaths(self.cachedir, name) != snapshot:
+                remove(joinpaths(self.cachedir, name))
+
+    def restore(self, stage, key, root):
+        snapshot = self._path(stage, key)
+        logger.info("restoring %s from %s snapshot %s", root, stage, snapshot)
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        for name in os.listdir(root):
+            remove(joinpaths(root, name))
+        runcmd(["cp", "-a", "--reflink=auto", joinpaths(snapshot, "."), root])
+
+def installed_packages(root):
+    '''Return the sorted "name-epoch:version-release.arch sigmd5" lines of
+    the packages installed in root. The SIGMD5 changes whenever a package is
+    rebuilt, even under the same NEVRA.'''
+    pkgs = runcmd_output(["rpm", "--root", root, "-qa", "--qf",
+                          "%{NAME}-%{EPOCHNUM}:%{VERSION}-%{RELEASE}.%{ARCH} %{SIGMD5}\\n"])
+    return sorted(pkgs.splitlines())
+
+# inst, inst_binary, inst_simple, ... (but not inst_dir, which only makes
+# the directory) and find, followed by the rest of the shell command
+DRACUT_INST_RE = re.compile(r"\b(?:inst(?!_dir\b)\w*|find)\s([^;|&`)]*)")
+DRACUT_PATH_RE = re.compile(r"^/[\w.+@/-]+$")
+
+def dracut_module_paths(root):
+    '''Return the absolute paths in root that the dracut modules' setup
+    scripts name literally when installing files, e.g. /fetchRocksKS.py and
+    /lighttpd in 70rocks. Paths built from shell variables aren't found.'''
+    paths = set()
+    for setup in glob.glob(joinpaths(root, "usr/lib/dracut/modules.d/*/module-setup.sh")):
+        for line in open(setup):
+            line = line.split("#", 1)[0]
+            for match in DRACUT_INST_RE.finditer(line):
+                for arg in match.group(1).split():
+                    arg = arg.strip("\"'")
+                    if arg != "/" and DRACUT_PATH_RE.match(arg):
+                        paths.add(arg)
+    return sorted(paths)
+
+class InitramfsCache(object):
+    '''On-disk cache of dracut images, keyed on a hash of what goes into them:
+    the kernel version, its module tree, the dracut modules, the files the
+    dracut modules name (see dracut_module_paths()), the files passed with
+    --include/--install, the dracut arguments and environment, and extra_key.
+
+    extra_key must cover the rest of the root dracut copies from: the
+    installed packages with their checksums (see installed_packages()) and
+    whatever templates changed the root after they were installed.'''
+    def __init__(self, cachedir, extra_key=""):
+        self.cachedir = cachedir
+        self.extra_key = extra_key
+        self._tree_digests = {}
+        self._module_paths = {}
+
+    def _digest_tree(self, path):
+        if path not in self._tree_digests:
+            self._tree_digests[path] = digest_tree(path)
+        return self._tree_digests[path]
+
+    def key(self, root, kver, dracut_args, env=None):
+        '''Return the cache key for building kver's initramfs in root with the
+        dracut command line dracut_args (without the outfile and kver)'''
+        h = hashlib.sha256()
+        h.update("%s\0%s\0" % (kver, self.extra_key))
+        h.update("%s\0" % "\0".join(a for a in dracut_args if a != "--force"))
+        for k in sorted(env or {}):
+            h.update("%s=%s\0" % (k, env[k]))
+
+        if root not in self._module_paths:
+            self._module_paths[root] = dracut_module_paths(root)
+        paths = [joinpaths("lib/modules", kver), "usr/lib/dracut"] + self._module_paths[root]
+        for i, arg in enumerate(dracut_args[:-1]):
+            if arg in ("-i", "--include"):
+                paths.append(dracut_args[i+1])
+            elif arg in ("-I", "--install"):
+                paths += dracut_args[i+1].split()
+        for path in paths:
+            h.update("%s %s\0" % (path, self._digest_tree(joinpaths(root, path))))
+
+        return h.hexdigest()
+
+    def _path(self, key):
+        return joinpaths(self.cachedir, key[:2], key + ".img")
+
+    def fetch(self, key, outfile):
+        '''Copy the cached image for key to outfile, return False on a miss'''
+        cached = self._path(key)
+        if not os.path.exists(cached):
+            logger.debug("initramfs cache miss for %s (%s)", outfile, key)
+            return False
+
+        logger.info("using cached initramfs %s for %s", cached, outfile)
+        if os.path.lexists(outfile):
+            os.unlink(outfile)
+        copy2(cached, outfile)
+        return True
+
+    def store(self, key, outfile):
+        '''Add outfile to the cache as key'''
+        cached = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(cached))
+        except OSError:
+            # already there, or made by another dracut job
+            pass
+
+        try:
+            tmp = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(cached))
+            os.close(tmp[0])
+            copy2(outfile, tmp[1])
+            os.rename(tmp[1], cached)
+        except (IOError, OSError) as e:
+            logger.warning("could not add %s to the initramfs cache: %s", outfile, e)
+
 def findkernels(root="/", kdir="boot"):
     # To find possible flavors, awk '/BuildKernel/ { print $4 }' kernel.spec
     flavors = ('debug', 'PAE', 'PAEdebug', 'smp', 'xen', 'lpae', 'tegra')
@@ -0,0 +1,271 @@
+#
+# treecopy.py - copy directory trees as cheaply as the filesystem allows
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+logger = logging.getLogger("pylorax.treecopy")
+
+import os
+import stat
+import fcntl
+import tempfile
+import threading
+import time
+import multiprocessing
+from os.path import join
+from subprocess import CalledProcessError
+
+try:
+    import xattr
+except ImportError:
+    xattr = None
+
+from pylorax.executils import runcmd
+
+# linux/fs.h
+FICLONE = 0x40049409
+
+# don't split a tree deeper than this looking for units of work
+MAX_SPLIT_DEPTH = 3
+
+class CopyStats(object):
+    '''What copy_tree did: the method used, how long it took and how many
+    files (counting each hardlinked inode once) and bytes it covered.
+    Unless the copy already scanned the tree, files and size walk it on
+    first use.'''
+    def __init__(self, method, seconds, src, one_fs=False, scan=None):
+        (self.method, self.seconds) = (method, seconds)
+        (self.src, self.one_fs, self._treescan) = (src, one_fs, scan)
+
+    def _scan(self):
+        if self._treescan is None:
+            self._treescan = TreeScan(self.src, one_fs=self.one_fs)
+        return self._treescan
+
+    @property
+    def files(self):
+        return self._scan().files
+
+    @property
+    def size(self):
+        return self._scan().size
+
+    def __str__(self):
+        if self._treescan is None:
+            return "%s in %.1fs" % (self.method, self.seconds)
+        return "%s %d files, %.1f MiB in %.1fs" % (self.method, self.files,
+                                                   self.size/1024.0**2, self.seconds)
+
+class TreeScan(object):
+    '''Walk a tree once, noting the bytes under each directory and which
+    directories contain each multiply-linked inode.'''
+    def __init__(self, rootdir, one_fs=False):
+        self.rootdir = rootdir
+        self.files = 0
+        self.size = 0
+        self.dirsize = {}       # relative dir -> bytes of regular files below it
+        self.links = {}         # (dev, ino) -> set of relative paths
+        rootdev = os.lstat(rootdir).st_dev
+        seen = set()
+        for top, dirs, files in os.walk(rootdir):
+            rel = os.path.relpath(top, rootdir)
+            if one_fs:
+                dirs[:] = [d for d in dirs if os.lstat(join(top, d)).st_dev == rootdev]
+            total = 0
+            for f in files:
+                st = os.lstat(join(top, f))
+                if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                    self.links.setdefault((st.st_dev, st.st_ino), set()).add(
+                        os.path.normpath(join(rel, f)))
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                self.files += 1
+                if stat.S_ISREG(st.st_mode):
+                    total += st.st_size
+            self.size += total
+            # charge the bytes to this dir and each of its parents
+            while True:
+                self.dirsize[rel] = self.dirsize.get(rel, 0) + total
+                if rel == ".":
+                    break
+                rel = os.path.dirname(rel) or "."
+
+    def units(self, target):
+        '''Split the tree into entries of roughly target bytes or less.
+        Returns (dirs to create, list of units), each unit being a list of
+        relative paths that must be copied by the same cp so that hardlinks
+        between them survive.'''
+        split = ["."]
+        units = []
+        pending = ["."]
+        while pending:
+            rel = pending.pop()
+            for name in sorted(os.listdir(join(self.rootdir, rel))):
+                path = os.path.normpath(join(rel, name))
+                isdir = stat.S_ISDIR(os.lstat(join(self.rootdir, path)).st_mode)
+                if isdir and path not in self.dirsize:
+                    # on another filesystem, pruned by the scan
+                    continue
+                if isdir and self.dirsize[path] > target and path.count("/") < MAX_SPLIT_DEPTH:
+                    split.append(path)
+                    pending.append(path)
+                else:
+                    units.append(path)
+
+        # join units that share an inode
+        owner = dict((u, u) for u in units)
+        def find(u):
+            while owner[u] != u:
+                u = owner[u]
+            return u
+        def unit_of(path):
+            while path not in owner:
+                path = os.path.dirname(path)
+            return path
+        for paths in self.links.values():
+            roots = set(find(unit_of(p)) for p in paths)
+            if len(roots) < 2:
+                continue
+            first = roots.pop()
+            for other in roots:
+                owner[other] = first
+        groups = {}
+        for u in units:
+            groups.setdefault(find(u), []).append(u)
+        return split, groups.values()
+
+def first_file(rootdir, one_fs=False):
+    '''Return the first non-empty regular file under rootdir, or None.
+    Stops walking as soon as it finds one.'''
+    rootdev = os.lstat(rootdir).st_dev
+    for top, dirs, files in os.walk(rootdir):
+        if one_fs:
+            dirs[:] = [d for d in dirs if os.lstat(join(top, d)).st_dev == rootdev]
+        for f in files:
+            st = os.lstat(join(top, f))
+            if stat.S_ISREG(st.st_mode) and st.st_size:
+                return join(top, f)
+    return None
+
+def can_reflink(src, destdir):
+    '''Return True if a file in src can be cloned into destdir'''
+    if src is None:
+        return False
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=".lorax-reflink-", dir=destdir)
+    except OSError:
+        return False
+    try:
+        with open(src, "rb") as f:
+            fcntl.ioctl(fd, FICLONE, f.fileno())
+        return True
+    except IOError:
+        return False
+    finally:
+        os.close(fd)
+        os.unlink(tmp)
+
+def copy_metadata(src, dst):
+    '''Copy owner, mode, xattrs (SELinux labels and ACLs among them) and
+    timestamps of src to dst'''
+    st = os.lstat(src)
+    os.lchown(dst, st.st_uid, st.st_gid)
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    for key, value in xattr.get_all(src, nofollow=True):
+        xattr.set(dst, key, value, nofollow=True)
+    os.utime(dst, (st.st_atime, st.st_mtime))
+
+def copy_parallel(scan, dest, cpargs, workers):
+    '''Copy the tree in scan to dest with up to workers cp processes at once.'''
+    target = max(scan.size/(workers*4), 1)
+    split, groups = scan.units(target)
+    for rel in split:
+        path = join(dest, rel)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    # biggest first, so the long ones don't start last
+    groups.sort(key=lambda g: -sum(scan.dirsize.get(u, 0) for u in g))
+    logger.debug("copying %s in %d parts with %d workers", scan.rootdir, len(groups), workers)
+
+    lock = threading.Lock()
+    errors = []
+    def worker():
+        while True:
+            with lock:
+                if not groups or errors:
+                    return
+                group = groups.pop(0)
+            try:
+                runcmd(["cp"] + cpargs + ["--parents"] + group + [os.path.abspath(dest)],
+                       cwd=scan.rootdir)
+            except (CalledProcessError, RuntimeError) as e:
+                with lock:
+                    errors.append(e)
+    threads = [threading.Thread(target=worker) for _ in xrange(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+    # the directories we made ourselves need the source's metadata, now
+    # that nothing else will be created in them
+    for rel in reversed(split):
+        copy_metadata(join(scan.rootdir, rel), join(dest, rel))
+
+def copy_tree(src, dest, hardlink=False, workers=None):
+    '''Copy the contents of src into dest (created if needed), preserving
+    modes, owners, timestamps, hardlinks, sparse files, xattrs, ACLs and
+    SELinux labels like cp -a.
+
+    Uses the cheapest method that works: reflinks (cp --reflink=always) if
+    dest's filesystem can clone src's files, then hardlinks (cp -al) if
+    hardlink is True and both are on the same filesystem, then cp -a split
+    over subtrees and run workers at a time (the number of CPUs by default).
+    With hardlink the copy stays on src's filesystem, like cp -alx.
+
+    Only the parallel copy scans the whole tree up front.
+
+    Returns a CopyStats. Raises CalledProcessError if cp fails.'''
+    start = time.time()
+    scan = None
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    cpargs = ["-a"] + (["-x"] if hardlink else [])
+    if can_reflink(first_file(src, one_fs=hardlink), dest):
+        method = "reflinked"
+        runcmd(["cp"] + cpargs + ["--reflink=always", ".", os.path.abspath(dest)], cwd=src)
+    elif hardlink and os.lstat(src).st_dev == os.lstat(dest).st_dev:
+        method = "hardlinked"
+        runcmd(["cp"] + cpargs + ["-l", ".", os.path.abspath(dest)], cwd=src)
+    else:
+        workers = workers or multiprocessing.cpu_count()
+        if xattr is None or workers < 2:
+            if xattr is None:
+                logger.debug("python xattr module missing, copying %s with one cp", src)
+            method = "copied"
+            runcmd(["cp"] + cpargs + [".", os.path.abspath(dest)], cwd=src)
+        else:
+            method = "copied (%d workers)" % workers
+            scan = TreeScan(src, one_fs=hardlink)
+            copy_parallel(scan, dest, cpargs, workers)
+    stats = CopyStats(method, time.time() - start, src, one_fs=hardlink, scan=scan)
+    logger.info("%s to %s: %s", src, dest, stats)
+    return stats
@@ -5,6 +5,10 @@ RPM.PREFIX	= $(PKGROOT)
 INSTALLERISO	= rocks-installer-$(VERSION.MAJOR)-$(VERSION.MINOR).iso
 
 ISFINAL = --isfinal
+
+# reuse unchanged runtime build stages from the last build. For developer
+# builds only (make INCREMENTAL=--incremental), release builds stay clean
+#INCREMENTAL = --incremental
 ifdef ISFINAL
 #CENTRAL=central-$(shell echo $(VERSION) | tr . -)-x86-64.rocksclusters.org
 CENTRAL=rc-ucr.org/$(shell echo $(VERSION) | tr . -)-UCR